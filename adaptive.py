@@ -0,0 +1,192 @@
+'''
+Adaptive alternative to the fixed beta/seed grid for the calibration sweep.
+Runs are proposed in batches; after each batch, the acceptance rate of each
+beta (and, optionally, change) is updated, and the next batch is shared out in
+proportion to draws from each one's Beta posterior, so runs go to the
+parameters that produce accepted seeds. Every parameter set keeps getting a
+minimum share, so none are starved on the strength of a few early rejections.
+Sampling stops once a target number of accepted (beta, seed) pairs is reached.
+
+Seeds are used in order for each parameter set, so the results can be written
+out in the same fitsummary layout as the grid, with nan for seeds not run.
+Since the runs weren't shared out equally, the accepted runs are biased
+towards the parameter sets with the highest acceptance rates; every accepted
+run is kept, and fitweights() gives the importance weight of each beta, which
+scenarios.scenario_jobs() resamples the runs by so that the parameter sets
+count as they would in the grid.
+'''
+
+import multiprocessing as mp
+import numpy as np
+import sciris as sc
+from sweep import run_sweep
+import calibration as cal
+
+
+class AdaptiveSampler:
+    '''
+    Allocate calibration runs across parameter sets by their acceptance rate.
+
+    Args:
+        betas (list): the betas to sample
+        changes (list): the values of change to sample
+        n_runs (int): the maximum number of seeds per parameter set
+        cutoff (float): runs with a mismatch below this are accepted
+        n_init (int): the number of runs per parameter set in the first batch
+        min_share (float): the smallest share of each batch given to any parameter set, as a fraction of an equal share
+        seed (int): random seed for the allocation
+    '''
+
+    def __init__(self, betas, changes, n_runs, cutoff, n_init=10, min_share=0.1, seed=0):
+        self.arms = [(beta, change) for change in changes for beta in betas]
+        self.n_runs = n_runs
+        self.cutoff = cutoff
+        self.n_init = n_init
+        self.min_share = min_share
+        self.rng = np.random.RandomState(seed)
+        self.next_seed = {arm:0 for arm in self.arms}
+        self.accepted  = {arm:0 for arm in self.arms}
+        self.rejected  = {arm:0 for arm in self.arms}
+        self.cpu_time  = {arm:0.0 for arm in self.arms}
+        self.mismatch  = {arm:np.full(n_runs, np.nan) for arm in self.arms}
+        return
+
+
+    @property
+    def n_accepted(self):
+        return sum(self.accepted.values())
+
+
+    def remaining(self, arm):
+        return self.n_runs - self.next_seed[arm]
+
+
+    def allocate(self, batch_size):
+        ''' How many runs each parameter set gets in the next batch '''
+        open_arms = [arm for arm in self.arms if self.remaining(arm) > 0]
+        if not open_arms:
+            return {}
+        if all(self.next_seed[arm] == 0 for arm in self.arms): # First batch: the same for everyone
+            return {arm:min(self.n_init, self.remaining(arm)) for arm in open_arms}
+        theta = np.array([self.rng.beta(1 + self.accepted[arm], 1 + self.rejected[arm]) for arm in open_arms]) # Thompson draws of the acceptance rates
+        share = theta/theta.sum()
+        share = np.maximum(share, self.min_share/len(open_arms))
+        share /= share.sum()
+        counts = self.rng.multinomial(batch_size, share)
+        return {arm:min(int(n), self.remaining(arm)) for arm,n in zip(open_arms, counts) if n > 0}
+
+
+    def propose(self, batch_size, **kwargs):
+        ''' The jobs for the next batch; kwargs are added to every job '''
+        jobs = []
+        for (beta,change),n in self.allocate(batch_size).items():
+            start = self.next_seed[(beta,change)]
+            jobs += [dict(beta=beta, change=change, seed=seed, **kwargs) for seed in range(start, start+n)]
+            self.next_seed[(beta,change)] += n
+        return jobs
+
+
+    def update(self, records):
+        ''' Add the results of finished jobs '''
+        for r in records:
+            arm = (r['beta'], r['change'])
+            self.mismatch[arm][r['seed']] = r['mismatch']
+            if r['mismatch'] < self.cutoff:
+                self.accepted[arm] += 1
+            else:
+                self.rejected[arm] += 1
+            self.cpu_time[arm] += r.get('time', 0.0)
+        return
+
+
+    def fitsummary(self, change):
+        ''' The mismatches for one value of change in the grid's fitsummary layout: one list per beta, indexed by seed, with nan for seeds not run '''
+        return [list(self.mismatch[arm]) for arm in self.arms if arm[1] == change]
+
+
+    def weights(self):
+        '''
+        Importance weight of a run from each parameter set. Runs were not shared
+        out equally, so to weight the parameter sets as the grid does, each run
+        counts in inverse proportion to the runs its parameter set was given;
+        the weights average 1 over the parameter sets that were run.
+        '''
+        n = {arm:self.accepted[arm] + self.rejected[arm] for arm in self.arms}
+        mean_n = np.mean([v for v in n.values() if v])
+        return {arm:(mean_n/n[arm] if n[arm] else 0.0) for arm in self.arms}
+
+
+    def fitweights(self, change):
+        ''' The weights() of each beta for one value of change, in the order of fitsummary() '''
+        weights = self.weights()
+        return [weights[arm] for arm in self.arms if arm[1] == change]
+
+
+    def report(self, grid_records=None):
+        '''
+        Print runs, acceptance and CPU time for each parameter set, and compare
+        accepted runs per CPU-hour with the grid: from the grid's own records if
+        given, otherwise estimated from the per-run acceptance rate and run time
+        observed here, applied to an equal split of runs.
+        '''
+        weights = self.weights()
+        print(f'{"beta":>8s} {"change":>7s} {"runs":>6s} {"accepted":>9s} {"rate":>6s} {"CPU (h)":>8s} {"weight":>7s}')
+        for arm in self.arms:
+            n = self.accepted[arm] + self.rejected[arm]
+            rate = self.accepted[arm]/n if n else np.nan
+            print(f'{arm[0]:8.4f} {arm[1]:7.2f} {n:6d} {self.accepted[arm]:9d} {rate:6.3f} {self.cpu_time[arm]/3600:8.3f} {weights[arm]:7.2f}')
+
+        total_cpu = sum(self.cpu_time.values())/3600
+        adaptive_rate = self.n_accepted/total_cpu if total_cpu else np.nan
+        if grid_records:
+            grid_cpu = sum(r.get('time', 0.0) for r in grid_records)/3600
+            grid_rate = sum(r['mismatch'] < self.cutoff for r in grid_records)/grid_cpu if grid_cpu else np.nan
+            source = f'from {len(grid_records)} grid runs'
+        else:
+            tried = [arm for arm in self.arms if self.accepted[arm] + self.rejected[arm]]
+            p = np.mean([self.accepted[arm]/(self.accepted[arm] + self.rejected[arm]) for arm in tried])
+            t = np.mean([self.cpu_time[arm]/(self.accepted[arm] + self.rejected[arm]) for arm in tried])/3600
+            grid_rate = p/t if t else np.nan
+            source = 'estimated from the runs above'
+        print(f'Accepted runs per CPU-hour: {adaptive_rate:0.1f} adaptive vs {grid_rate:0.1f} grid ({source}); {self.n_accepted} accepted in {total_cpu:0.2f} CPU-hours')
+        return sc.objdict(adaptive=adaptive_rate, grid=grid_rate, weights=weights)
+
+
+def adaptive_fit(betas, n_runs, change, end_day, cutoff, target, changes=None, checkpoint=None, batch_size=None, ncpus=None, early_stop=True, n_agents=None, label='Adaptive fitting', **kwargs):
+    '''
+    Run the calibration adaptively until target runs have been accepted (or every seed of every parameter set has been run).
+
+    Args:
+        betas (list): the betas to sample
+        n_runs (int): the maximum number of seeds per parameter set
+        change (float): the value of change, if changes isn't given
+        end_day (str): the end of the calibration window
+        cutoff (float): runs with a mismatch below this are accepted
+        target (int): the number of accepted runs to stop at
+        changes (list): sample over these values of change as well
+        checkpoint (Checkpoint): a checkpoint with keys beta, change and seed; finished runs in it are not rerun
+        batch_size (int): runs per batch (default: 4 per worker)
+        ncpus (int): number of worker processes
+        early_stop (bool): stop runs once they can no longer be accepted
+        n_agents (float): number of agents, if not the make_sim() default
+        kwargs (dict): passed to AdaptiveSampler
+
+    Returns:
+        sampler (AdaptiveSampler): use sampler.fitsummary(change) for the results
+    '''
+    changes = changes if changes is not None else [change]
+    if batch_size is None:
+        batch_size = 4*(ncpus if ncpus else mp.cpu_count())
+    sampler = AdaptiveSampler(betas, changes, n_runs, cutoff, **kwargs)
+    job_kwargs = dict(n_agents=n_agents) if n_agents is not None else {}
+    batch = 0
+    while sampler.n_accepted < target:
+        jobs = sampler.propose(batch_size, end_day=end_day, cutoff=cutoff if early_stop else None, **job_kwargs)
+        if not jobs:
+            print(f'{label}: every seed has been run; stopping with {sampler.n_accepted} of {target} accepted')
+            break
+        records = run_sweep(cal.fit_run, jobs, checkpoint=checkpoint, ncpus=ncpus, label=f'{label} batch {batch}', report_every=len(jobs))
+        sampler.update(records.values())
+        batch += 1
+        print(f'{label}: {sampler.n_accepted}/{target} accepted after {batch} batches')
+    return sampler
@@ -0,0 +1,107 @@
+'''
+Benchmark of contact tracing over the calibration window, finding each day's
+contacts by scanning every edge of the traced layers (cv.contact_tracing) and
+from an index of each layer (vietnam_interventions.indexed_contact_tracing).
+Gives the time spent tracing per day (from the profiler) on the days with the
+most diagnoses -- the peak of the outbreak, when the most people are traced --
+and over all days, along with the time to build the index of each layer. It
+checks that the index finds exactly the same contacts as each layer, and that
+the number of people notified per run agrees statistically both ways (the
+draws of which contacts are traced may differ, so single runs can differ).
+
+Run from the repository root:
+
+    python benchmarks/bench_contact_tracing.py [n_seeds]
+'''
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The model reads vietnam_data.csv from the root folder
+import covasim as cv
+import vietnam_model as vm
+import vietnam_interventions as vi
+import resultstore as rs
+import profiling
+
+n_seeds = int(sys.argv[1]) if len(sys.argv)>1 else 5
+n_peak = 14 # Number of days with the most diagnoses counted as the peak
+today = '2020-10-15' # Past the reopening of schools and workplaces, so the rebuilt indexes are timed too
+beta = 0.0135
+
+
+def bench(indexed):
+    ''' Run every seed, returning the results, the dates each person was notified, and the tracing time and diagnoses by day '''
+    vm.indexed_tracing = indexed
+    vi.clear_indexes()
+    s0 = vm.make_sim(seed=1, beta=beta, end_day=today)
+    i = [isinstance(intervention, cv.contact_tracing) for intervention in s0['interventions']].index(True)
+    results = []
+    notified = []
+    tracing = []
+    diagnoses = []
+    for seed in range(n_seeds):
+        sim = vm.copy_sim(s0)
+        sim['rand_seed'] = seed
+        sim.set_seed()
+        profiling.enable()
+        sim.run()
+        profile = profiling.take()
+        day_time = np.zeros(sim.npts)
+        for name,row in profile['rows'].items():
+            if name.startswith(f'intervention {i}:'):
+                day_time[:len(row['time'])] += row['time']
+        tracing.append(day_time)
+        diagnoses.append(sim.results['new_diagnoses'].values)
+        results.append(rs.get_results(sim))
+        notified.append(sim.people.date_known_contact.copy())
+    return dict(results=results, notified=notified, tracing=np.array(tracing), diagnoses=np.array(diagnoses), sim=s0)
+
+
+def same_contacts(sim, n_people=1000, seed=0):
+    ''' Whether the index of each layer finds the same contacts as the layer itself, for a random sample of people '''
+    inds = np.sort(np.random.RandomState(seed).choice(len(sim.people), n_people, replace=False))
+    for lkey,layer in sim.people.contacts.items():
+        index = vi.ContactIndex(layer['p1'], layer['p2'], len(sim.people))
+        if not np.array_equal(index.find_contacts(inds), np.unique(layer.find_contacts(inds))):
+            return False
+    return True
+
+
+def notified_z(a, b):
+    ''' Difference in the mean number of people notified per run, in standard errors '''
+    a, b = [np.array([np.isfinite(n).sum() for n in r['notified']]) for r in [a, b]]
+    se = np.sqrt(a.var(ddof=1)/len(a) + b.var(ddof=1)/len(b)) if len(a) > 1 else np.nan
+    return (b.mean() - a.mean())/se if se else 0.0
+
+
+def build_times(sim):
+    ''' Time to index each traced layer of a sim, in seconds '''
+    times = {}
+    for lkey,layer in sim.people.contacts.items():
+        T = time.time()
+        vi.ContactIndex(layer['p1'], layer['p2'], len(sim.people))
+        times[lkey] = time.time() - T
+    return times
+
+
+vm.make_sim(seed=1, beta=beta, end_day=today) # Make sure the on-disk population cache exists
+scan = bench(indexed=False)
+indexed = bench(indexed=True)
+
+peak_days = np.sort(np.argsort(-scan['diagnoses'].mean(axis=0))[:n_peak])
+contacts = same_contacts(indexed['sim'])
+z = notified_z(scan, indexed)
+identical = all(np.array_equal(a, b, equal_nan=True) for a,b in zip(scan['notified'], indexed['notified']))
+
+sim = indexed['sim']
+print(f'{n_seeds} seeds to {today}; peak days {sim.date(int(peak_days[0]))} to {sim.date(int(peak_days[-1]))}, with {scan["diagnoses"][:,peak_days].mean():0.1f} diagnoses per day')
+print('Index build (ms): ' + ', '.join(f'{lkey} {t*1e3:0.1f} ({len(sim.people.contacts[lkey]):,} edges)' for lkey,t in build_times(sim).items()))
+print(f'{"Tracing":10s} {"peak day (ms)":>14s} {"any day (ms)":>13s} {"per run (s)":>12s}')
+for label,r in [('scan', scan), ('indexed', indexed)]:
+    print(f'{label:10s} {r["tracing"][:,peak_days].mean()*1e3:14.2f} {r["tracing"].mean()*1e3:13.2f} {r["tracing"].sum(axis=1).mean():12.3f}')
+print(f'Speedup on peak days: {scan["tracing"][:,peak_days].mean()/indexed["tracing"][:,peak_days].mean():0.1f}x')
+print(f'Contacts found: {"same" if contacts else "DIFFER"}; people notified per run: {"consistent" if abs(z) < 3 else "DIFFER"} ({z:+0.1f} standard errors){"; runs identical" if identical else ""}')
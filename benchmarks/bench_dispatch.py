@@ -0,0 +1,123 @@
+'''
+Benchmark of handing a batch of seeds to the worker pool: the parent's peak
+memory, and how long it takes from the start of the batch until each worker has
+its sim ready to run. Three ways of dispatching are compared:
+
+    sims    the parent copies the base sim for every seed and sends the copies to the pool, as cv.MultiSim does
+    jobs    only the seed crosses to the workers, which copy the sim built by vietnam_model.shared_sim()
+    shared  as jobs, with the population's read-only arrays in shared memory (see sharedpeople)
+
+Each mode runs in its own process, so that its peak RSS is its own. Worker
+memory is given as the total proportional set size (PSS) of the workers, which
+counts each shared page once across them.
+
+Run from the repository root:
+
+    python benchmarks/bench_dispatch.py [n_seeds] [ncpus]
+'''
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import numpy as np
+import multiprocessing as mp
+
+thisfile = os.path.abspath(__file__)
+sys.path.insert(0, os.path.join(os.path.dirname(thisfile), '..'))
+os.chdir(os.path.join(os.path.dirname(thisfile), '..')) # The model reads vietnam_data.csv from the root folder
+import vietnam_model as vm
+
+modes = ['sims', 'jobs', 'shared']
+sim_kwargs = dict(beta=0.0135, policy='dynamic')
+n_steps = 1 # Days each worker runs its sim, to check it's usable; dispatch is what's being timed
+
+
+def peak_rss():
+    ''' Peak resident memory of this process in MB '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3 # In kB on Linux
+
+
+def pss():
+    ''' Current proportional set size of this process in MB, or nan if not available '''
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return float(line.split()[1])/1e3
+    except OSError:
+        pass
+    return np.nan
+
+
+def worker_pid(_):
+    return os.getpid()
+
+
+def ready(sim, t0):
+    sim.run(until=n_steps)
+    return time.time() - t0, os.getpid(), pss()
+
+
+def run_copy(args):
+    ''' Worker for "sims": the sim arrives ready-made '''
+    t0, sim = args
+    return ready(sim, t0)
+
+
+def run_seed(args):
+    ''' Worker for "jobs" and "shared": only the seed arrives '''
+    t0, seed = args
+    sim = vm.copy_sim(vm.shared_sim(seed=1, **sim_kwargs))
+    sim['rand_seed'] = seed
+    sim.set_seed()
+    return ready(sim, t0)
+
+
+def bench(mode, n_seeds, ncpus):
+    ''' Dispatch one batch in this process and return its statistics '''
+    s0 = vm.shared_sim(seed=1, **sim_kwargs) # Built before the pool starts, so the workers inherit it
+    if mode == 'shared':
+        vm.share_population(s0)
+    with mp.Pool(processes=ncpus) as pool:
+        pool.map(worker_pid, range(ncpus)) # Start the workers before timing
+        t0 = time.time()
+        if mode == 'sims':
+            sims = []
+            for seed in range(n_seeds):
+                sim = s0.copy()
+                sim['rand_seed'] = seed
+                sim.set_seed()
+                sims.append(sim)
+            output = pool.map(run_copy, [(t0, sim) for sim in sims], chunksize=1)
+        else:
+            output = pool.map(run_seed, [(t0, seed) for seed in range(n_seeds)], chunksize=1)
+        wall = time.time() - t0
+    latency = np.array([o[0] for o in output])
+    workers = {}
+    for _,pid,mem in output:
+        workers[pid] = max(workers.get(pid, 0), mem)
+    return dict(mode=mode, n_seeds=n_seeds, parent_rss=peak_rss(), worker_pss=sum(workers.values()),
+                first=latency.min(), median=np.median(latency), p95=np.percentile(latency, 95), wall=wall)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('n_seeds', type=int, nargs='?', default=500)
+    parser.add_argument('ncpus', type=int, nargs='?', default=mp.cpu_count())
+    parser.add_argument('--mode', choices=modes, help='run a single mode in this process and print its statistics as JSON')
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(bench(args.mode, args.n_seeds, args.ncpus)))
+    else:
+        vm.make_sim(seed=1, beta=0.0135) # Make sure the on-disk population cache exists, as it would after the first run
+        print(f'{args.n_seeds} seeds on {args.ncpus} workers')
+        print(f'{"Mode":8s} {"parent peak RSS (MB)":>21s} {"worker PSS (MB)":>16s} {"first ready (s)":>16s} {"median (s)":>11s} {"95th pct (s)":>13s} {"batch (s)":>10s}')
+        for mode in modes:
+            out = subprocess.run([sys.executable, thisfile, str(args.n_seeds), str(args.ncpus), '--mode', mode], capture_output=True, text=True, check=True)
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f'{mode:8s} {r["parent_rss"]:21.0f} {r["worker_pss"]:16.0f} {r["first"]:16.2f} {r["median"]:11.2f} {r["p95"]:13.2f} {r["wall"]:10.1f}')
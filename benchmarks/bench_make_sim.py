@@ -0,0 +1,53 @@
+'''
+Microbenchmark of make_sim() setup latency. Also times the work that the
+shared calendar removed from every call -- building a throwaway sim to parse
+vietnam_data.csv and convert dates, then parsing the file again for the real
+sim -- so the saving per call can be compared with the remaining latency.
+
+Run from the repository root:
+
+    python benchmarks/bench_make_sim.py [repeats]
+'''
+
+import os
+import sys
+import numpy as np
+import sciris as sc
+import covasim as cv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vietnam_model as vm
+from vietnam_calendar import Calendar
+
+repeats = int(sys.argv[1]) if len(sys.argv)>1 else 20
+
+
+def timeit(func):
+    ''' Time repeated calls, returning the mean and standard deviation in ms '''
+    times = []
+    for r in range(repeats):
+        T = sc.tic()
+        func()
+        times.append(sc.toc(T, output=True)*1e3)
+    return np.mean(times), np.std(times)
+
+
+def old_setup():
+    ''' What each make_sim() call used to do just to get the data and sim days '''
+    sim = cv.Sim(start_day='2020-06-15', datafile='vietnam_data.csv')
+    sim.data['new_tests'].rolling(3).mean()
+    sim.day('2020-07-15', '2020-08-22', '2020-08-23', '2020-08-31', '2020-11-30', '2020-12-01', '2020-12-31', '2021-04-30')
+    cv.load_data('vietnam_data.csv', verbose=False) # The second parse, when the real sim was created
+
+
+vm.make_sim(seed=1, beta=0.0135) # Warm up the population cache so only the setup is timed
+
+results = sc.objdict()
+results['Old per-call data/calendar setup'] = timeit(old_setup)
+results['Calendar construction (once per process)'] = timeit(Calendar)
+results['make_sim(), mainscens settings'] = timeit(lambda: vm.make_sim(seed=1, beta=0.0135, policy='dynamic'))
+results['make_sim(), fitting settings'] = timeit(lambda: vm.make_sim(seed=1, beta=0.0135, end_day='2020-10-15'))
+
+for label,(mean,std) in results.items():
+    print(f'{label:42s} {mean:8.1f} ± {std:5.1f} ms')
@@ -0,0 +1,63 @@
+'''
+Benchmark how much of each batch's wall time goes on building sims (mostly
+population generation), with and without the base sim cache in vietnam_model.
+
+Run from the repository root:
+
+    python benchmarks/bench_population_cache.py [n_seeds]
+
+where n_seeds is the number of seeds run per built sim (default 20). Runs are
+timed on a couple of seeds per batch and extrapolated.
+'''
+
+import os
+import sys
+import sciris as sc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The model reads vietnam_data.csv from the root folder
+import vietnam_model as vm
+
+n_seeds = int(sys.argv[1]) if len(sys.argv)>1 else 20
+n_timed = 2 # Seeds actually run per batch to estimate the run time
+today = '2020-10-15'
+betas = [i / 10000 for i in range(130, 140, 1)]
+symp_probs = [0.01048074, 0.02206723, 0.0350389 , 0.04979978, 0.06696701]
+
+# The make_sim() calls made by each stage of run_vietnam_central.py
+batches = sc.objdict()
+batches.fitting      = [dict(beta=beta, end_day=today) for beta in betas]
+batches.mainscens    = [dict(beta=beta, policy=policy) for policy in ['remain','drop','dynamic'] for beta in betas]
+batches.testingscens = [dict(beta=beta, policy='dynamic', symp_prob=sp) for sp in symp_probs for beta in betas]
+
+
+def time_builds(calls, use_cache):
+    ''' Time every make_sim() call in a batch, starting from an empty in-memory cache as a new process would '''
+    vm._base_sims.clear()
+    T = sc.tic()
+    for kwargs in calls:
+        sim = vm.make_sim(seed=1, use_cache=use_cache, **kwargs)
+    return sc.toc(T, output=True), sim
+
+
+def time_runs(sim):
+    ''' Time a few seeds of one sim, to extrapolate the run time of the batch '''
+    T = sc.tic()
+    for seed in range(n_timed):
+        s = sim.copy()
+        s['rand_seed'] = seed
+        s.set_seed()
+        s.run()
+    return sc.toc(T, output=True)/n_timed
+
+
+vm.make_sim(seed=1, beta=betas[0]) # Make sure the on-disk cache exists, as it would after the first run
+
+print(f'{"Batch":14s} {"builds":>6s} {"uncached (s)":>13s} {"cached (s)":>11s} {"runs (s)":>9s} {"share before":>13s} {"share after":>12s}')
+for name,calls in batches.items():
+    t_cold, sim = time_builds(calls, use_cache=False)
+    t_warm, sim = time_builds(calls, use_cache=True)
+    t_runs = time_runs(sim)*n_seeds*len(calls)
+    before = t_cold/(t_cold + t_runs)
+    after  = t_warm/(t_warm + t_runs)
+    print(f'{name:14s} {len(calls):6d} {t_cold:13.1f} {t_warm:11.1f} {t_runs:9.1f} {before*100:12.1f}% {after*100:11.1f}%')
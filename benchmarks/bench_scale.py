@@ -0,0 +1,70 @@
+'''
+Benchmark of step time and memory at 100k agents (the default), 1M agents, and
+the full population of central Vietnam (11.9M agents, no rescaling), with the
+estimate from memory.py alongside the measured peak RSS. Sizes whose estimate
+is over the memory budget are skipped rather than run.
+
+Run from the repository root:
+
+    python benchmarks/bench_scale.py [n_steps] [budget_gb]
+
+Each size runs in its own process, so that its peak RSS is its own. The first
+run at each size also builds its population and writes it to results/cache,
+which is timed separately.
+'''
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import numpy as np
+
+thisfile = os.path.abspath(__file__)
+sys.path.insert(0, os.path.join(os.path.dirname(thisfile), '..'))
+os.chdir(os.path.join(os.path.dirname(thisfile), '..')) # The model reads vietnam_data.csv from the root folder
+import vietnam_model as vm
+import memory
+
+sizes = [100e3, 1e6, vm.total_pop]
+
+
+def bench(n_agents, n_steps):
+    ''' Build a sim with n_agents and time its steps, in this process '''
+    T = time.time()
+    sim = vm.make_sim(seed=1, beta=0.0135, n_agents=n_agents)
+    t_build = time.time() - T
+    sim = vm.copy_sim(sim)
+    times = []
+    for t in range(n_steps):
+        T = time.time()
+        sim.step()
+        times.append(time.time() - T)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1e3 # In kB on Linux
+    return dict(n_agents=n_agents, build=t_build, step=np.mean(times), step_max=np.max(times), rss=rss)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('n_steps', type=int, nargs='?', default=60)
+    parser.add_argument('budget_gb', type=float, nargs='?', default=None, help='memory budget in GB (default: 80%% of physical memory)')
+    parser.add_argument('--agents', type=float, help='run a single size in this process and print its statistics as JSON')
+    args = parser.parse_args()
+
+    if args.agents:
+        print(json.dumps(bench(args.agents, args.n_steps)))
+    else:
+        budget = args.budget_gb*1e9 if args.budget_gb else memory.budget_share*memory.physical_memory()
+        print(f'{args.n_steps} steps per size; budget {budget/1e9:0.1f} GB')
+        print(f'{"Agents":>12s} {"build (s)":>10s} {"step (s)":>9s} {"slowest (s)":>12s} {"s/step/M agents":>16s} {"peak RSS (GB)":>14s} {"estimate (GB)":>14s}')
+        for n_agents in sizes:
+            est = memory.estimate(n_agents, 1, shared=False) # Nothing is shared in a single process, so everything is copied
+            need = est.total if memory.population_cached(n_agents) else max(est.build, est.total)
+            if need > budget:
+                print(f'{n_agents:12.0f} skipped: needs about {need/1e9:0.1f} GB')
+                continue
+            out = subprocess.run([sys.executable, thisfile, str(args.n_steps), '--agents', str(n_agents)], capture_output=True, text=True, check=True)
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f'{n_agents:12.0f} {r["build"]:10.1f} {r["step"]:9.3f} {r["step_max"]:12.3f} {r["step"]/n_agents*1e6:16.3f} {r["rss"]/1e9:14.2f} {need/1e9:14.2f}')
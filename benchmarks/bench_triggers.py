@@ -0,0 +1,66 @@
+'''
+Benchmark of the triggers on daily diagnoses over full-horizon runs, with each
+trigger counting diagnoses itself (cv.trigger) and with all of them reading
+one running count per sim (vietnam_interventions.shared_trigger). Gives the
+time spent evaluating triggers (from the profiler) and per run, and checks
+that every run's results are identical both ways, i.e. that the interventions
+fired on the same days.
+
+Run from the repository root:
+
+    python benchmarks/bench_triggers.py [n_seeds]
+'''
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # The model reads vietnam_data.csv from the root folder
+import vietnam_model as vm
+import resultstore as rs
+import profiling
+
+n_seeds = int(sys.argv[1]) if len(sys.argv)>1 else 5
+policies = ['remain', 'drop', 'dynamic']
+beta = 0.0135
+
+
+def bench(policy, shared):
+    ''' Run every seed under one policy, returning the results, run times, trigger time, and whether the shared counter was used '''
+    vm.shared_triggers = shared
+    s0 = vm.make_sim(seed=1, beta=beta, policy=policy)
+    n_triggers = sum(getattr(intervention, 'trigger', None) is not None for intervention in s0['interventions'])
+    results = []
+    times = []
+    report = profiling.Report()
+    counted = True
+    for seed in range(n_seeds):
+        sim = vm.copy_sim(s0)
+        sim['rand_seed'] = seed
+        sim.set_seed()
+        profiling.enable()
+        T = time.time()
+        vm.run_sim(sim)
+        times.append(time.time() - T)
+        report.add(profiling.take())
+        results.append(rs.get_results(sim))
+        counted = counted and hasattr(sim, '_diagnosis_counter')
+    times_by_row, _, kinds = report.rows()
+    trigger_time = sum(t.sum() for name,t in times_by_row.items() if kinds[name] == 'trigger')/n_seeds
+    return dict(results=results, run=np.mean(times), trigger=trigger_time, n_triggers=n_triggers, counted=counted)
+
+
+vm.make_sim(seed=1, beta=beta) # Make sure the on-disk population cache exists
+print(f'{n_seeds} seeds per policy; times are per run')
+print(f'{"Policy":8s} {"triggers":>9s} {"trigger time (ms)":>18s} {"shared (ms)":>12s} {"speedup":>8s} {"run (s)":>8s} {"shared (s)":>11s}  results')
+for policy in policies:
+    own = bench(policy, shared=False)
+    shared = bench(policy, shared=True)
+    same = all(np.array_equal(a[key], b[key]) for a,b in zip(own['results'], shared['results']) for key in a)
+    speedup = own['trigger']/shared['trigger'] if shared['trigger'] else np.nan
+    status = 'identical' if same else 'DIFFER'
+    if not shared['counted']:
+        status += ' (the shared count was never read: cv.trigger is evaluated through a method shared_trigger does not override; see vietnam_model.check_shared_triggers())'
+    print(f'{policy:8s} {own["n_triggers"]:9d} {own["trigger"]*1e3:18.2f} {shared["trigger"]*1e3:12.2f} {speedup:8.1f} {own["run"]:8.2f} {shared["run"]:11.2f}  {status}')
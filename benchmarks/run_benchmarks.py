@@ -0,0 +1,246 @@
+'''
+Benchmark suite for the Vietnam workflow, compared against a stored baseline.
+Each case is timed on a few seeds in its own process, so that its peak RSS is
+its own:
+
+    make_sim          building a sim from the cached population, with the fitting settings
+    run_today         running a sim to the end of the calibration window (today)
+    run_<policy>      running a sim to 2021-04-30 under each border policy
+    transtree         the transmission statistics computed by finialisecalibration
+    plot_<figure>     loading and reducing the result stores used by each plot_vietnam_*.py script
+
+The plot cases read the stores in results/ written by run_vietnam_central.py,
+with an empty summary cache, and are skipped if the stores don't exist yet.
+
+Run from the repository root:
+
+    python benchmarks/run_benchmarks.py [--seeds N] [--tolerance 0.2] [--update] [cases ...]
+
+Each run compares against the baseline file (benchmarks/baseline.json by
+default) and flags any case whose median time or peak RSS is more than the
+tolerance above the baseline, exiting with status 1 if any are. No baseline is
+committed, since baselines are only comparable on the same machine and with the
+same number of seeds: without one, the script stops with an error before
+running anything. Use --update to write the baseline (or replace the numbers of
+the cases run), e.g. on a new machine or after an intended change; it records
+the machine and the number of seeds along with the numbers.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import argparse
+import importlib.metadata
+import tempfile
+import subprocess
+import numpy as np
+
+thisfile = os.path.abspath(__file__)
+rootdir = os.path.join(os.path.dirname(thisfile), '..')
+sys.path.insert(0, rootdir)
+os.chdir(rootdir) # The model reads vietnam_data.csv from the root folder
+
+default_baseline = os.path.join('benchmarks', 'baseline.json')
+today = '2020-10-15'
+beta = 0.0135
+change = 0.42
+policies = ['remain', 'drop', 'dynamic']
+figures = dict(
+    calibration = ['results/vietnam_sim'],
+    scenarios   = [f'results/vietnam_sim_{policy}' for policy in policies],
+    multiscens  = [f'results/vietnam_sim_{t}' for t in range(10, 60, 10)],
+)
+
+
+def peak_rss():
+    ''' Peak resident memory of this process in MB '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3 # In kB on Linux
+
+
+def seeded_sims(n_seeds, **kwargs):
+    ''' Copies of one sim with different seeds, as the sweep workers make them '''
+    import vietnam_model as vm
+    s0 = vm.make_sim(seed=1, beta=beta, change=change, **kwargs)
+    for seed in range(n_seeds):
+        sim = vm.copy_sim(s0)
+        sim['rand_seed'] = seed
+        sim.set_seed()
+        yield sim
+
+
+def timed_runs(n_seeds, run, **kwargs):
+    times = []
+    for sim in seeded_sims(n_seeds, **kwargs):
+        T = time.time()
+        run(sim)
+        times.append(time.time() - T)
+    return times
+
+
+def bench_make_sim(n_seeds):
+    import vietnam_model as vm
+    vm.make_sim(seed=1, beta=beta, end_day=today) # Load the population cache so only the build is timed
+    times = []
+    for seed in range(n_seeds):
+        T = time.time()
+        vm.make_sim(seed=1, beta=beta, change=change, end_day=today)
+        times.append(time.time() - T)
+    return times
+
+
+def bench_run_today(n_seeds):
+    return timed_runs(n_seeds, lambda sim: sim.run(), end_day=today)
+
+
+def bench_run_policy(policy):
+    def bench(n_seeds):
+        import vietnam_model as vm
+        return timed_runs(n_seeds, vm.run_sim, policy=policy)
+    return bench
+
+
+def bench_transtree(n_seeds):
+    import calibration as cal
+    times = []
+    for sim in seeded_sims(n_seeds, end_day=today):
+        sim.run()
+        T = time.time()
+        cal.transmission_stats(sim.people, sim.rescale_vec)
+        times.append(time.time() - T)
+    return times
+
+
+def cuminf_after_borders(res):
+    ''' As in plot_vietnam_multiscens.py '''
+    import metrics
+    from vietnam_calendar import calendar as cal
+    return metrics.cum_diff(res['cum_infections'], cal.day('2020-12-01'))
+
+
+def bench_plot(figure):
+    def bench(n_seeds):
+        import summaries
+        folders = figures[figure]
+        missing = [folder for folder in folders if not os.path.exists(folder)]
+        if missing:
+            return None
+        scalars = dict(cuminf=cuminf_after_borders) if figure == 'multiscens' else None
+        times = []
+        for r in range(n_seeds):
+            summaries.cachefolder = tempfile.mkdtemp() # Start from an empty cache, so the stores are read and reduced every time
+            summaries._summaries.clear()
+            T = time.time()
+            for folder in folders:
+                summaries.summarize(folder, scalars=scalars)
+            times.append(time.time() - T)
+            shutil.rmtree(summaries.cachefolder)
+        return times
+    return bench
+
+
+cases = dict(make_sim=bench_make_sim, run_today=bench_run_today)
+cases.update({f'run_{policy}':bench_run_policy(policy) for policy in policies})
+cases['transtree'] = bench_transtree
+cases.update({f'plot_{figure}':bench_plot(figure) for figure in figures})
+
+
+def run_case(name, n_seeds):
+    ''' Run one case in a new process and return its statistics, or None if it was skipped '''
+    out = subprocess.run([sys.executable, thisfile, '--case', name, '--seeds', str(n_seeds)], capture_output=True, text=True)
+    if out.returncode:
+        print(out.stdout + out.stderr)
+        raise RuntimeError(f'Benchmark {name} failed')
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def machine():
+    ''' What the numbers depend on besides the code '''
+    try:
+        covasim = importlib.metadata.version('covasim')
+    except importlib.metadata.PackageNotFoundError: # e.g. run from a source checkout
+        covasim = None
+    return dict(host=platform.node(), cpus=os.cpu_count(), python=platform.python_version(), covasim=covasim)
+
+
+def compare(current, baseline, tolerance):
+    ''' Print each case against the baseline and return the names of those that regressed '''
+    regressions = []
+    print(f'{"Case":18s} {"median (s)":>11s} {"baseline":>9s} {"ratio":>6s} {"peak RSS (MB)":>14s} {"baseline":>9s} {"ratio":>6s}  status')
+    for name,r in current.items():
+        if r is None:
+            print(f'{name:18s} skipped: result stores not found')
+            continue
+        b = baseline.get(name)
+        if b is None:
+            print(f'{name:18s} {r["median"]:11.3f} {"":>9s} {"":>6s} {r["rss"]:14.0f} {"":>9s} {"":>6s}  no baseline')
+            continue
+        t_ratio = r['median']/b['median'] if b['median'] else np.nan
+        m_ratio = r['rss']/b['rss'] if b['rss'] else np.nan
+        slower = t_ratio > 1 + tolerance
+        bigger = m_ratio > 1 + tolerance
+        status = ', '.join([s for s,flag in [('SLOWER', slower), ('MORE MEMORY', bigger)] if flag]) or 'ok'
+        if slower or bigger:
+            regressions.append(name)
+        print(f'{name:18s} {r["median"]:11.3f} {b["median"]:9.3f} {t_ratio:6.2f} {r["rss"]:14.0f} {b["rss"]:9.0f} {m_ratio:6.2f}  {status}')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the steps of the Vietnam workflow and compare them with a stored baseline')
+    parser.add_argument('names', nargs='*', metavar='case', help=f'cases to run (default: all of {list(cases)})')
+    parser.add_argument('--seeds', type=int, default=3, help='seeds (or repeats) timed per case (default: 3)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='flag cases more than this fraction slower or bigger than the baseline (default: 0.2)')
+    parser.add_argument('--baseline', default=default_baseline, help=f'baseline file (default: {default_baseline})')
+    parser.add_argument('--update', action='store_true', help='replace the baseline with these numbers')
+    parser.add_argument('--case', help=argparse.SUPPRESS) # Run a single case in this process and print its statistics as JSON
+    args = parser.parse_args()
+
+    if args.case:
+        times = cases[args.case](args.seeds)
+        stats = None if times is None else dict(median=float(np.median(times)), min=float(np.min(times)), max=float(np.max(times)), rss=peak_rss())
+        print(json.dumps(stats))
+        sys.exit()
+
+    unknown = [name for name in args.names if name not in cases]
+    if unknown:
+        parser.error(f'unknown case(s) {unknown}; choices are {list(cases)}')
+    names = args.names if args.names else list(cases)
+    if not args.update and not os.path.exists(args.baseline):
+        parser.error(f'no baseline in {args.baseline}; run with --update to make one on this machine first')
+
+    if any(not name.startswith('plot_') for name in names):
+        import vietnam_model as vm
+        vm.make_sim(seed=1, beta=beta, end_day=today) # Make sure the on-disk population cache exists, as it would after the first run
+    print(f'{len(names)} cases, {args.seeds} seeds each')
+    current = {}
+    for name in names:
+        current[name] = run_case(name, args.seeds)
+
+    stored = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+    if stored is not None:
+        if stored['seeds'] != args.seeds:
+            print(f'Warning: the baseline was made with {stored["seeds"]} seeds, so the times may not be comparable')
+        if stored['machine']['host'] != platform.node():
+            print(f'Warning: the baseline was made on {stored["machine"]["host"]}, so the numbers may not be comparable')
+    baseline = stored['cases'] if stored is not None else {}
+    regressions = compare(current, baseline, args.tolerance)
+
+    new = [name for name,r in current.items() if r is not None and name not in baseline]
+    if args.update:
+        merged = dict(baseline)
+        merged.update({name:r for name,r in current.items() if r is not None})
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(machine=machine(), seeds=args.seeds, cases=merged), f, indent=2)
+        print(f'Baseline {"updated" if stored is not None else "written"} to {args.baseline}')
+    elif new:
+        print(f'No baseline for {", ".join(new)}; run with --update to add them')
+    if regressions and not args.update:
+        print(f'{len(regressions)} case(s) regressed by more than {args.tolerance*100:0.0f}%: {", ".join(regressions)}')
+        sys.exit(1)
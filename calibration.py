@@ -0,0 +1,366 @@
+'''
+Worker functions for the beta/seed calibration sweep, for use with sweep.run_sweep().
+The accepted runs can also be saved as they stood at the end of the calibration
+window, so that when the data file is extended they can be resumed and scored
+against the new days, rather than run again from the start (see warm_fit()).
+'''
+
+import os
+import json
+import numpy as np
+import sciris as sc
+import covasim as cv
+import vietnam_model as vm
+from vietnam_model import shared_sim, copy_sim
+from vietnam_calendar import calendar
+from sweep import run_sweep
+import sharedpeople
+import resultstore as rs
+import runcache
+
+
+class MismatchTracker:
+    '''
+    Running version of the mismatch computed by sim.compute_fit(), for use as
+    the sim's stopping_func. Each day it adds the loss for the data points that
+    have just been simulated; since every point adds a non-negative amount, the
+    sim can be stopped as soon as the running total reaches the cutoff, because
+    its final mismatch could never get back under it.
+
+    Uses the same defaults as cv.Fit: cumulative keys present in both the sim
+    and the data, weights of 5 for diagnoses and 10 for deaths, and absolute
+    errors normalized by the largest data value.
+
+    Args:
+        cutoff (float): stop the sim once the running mismatch reaches this value
+        weights (dict): override the default weights
+    '''
+
+    def __init__(self, cutoff, weights=None):
+        self.cutoff = cutoff
+        self.weights = sc.mergedicts({'cum_deaths':10, 'cum_diagnoses':5}, weights)
+        self.initialized = False
+        return
+
+
+    def initialize(self, sim):
+        ''' Line the data up with the sim days and precompute the weight of each point '''
+        self.t = 0 # The next day to be added to the running totals
+        self.mismatch = 0.0
+        self.keys = [key for key in sim.result_keys() if key.startswith('cum_') and key in sim.data.columns]
+        self.data = {}
+        self.scale = {}
+        self.cum = {}
+        for key in self.keys:
+            data = np.full(sim.npts, np.nan)
+            for date,datum in sim.data[key].items():
+                day = sim.day(date)
+                if np.isfinite(datum) and 0 <= day < sim.npts:
+                    data[day] = datum
+            actual_max = np.nanmax(np.abs(data)) if np.isfinite(data).any() else 0
+            self.data[key] = data
+            self.scale[key] = self.weights.get(key, 1.0)/(actual_max if actual_max>0 else 1.0)
+            self.cum[key] = 0.0
+        self.initialized = True
+        return
+
+
+    def update(self, sim):
+        ''' Add the losses for all days that have finished since the last call '''
+        if not self.initialized:
+            self.initialize(sim)
+        for t in range(self.t, sim.t):
+            for key in self.keys:
+                self.cum[key] += sim.results[key.replace('cum_', 'new_')].values[t]*sim.rescale_vec[t] # Results are only rescaled when the sim is finalized
+                if np.isfinite(self.data[key][t]):
+                    self.mismatch += self.scale[key]*abs(self.data[key][t] - self.cum[key])
+        self.t = sim.t
+        return self.mismatch
+
+
+    def __call__(self, sim):
+        ''' Called by the sim before each step: returning True stops the run '''
+        return self.update(sim) >= self.cutoff
+
+
+def fit_run(job):
+    '''
+    Run a single (beta, seed) pair to the end of the calibration window and
+    compute its mismatch against the data.
+
+    Args:
+        job (dict): must contain beta, seed, change, and end_day, and may give n_agents and resume_dates; if it also has a cutoff, stop the run early once its mismatch can no longer get under it; unless cache=False, completed runs are saved to the run cache; with a states folder, the state of the run before its last day is saved there if its mismatch is below state_cutoff; with resume, the run carries on from the state in that file instead of starting from day 0
+
+    Returns:
+        dict with the mismatch; runs stopped early get a mismatch of inf, plus the partial mismatch and the day they were stopped; resumed runs also give the day they resumed from
+    '''
+    sim_kwargs = dict(beta=job['beta'], change=job['change'], end_day=job['end_day'])
+    if 'n_agents' in job:
+        sim_kwargs['n_agents'] = job['n_agents']
+    if job.get('resume_dates'):
+        sim_kwargs['resume_dates'] = tuple(job['resume_dates'])
+    s0 = shared_sim(seed=1, **sim_kwargs)
+    if job.get('resume'):
+        sim = vm.extend_sim(load_state(job['resume'], s0), s0)
+        resumed = int(sim.t)
+    else:
+        sim = copy_sim(s0)
+        sim['rand_seed'] = job['seed']
+        sim.set_seed()
+        resumed = None
+    cutoff = job.get('cutoff')
+    if cutoff is not None:
+        sim['stopping_func'] = MismatchTracker(cutoff)
+    cache = job.get('cache', True)
+    if cache: # So that later stages can reuse the run
+        sim['analyzers'] = [asymp_stats()]
+        sim.init_analyzers()
+    state = None
+    if job.get('states'):
+        vm.run_sim(sim, until=sim.npts-1)
+        if sim.t == sim.npts-1: # Not stopped early; the last day is stepped again when resumed, so the interventions haven't cleaned up yet
+            state = copy_sim(sim)
+    vm.run_sim(sim)
+    if not sim.complete: # Stopped early: record as rejected
+        return dict(mismatch=np.inf, partial=float(sim['stopping_func'].mismatch), stopped=int(sim.t))
+    if cache:
+        stats = sim.get_analyzer('asymp_stats').stats
+        key = runcache.default_cache.key(sim_kwargs, job['seed'])
+        runcache.default_cache.put(key, rs.get_results(sim), prop_asymp=stats.prop_asymp, prop_asymp_asymp=stats.prop_asymp_asymp)
+    mismatch = float(sim.compute_fit().mismatch)
+    if state is not None and mismatch < job['state_cutoff']:
+        save_state(state, s0, state_file(job['states'], job['beta'], job['seed']))
+    output = dict(mismatch=mismatch)
+    if resumed is not None:
+        output['resumed'] = resumed
+    return output
+
+
+def fit_jobs(betas, n_runs, change, end_day, cutoff=None, **kwargs):
+    ''' The full (beta, seed) grid as a flat list of jobs; kwargs are added to every job '''
+    return [dict(beta=beta, seed=seed, change=change, end_day=end_day, cutoff=cutoff, **kwargs) for beta in betas for seed in range(n_runs)]
+
+
+def make_fitsummary(records, betas, n_runs, key='mismatch'):
+    ''' Rebuild the fitsummary layout -- one list of mismatches per beta, indexed by seed -- from sweep records '''
+    fitsummary = []
+    for beta in betas:
+        fitsummary.append([records[(beta, seed)][key] for seed in range(n_runs)])
+    return fitsummary
+
+
+def state_file(folder, beta, seed):
+    ''' Where the state of a (beta, seed) run is saved '''
+    return os.path.join(folder, f'beta{beta}_seed{seed}.sim')
+
+
+def save_state(sim, base, filename):
+    ''' Save a sim partway through its run, without the parts of the population it shares with base, the sim it was copied from '''
+    sim['stopping_func'] = None
+    sharedpeople.strip(sim, base)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmpfile = f'{filename}.{os.getpid()}.tmp'
+    cv.save(tmpfile, sim)
+    os.replace(tmpfile, filename)
+    return filename
+
+
+def load_state(filename, base):
+    ''' Load a sim saved by save_state(), filling in the population from base '''
+    return sharedpeople.fill(cv.load(filename), base)
+
+
+def states_info(end_day, change, n_agents=None, resume_dates=()):
+    ''' What the states saved at the end of a calibration window depend on, besides the model code '''
+    return dict(end_day=calendar.date(calendar.day(end_day)), change=change, n_agents=n_agents, resume_dates=list(resume_dates), data=calendar.data_hash(end_day), covasim=cv.__version__)
+
+
+def write_states_meta(folder, fitsummary, betas, cutoff, end_day, change, n_agents=None, resume_dates=()):
+    '''
+    Record which runs have a saved state in the folder -- the accepted runs of
+    this fitsummary -- along with the number of seeds of each beta and the
+    number of runs in the fit, and what the states depend on.
+    '''
+    runs = [[beta, seed] for bn,beta in enumerate(betas) for seed,mismatch in enumerate(fitsummary[bn]) if mismatch < cutoff and os.path.exists(state_file(folder, beta, seed))]
+    n_run = sum(not np.isnan(mismatch) for mismatches in fitsummary for mismatch in mismatches)
+    meta = dict(states_info(end_day, change, n_agents, resume_dates), runs=runs, betas=list(betas), n_seeds=[len(mismatches) for mismatches in fitsummary], n_run=n_run)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def read_states_meta(folder, end_day, change, n_agents=None, resume_dates=()):
+    ''' Read the metadata written by write_states_meta(), checking that the states can be resumed with the current settings and data; resume_dates are those of the new fit '''
+    filename = os.path.join(folder, 'meta.json')
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f'No saved states in {folder}: run the fitting for the window ending on {end_day} with save_states = True first')
+    with open(filename) as f:
+        meta = json.load(f)
+    expected = states_info(end_day, change, n_agents, resume_dates[:-1]) # The window they were saved in ended on the last of them
+    for key,value in expected.items():
+        if meta.get(key) != value:
+            if key == 'data':
+                errormsg = f'The data up to {end_day} have changed since the states in {folder} were saved, so the runs have to be refitted from the start'
+            else:
+                errormsg = f'The states in {folder} were saved with {key}={meta.get(key)}, not {value}'
+            raise ValueError(errormsg)
+    return meta
+
+
+def warm_fit(betas, previous, change, end_day, cutoff, min_accepted, resume_dates, checkpoint=None, states=None, ncpus=None, early_stop=True, n_agents=None, label='Warm fitting'):
+    '''
+    Refit after the data file has been extended, starting from the accepted
+    runs of the previous calibration window. Each is resumed from the state it
+    was saved in at the end of that window, so only the new days are
+    simulated, and scored against the extended data. If fewer than
+    min_accepted of them are still accepted, the fit is topped up with fresh
+    seeds, run from day 0, until enough are (or until each beta has run as
+    many fresh seeds as the largest number of seeds run of any beta in the
+    previous window). The last of the
+    resume_dates must be the end of the previous window, so that every run is
+    reseeded there and the resumed runs match runs from day 0.
+
+    The workers need to be able to read the saved states, so remote workers
+    (see distributed.py) need a shared file system.
+
+    Args:
+        betas (list): the betas to fit
+        previous (str): the folder of states saved at the end of the previous window
+        change (float): the value of change
+        end_day (str): the end of the new calibration window
+        cutoff (float): runs with a mismatch below this are accepted
+        min_accepted (int): the number of accepted runs below which fresh seeds are added
+        resume_dates (list): the ends of the earlier calibration windows, on which every run is reseeded (see vm.make_sim())
+        checkpoint (Checkpoint): a checkpoint with keys beta and seed; finished runs in it are not rerun
+        states (str): if given, save the states of the accepted runs at the end of this window to this folder, for the next
+        ncpus (int): number of worker processes
+        early_stop (bool): stop runs once they can no longer be accepted
+        n_agents (float): number of agents, if not the make_sim() default
+
+    Returns:
+        fitsummary: one list of mismatches per beta indexed by seed, as from make_fitsummary(), with nan for the seeds not run in this window
+    '''
+    if not resume_dates:
+        raise ValueError('Add the end of the previous calibration window to resume_dates first')
+    prev_end = resume_dates[-1]
+    meta = read_states_meta(previous, prev_end, change, n_agents, resume_dates)
+    job_kwargs = dict(change=change, end_day=end_day, cutoff=cutoff if early_stop else None, states=states, state_cutoff=cutoff, resume_dates=tuple(resume_dates))
+    if n_agents is not None:
+        job_kwargs['n_agents'] = n_agents
+    jobs = [dict(beta=beta, seed=seed, resume=state_file(previous, beta, seed), **job_kwargs) for beta,seed in meta['runs'] if beta in betas and os.path.exists(state_file(previous, beta, seed))]
+    records = list(run_sweep(fit_run, jobs, checkpoint=checkpoint, ncpus=ncpus, label=f'{label} (resumed)').values())
+    accepted = sum(r['mismatch'] < cutoff for r in records)
+    print(f'{label}: {accepted} of {len(records)} resumed runs are still accepted')
+
+    # Top up with fresh seeds, in rounds sized by the acceptance rate so far
+    prev_seeds = dict(zip(meta['betas'], meta['n_seeds'])) # Seeds of each beta in the previous window
+    n_seeds = {beta:prev_seeds.get(beta, 0) for beta in betas}
+    max_seeds = {beta:n + max(meta['n_seeds']) for beta,n in n_seeds.items()}
+    n_run = meta['n_run'] # Runs that could have been accepted had they been rerun: all those in the previous window
+    n_fresh = 0
+    while accepted < min_accepted:
+        rate = max(accepted, 1)/(n_run + n_fresh)
+        per_beta = int(np.ceil((min_accepted - accepted)/rate/len(betas)))
+        jobs = []
+        for beta in betas:
+            seeds = range(n_seeds[beta], min(n_seeds[beta] + per_beta, max_seeds[beta]))
+            jobs += [dict(beta=beta, seed=seed, **job_kwargs) for seed in seeds]
+            n_seeds[beta] = seeds.stop
+        if not jobs:
+            print(f'{label}: every fresh seed has been run; stopping with {accepted} of {min_accepted} accepted')
+            break
+        fresh = list(run_sweep(fit_run, jobs, checkpoint=checkpoint, ncpus=ncpus, label=f'{label} (fresh seeds)').values())
+        records += fresh
+        n_fresh += len(fresh)
+        accepted = sum(r['mismatch'] < cutoff for r in records)
+        print(f'{label}: {accepted}/{min_accepted} accepted after {n_fresh} fresh runs')
+
+    # Compare the days simulated with a full sweep over the new window
+    n_days = calendar.day(end_day) + 1
+    days_run = sum(r.get('stopped', n_days) - r.get('resumed', 0) for r in records)
+    print(f'{label}: simulated {days_run:,} days, {days_run/(n_run*n_days)*100:0.1f}% of the {n_run*n_days:,} in a full sweep of {n_run} runs without early stopping')
+
+    fitsummary = [[np.nan]*n_seeds[beta] for beta in betas]
+    for r in records:
+        fitsummary[betas.index(r['beta'])][r['seed']] = r['mismatch']
+    return fitsummary
+
+
+def transmission_stats(people, rescale_vec, start_day=40):
+    '''
+    Asymptomatic share of undiagnosed onward infections, computed with array
+    operations over the infection log. Gives the same numbers as looping over
+    sim.make_transtree(): each transmission is described by its target's most
+    recent infection, and only counts if that infection had a source who was
+    infected on or after start_day (and no later than the target), and if the
+    target was never diagnosed. Counts are weighted by the rescaling factor on
+    the day of infection.
+
+    Args:
+        people (People): the people at the end of the run
+        rescale_vec (arr): the sim's rescaling factor per day
+        start_day (int): only count infections whose source was infected on or after this day
+
+    Returns:
+        objdict with prop_asymp, prop_asymp_asymp, and symp_counts (weighted counts by days between symptom onset and infection)
+    '''
+    log = people.infection_log
+    source = np.array([-1 if entry['source'] is None else entry['source'] for entry in log], dtype=np.int64)
+    target = np.array([entry['target'] for entry in log], dtype=np.int64)
+    date   = np.array([entry['date'] for entry in log], dtype=np.int64)
+
+    # Each person's most recent infection, as stored in the detailed transmission tree
+    last = np.full(len(people), -1, dtype=np.int64)
+    np.maximum.at(last, target, np.arange(len(log)))
+
+    # Look up every transmission's details via its target's latest infection
+    entry = last[target[source>=0]]
+    entry = entry[source[entry]>=0] # Skip targets whose latest infection had no source
+    tgt   = target[entry]
+    src   = source[entry]
+    tdate = date[entry]
+    sdate = date[last[src]]
+
+    # Undiagnosed infections from sources infected after the start day
+    keep  = (sdate <= tdate) & (sdate >= start_day) & np.isnan(people.date_diagnosed[tgt])
+    tgt, src, tdate = tgt[keep], src[keep], tdate[keep]
+    delta = rescale_vec[tdate]
+    t_symp = people.date_symptomatic[tgt]
+    asymp  = np.isnan(t_symp)
+
+    # Tally them up
+    asymp_count = delta[asymp].sum()
+    offsets = (tdate[~asymp] - t_symp[~asymp]).astype(int)
+    days, inds = np.unique(offsets, return_inverse=True)
+    counts = np.bincount(inds, weights=delta[~asymp], minlength=len(days))
+    symp_counts = {int(day):float(count) for day,count in zip(days, counts)}
+    asymp_asymp_count = delta[np.isnan(people.date_symptomatic[src])].sum() # Transmissions where the source was also asymptomatic
+
+    stats = sc.objdict()
+    stats.prop_asymp = asymp_count/(asymp_count + counts.sum())
+    stats.prop_asymp_asymp = asymp_asymp_count/asymp_count
+    stats.symp_counts = symp_counts
+    return stats
+
+
+class asymp_stats(cv.Analyzer):
+    '''
+    Compute transmission_stats() on the last day of the run, so that the
+    statistics are available without keeping the people.
+
+    Args:
+        start_day (int): passed to transmission_stats()
+    '''
+
+    def __init__(self, start_day=40, label='asymp_stats', **kwargs):
+        super().__init__(label=label, **kwargs)
+        self.start_day = start_day
+        self.stats = None
+        return
+
+
+    def apply(self, sim):
+        if sim.t == sim.npts-1: # The people and rescaling are final after the last step
+            self.stats = transmission_stats(sim.people, sim.rescale_vec, start_day=self.start_day)
+        return
@@ -0,0 +1,300 @@
+'''
+Run sweep jobs on worker processes on any number of hosts. The process running
+run_vietnam_central.py acts as the coordinator: it listens on a TCP port, and
+each worker connects to it, asks for a job, runs it and sends back the result.
+Jobs are handed out one at a time, so faster hosts simply take more of them.
+While a worker runs a job it sends a heartbeat every few seconds; if a worker's
+connection drops, or its heartbeats stop for longer than the timeout, its job
+is put back in the queue for another worker. The results go through the same
+path as with the local pool (see sweep.run_sweep), so checkpoints, the
+fitsummary and the result stores are written exactly as before.
+
+To try it on one machine, set distribute_port in run_vietnam_central.py (or
+pass --listen PORT), start the analysis, and start some workers:
+
+    python distributed.py worker localhost:6000 -n 4
+
+Workers need the repository (and the same model code and data) on each host;
+they can be started before or after the coordinator, and can be added or
+stopped at any time. Connections are authenticated with a shared key (set
+SWEEP_AUTHKEY on every host), but jobs and results are pickled, so only run
+this on a network you trust.
+'''
+
+import os
+import sys
+import time
+import queue
+import socket
+import argparse
+import threading
+import traceback
+import collections
+import multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+
+authkey = os.environ.get('SWEEP_AUTHKEY', 'covid_vietnam').encode()
+heartbeat_interval = 5 # Seconds between a busy worker's heartbeats
+heartbeat_timeout = 60 # Seconds without a heartbeat before a job is given to another worker
+poll_interval = 1 # Seconds an idle worker waits before asking again
+
+
+class Coordinator:
+    '''
+    Hand out jobs to remote workers and collect their results.
+
+    Args:
+        address (tuple): (host, port) to listen on, e.g. ('0.0.0.0', 6000) for all interfaces
+        timeout (float): seconds without a heartbeat before a job is re-queued
+    '''
+
+    def __init__(self, address, timeout=heartbeat_timeout):
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = collections.deque() # Jobs waiting for a worker: (key, func, job)
+        self.running = {} # Jobs being run, by key: worker, func, job and time last heard from
+        self.finished = set() # Keys of finished jobs, so a result from a worker presumed lost is only counted once
+        self.results = queue.Queue()
+        self.workers = {} # Time each connected worker was last heard from, by name
+        self.sweep = 0
+        self.closing = False
+        threading.Thread(target=self._accept, daemon=True).start()
+        threading.Thread(target=self._reap, daemon=True).start()
+        print(f'Coordinator listening on {self.address[0]}:{self.address[1]}')
+        return
+
+
+    def _accept(self):
+        ''' Start a thread for each worker that connects '''
+        while not self.closing:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError): # Listener closed, or a connection that failed authentication
+                if self.closing:
+                    return
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+        return
+
+
+    def _serve(self, conn):
+        ''' Talk to one worker until it disconnects '''
+        name = None
+        try:
+            while True:
+                msg = conn.recv()
+                kind = msg[0]
+                with self.lock:
+                    if name is not None:
+                        self.workers[name] = time.time()
+                    if kind == 'hello':
+                        name = msg[1]
+                        self.workers[name] = time.time()
+                        print(f'Worker {name} connected')
+                    elif kind == 'ready':
+                        conn.send(self._next(name))
+                    elif kind == 'heartbeat':
+                        if msg[1] in self.running and self.running[msg[1]]['worker'] == name:
+                            self.running[msg[1]]['last'] = time.time()
+                    elif kind in ['result', 'error']:
+                        self._finish(msg)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            with self.lock:
+                self.workers.pop(name, None)
+                lost = [key for key,r in self.running.items() if r['worker'] == name]
+                for key in lost:
+                    self._requeue(key)
+            if name is not None:
+                print(f'Worker {name} disconnected' + (f'; re-queued {len(lost)} job(s)' if lost else ''))
+        return
+
+
+    def _next(self, name):
+        ''' The message answering a worker that asks for a job; call with the lock held '''
+        if self.closing:
+            return ('stop',)
+        while self.pending:
+            key, func, job = self.pending.popleft()
+            if key in self.finished: # Re-queued, but the original worker finished it after all
+                continue
+            self.running[key] = dict(worker=name, func=func, job=job, last=time.time())
+            return ('job', key, func, job)
+        return ('wait', poll_interval)
+
+
+    def _finish(self, msg):
+        ''' Record a result (or error) from a worker; call with the lock held '''
+        kind, key = msg[0], msg[1]
+        r = self.running.pop(key, None)
+        if key in self.finished or key[0] != self.sweep:
+            return
+        self.finished.add(key)
+        if r is None: # Re-queued after this worker was presumed lost: drop the queued copy
+            self.pending = collections.deque(p for p in self.pending if p[0] != key)
+        self.results.put(msg)
+        return
+
+
+    def _requeue(self, key):
+        ''' Put a job that was being run back at the front of the queue; call with the lock held '''
+        r = self.running.pop(key)
+        if key not in self.finished:
+            self.pending.appendleft((key, r['func'], r['job']))
+        return
+
+
+    def _reap(self):
+        ''' Re-queue the jobs of workers that have stopped sending heartbeats '''
+        while not self.closing:
+            time.sleep(min(self.timeout/4, heartbeat_interval))
+            with self.lock:
+                now = time.time()
+                for key,r in list(self.running.items()):
+                    if now - r['last'] > self.timeout:
+                        print(f'No heartbeat from {r["worker"]} for {now - r["last"]:0.0f} s; re-queueing its job')
+                        self._requeue(key)
+        return
+
+
+    def run(self, func, todo):
+        '''
+        Queue the jobs and yield each result as it arrives, in the form used
+        by sweep.run_sweep().
+
+        Args:
+            func (func): the worker function; must be importable by the workers
+            todo (list): (position, job) pairs
+
+        Yields:
+            (position, job, result, worker name, run time) for each job
+        '''
+        with self.lock:
+            self.sweep += 1
+            self.finished.clear()
+            jobs = {}
+            for j,job in todo:
+                key = (self.sweep, j)
+                jobs[key] = job
+                self.pending.append((key, func, job))
+        n_left = len(todo)
+        waited = 0
+        while n_left:
+            try:
+                msg = self.results.get(timeout=heartbeat_timeout)
+            except queue.Empty:
+                waited += heartbeat_timeout
+                if not self.workers:
+                    print(f'Waiting for workers to connect to {self.address[0]}:{self.address[1]} ({n_left} jobs queued, {waited:0.0f} s so far)')
+                continue
+            if msg[0] == 'error':
+                raise RuntimeError(f'Job {jobs[msg[1]]} failed on a worker:\n{msg[2]}')
+            _, key, result, worker, elapsed = msg
+            n_left -= 1
+            yield key[1], jobs[key], result, worker, elapsed
+        return
+
+
+    def close(self):
+        ''' Tell the workers to stop and stop listening '''
+        self.closing = True
+        with self.lock:
+            self.pending.clear()
+        self.listener.close()
+        return
+
+
+def work(address, name=None):
+    '''
+    Connect to a coordinator and run jobs until it closes.
+
+    Args:
+        address (tuple): (host, port) of the coordinator
+        name (str): name to report (default: hostname:pid)
+    '''
+    if name is None:
+        name = f'{socket.gethostname()}:{os.getpid()}'
+    conn = Client(address, authkey=authkey)
+    lock = threading.Lock()
+    current = [None]
+    stopped = threading.Event()
+
+    def send(msg):
+        with lock:
+            conn.send(msg)
+
+    def heartbeat():
+        while not stopped.wait(heartbeat_interval):
+            key = current[0]
+            if key is not None:
+                try:
+                    send(('heartbeat', key))
+                except OSError:
+                    return
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    send(('hello', name))
+    n_done = 0
+    try:
+        while True:
+            send(('ready',))
+            msg = conn.recv()
+            if msg[0] == 'stop':
+                break
+            elif msg[0] == 'wait':
+                time.sleep(msg[1])
+                continue
+            _, key, func, job = msg
+            current[0] = key
+            t0 = time.time()
+            try:
+                result = func(job)
+            except Exception:
+                send(('error', key, traceback.format_exc()))
+            else:
+                send(('result', key, result, name, time.time() - t0))
+                n_done += 1
+            current[0] = None
+    except (EOFError, OSError):
+        pass # The coordinator has gone
+    finally:
+        stopped.set()
+        conn.close()
+    print(f'Worker {name} finished after {n_done} jobs')
+    return n_done
+
+
+def parse_address(address):
+    ''' Convert "host:port" to (host, port) '''
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+def _worker_main(address):
+    ''' Keep a worker process connected, retrying until the coordinator is up '''
+    while True:
+        try:
+            work(address)
+            return
+        except ConnectionRefusedError:
+            time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run sweep jobs for a coordinator on another process or host')
+    parser.add_argument('command', choices=['worker'])
+    parser.add_argument('address', help='host:port of the coordinator')
+    parser.add_argument('-n', '--nprocs', type=int, default=1, help='number of worker processes to start on this host (default: 1)')
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__))) # The model reads vietnam_data.csv from the root folder
+    sys.path.insert(0, os.getcwd())
+    address = parse_address(args.address)
+    procs = [mp.Process(target=_worker_main, args=(address,)) for p in range(args.nprocs)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
@@ -0,0 +1,77 @@
+'''
+The few Covasim and Sciris helpers the figure scripts use, reimplemented so
+that the scripts don't need to import either: importing Covasim (or unpickling
+anything that refers to it) pulls in the whole model, and Sciris on its own
+takes longer to import than Matplotlib. Together with resultstore, reducers,
+metrics, summaries and vietnam_calendar, which are kept free of any dependency
+but NumPy for this reason, this is everything a figure script needs to read
+the results; Matplotlib is imported by the scripts themselves, and pandas and
+seaborn only where a figure uses them.
+'''
+
+import os
+import time
+
+# Result colors, as from cv.get_colors() (Covasim 2.0)
+colors = dict(
+    susceptible = '#5e7544',
+    infectious  = '#c78f65',
+    infections  = '#c75649',
+    exposed     = '#c75649',
+    tests       = '#aaa8ff',
+    diagnoses   = '#8886cc',
+    diagnosed   = '#8886cc',
+    recoveries  = '#799956',
+    recovered   = '#799956',
+    symptomatic = '#c1ad71',
+    severe      = '#c1981d',
+    quarantined = '#5f1914',
+    critical    = '#b86113',
+    deaths      = '#000000',
+    dead        = '#000000',
+)
+
+
+def tic():
+    ''' Start a timer, like sc.tic() '''
+    return time.time()
+
+
+def toc(start):
+    ''' Print the time since tic(), like sc.toc() '''
+    print(f'Elapsed time: {time.time() - start:0.2f} s')
+    return
+
+
+def boxoff(ax=None):
+    ''' Remove the top and right borders of a plot, like sc.boxoff() '''
+    import pylab as pl
+    if ax is None:
+        ax = pl.gca()
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.xaxis.set_ticks_position('bottom')
+    ax.yaxis.set_ticks_position('left')
+    ax.tick_params(direction='out', pad=5)
+    return ax
+
+
+def setylim(ax=None):
+    ''' Start the y axis at zero, like sc.setylim() '''
+    import pylab as pl
+    if ax is None:
+        ax = pl.gca()
+    ax.set_ylim((0, max(0, ax.get_ylim()[1])))
+    return
+
+
+def savefig(filename, **kwargs):
+    ''' Save the current figure at 150 dpi, like cv.savefig(), creating its folder if needed '''
+    import pylab as pl
+    folder = os.path.dirname(filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    kwargs.setdefault('dpi', 150)
+    pl.savefig(filename, **kwargs)
+    return filename
+
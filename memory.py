@@ -0,0 +1,146 @@
+'''
+Memory estimates for runs at a given number of agents, so that full-scale runs
+(vietnam_model.total_pop agents, with no rescaling) can be checked against a
+budget before any are started. The memory used per agent is measured once, on a
+small population, and scaled up: by the population build, by the population's
+read-only arrays (which can be shared between workers; see sharedpeople), by the
+arrays each sim keeps to itself, and by a run. If the runs wouldn't all fit at
+once, the number of workers is cut so that they run in smaller waves; if even a
+single run wouldn't fit, a MemoryError is raised before anything starts.
+
+The measurement is of Covasim's own per-agent arrays, at whatever dtypes
+Covasim gives them; check_precision() warns if it's running at 64 bits. The
+arrays aren't narrowed any further here: Covasim's numba kernels are compiled
+for its default float and int types, and its date arrays use nan for days that
+never happen, so narrower dtypes or integer day indices would need changes to
+Covasim itself.
+'''
+
+import os
+import json
+import tracemalloc
+import numpy as np
+import sciris as sc
+import covasim as cv
+import covasim.defaults as cvd
+import vietnam_model as vm
+import vietnam_interventions as vi
+import sharedpeople
+
+calfile = os.path.join(vm.cachefolder, 'memory.json')
+calib_agents = 20e3 # Size of the population the per-agent memory is measured on
+calib_days = 60 # Days run when measuring, to get past the school and work closures, which copy their layers
+overhead = 1.25 # Allowance for fragmentation, the interpreter, and memory that tracemalloc doesn't see
+budget_share = 0.8 # Default budget, as a share of physical memory
+
+
+def physical_memory():
+    ''' Total physical memory in bytes '''
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+
+
+def check_precision():
+    ''' Warn if Covasim is running at 64-bit precision, which doubles the size of most per-agent arrays '''
+    if np.dtype(cvd.default_float).itemsize > 4:
+        print(f'Warning: Covasim is using {np.dtype(cvd.default_float).name}; set COVASIM_PRECISION=32 to halve the memory per agent')
+    return
+
+
+def calibrate(n_agents=calib_agents, force=False):
+    '''
+    Measure the memory used per agent, or load the measurement made before
+    with the same Covasim version and precision.
+
+    Returns:
+        objdict of bytes per agent for the population build (peak), the read-only arrays, each sim's own arrays, and a run (peak, on top of the sim it copies)
+    '''
+    key = f'{cv.__version__}_{np.dtype(cvd.default_float).name}_{n_agents:.0f}'
+    if vm.indexed_tracing:
+        key += '_indexed' # The contact indexes add to a run's memory
+    stored = {}
+    if os.path.exists(calfile):
+        with open(calfile) as f:
+            stored = json.load(f)
+    if key in stored and not force:
+        return sc.objdict(stored[key])
+
+    print(f'Measuring memory per agent on {n_agents:.0f} agents...')
+    tracemalloc.start()
+    sim = vm.make_sim(seed=1, beta=0.0135, n_agents=n_agents, use_cache=False)
+    build = tracemalloc.get_traced_memory()[1]
+    shared = sum(arr.nbytes for _,arr in sharedpeople.shared_fields(sim.people))
+    private = sum(sim.people[key].nbytes for key in sim.people.meta.all_states if key not in sim.people.meta.person)
+    vi.clear_indexes() # So the run builds its contact indexes, as a worker's first run does
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    run = vm.copy_sim(sim)
+    run.run(until=calib_days)
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    per_agent = dict(build=build/n_agents, shared=shared/n_agents, private=private/n_agents, run=peak/n_agents)
+    stored[key] = per_agent
+    os.makedirs(os.path.dirname(calfile), exist_ok=True)
+    with open(calfile, 'w') as f:
+        json.dump(stored, f, indent=2)
+    return sc.objdict(per_agent)
+
+
+def population_cached(n_agents):
+    ''' Whether the population for this many agents is already in the on-disk cache, so won't need to be built '''
+    pars = dict(pop_size=n_agents, pop_type='hybrid', location='vietnam', rand_seed=1) # As used by make_sim() for the shared sims
+    return os.path.exists(vm.base_sim_file(pars))
+
+
+def estimate(n_agents, n_workers=1, shared=True):
+    '''
+    Estimate the memory needed to run n_workers runs at once.
+
+    Args:
+        n_agents (float): the number of agents
+        n_workers (int): the number of runs at once
+        shared (bool): whether the read-only arrays are in shared memory (one copy for everyone) or copied by every worker
+
+    Returns:
+        objdict of bytes for building the population (before any workers start), for the parent and each worker while running, and in total
+    '''
+    p = calibrate()
+    build  = p.build*n_agents
+    parent = (p.shared + 2*p.private)*n_agents # The base sim and the sim built from it
+    worker = (2*p.private + p.run)*n_agents # The sim shared by the worker's runs, plus a run
+    if not shared:
+        worker += 2*p.shared*n_agents
+    return sc.objdict({k:overhead*v for k,v in dict(build=build, parent=parent, worker=worker, total=parent + n_workers*worker).items()})
+
+
+def max_workers(n_agents, ncpus=None, budget=None, shared=True, verbose=True):
+    '''
+    The number of workers that fit within the memory budget: ncpus if they all
+    fit, otherwise as many as do, so the runs go in smaller waves.
+
+    Args:
+        n_agents (float): the number of agents
+        ncpus (int): the number of workers wanted (default: all cores)
+        budget (float): memory budget in bytes (default: budget_share of physical memory)
+        shared (bool): see estimate()
+        verbose (bool): print the estimate
+
+    Raises:
+        MemoryError: if a single run, or building the population, wouldn't fit
+    '''
+    if ncpus is None:
+        ncpus = os.cpu_count()
+    if budget is None:
+        budget = budget_share*physical_memory()
+    check_precision()
+    one = estimate(n_agents, 1, shared=shared)
+    if one.total > budget:
+        raise MemoryError(f'A run with {n_agents:.0f} agents needs about {one.total/1e9:0.1f} GB, over the budget of {budget/1e9:0.1f} GB')
+    if one.build > budget and not population_cached(n_agents):
+        raise MemoryError(f'Building the population of {n_agents:.0f} agents needs about {one.build/1e9:0.1f} GB, over the budget of {budget/1e9:0.1f} GB')
+    n = int(min(ncpus, (budget - one.parent)//one.worker))
+    if verbose:
+        est = estimate(n_agents, n, shared=shared)
+        print(f'Memory for {n_agents:.0f} agents: {est.parent/1e9:0.2f} GB parent + {est.worker/1e9:0.2f} GB per worker; '
+              f'{n} workers need {est.total/1e9:0.1f} GB of the {budget/1e9:0.1f} GB budget' + (f' (cut from {ncpus})' if n < ncpus else ''))
+    return n
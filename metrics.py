@@ -0,0 +1,99 @@
+'''
+Scenario metrics computed on stacked result arrays in single NumPy passes,
+rather than run by run in Python. Every function works along the last axis
+(days), so the same call handles one run of shape (n_days,), a store's runs of
+shape (n_sims, n_days), or several scenarios stacked with stack() into shape
+(n_scenarios, n_sims, n_days).
+
+**Example**::
+
+    diags = stack([Results(folder)['new_diagnoses'] for folder in folders]) # (n_scenarios, n_sims, n_days)
+    smoothed = trailing_mean(diags, 14) # 14-day trailing average of every run
+    band = bands(smoothed) # band['best'] has shape (n_scenarios, n_days)
+    peak_day, peak_value = peaks(band['best'], start=cal.day('2020-12-01'))
+'''
+
+import numpy as np
+
+
+def stack(arrays):
+    '''
+    Stack the (n_sims, n_days) arrays of several scenarios into one
+    (n_scenarios, n_sims, n_days) array. Scenarios with fewer runs are padded
+    with nan, which bands() ignores.
+    '''
+    arrays = [np.asarray(arr, dtype=float) for arr in arrays]
+    n_sims = max(len(arr) for arr in arrays)
+    output = np.full((len(arrays), n_sims) + arrays[0].shape[1:], np.nan)
+    for i,arr in enumerate(arrays):
+        output[i,:len(arr)] = arr
+    return output
+
+
+def trailing_mean(x, window):
+    '''
+    Mean of the window days before each day, from a single cumulative sum.
+    Days without a full window before them are nan, so the output lines up
+    with the input day by day.
+
+    Args:
+        x (array): values by day along the last axis
+        window (int): number of days to average
+
+    Returns:
+        array of the same shape as x
+    '''
+    x = np.asarray(x, dtype=float)
+    csum = np.zeros(x.shape[:-1] + (x.shape[-1]+1,))
+    np.cumsum(x, axis=-1, out=csum[...,1:])
+    output = np.full(x.shape, np.nan)
+    output[...,window:] = (csum[...,window:-1] - csum[...,:-window-1])/window
+    return output
+
+
+def cum_diff(cum, start, end=-1):
+    '''
+    The increase in a cumulative result from one day to another, e.g. the
+    infections after the borders open: cum_diff(res['cum_infections'], day).
+    '''
+    cum = np.asarray(cum)
+    return cum[...,end] - cum[...,start]
+
+
+def window_diffs(cum, days):
+    '''
+    The increase in a cumulative result over each window between consecutive
+    days, e.g. monthly totals from month boundaries.
+
+    Returns:
+        array with len(days)-1 values along the last axis
+    '''
+    values = np.asarray(cum)[...,np.asarray(days)]
+    return np.diff(values, axis=-1)
+
+
+def peaks(x, start=0, end=None):
+    '''
+    The day and value of the peak of each series between two days.
+
+    Returns:
+        (peak day, peak value): arrays of the shape of x without its last axis, with days counted from the start of x
+    '''
+    x = np.asarray(x)[...,start:end]
+    peak_day = np.argmax(x, axis=-1)
+    peak_value = np.take_along_axis(x, peak_day[...,None], axis=-1)[...,0]
+    return peak_day + start, peak_value
+
+
+def bands(x, quantiles=(0.5, 0.025, 0.975)):
+    '''
+    Per-day quantiles across runs, i.e. along the second-to-last axis.
+
+    Returns:
+        dict with best (the first quantile, by default the median), low and high (the next two), and all quantiles by value under "quantiles", as from QuantileReducer.reduce()
+    '''
+    qvals = np.nanquantile(np.asarray(x, dtype=float), quantiles, axis=-2)
+    band = dict(quantiles={q:v for q,v in zip(quantiles, qvals)})
+    for name,v in zip(['best', 'low', 'high'], qvals):
+        band[name] = v
+    return band
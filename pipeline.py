@@ -0,0 +1,171 @@
+'''
+Minimal stage runner for run_vietnam_central.py. Each stage declares the stages
+it depends on, its parameters, the files it reads and the files it writes. A
+stage is skipped if its outputs exist and the hash of its inputs -- parameters,
+input files, and the outputs of the stages it depends on -- matches the hash
+recorded in results/pipeline.json when it last ran.
+'''
+
+import os
+import json
+import hashlib
+import sciris as sc
+
+
+def file_hash(path, blocksize=2**20):
+    ''' MD5 of a file's contents, or of every file in a folder; None if it doesn't exist '''
+    if os.path.isdir(path):
+        md5 = hashlib.md5()
+        for name in sorted(os.listdir(path)):
+            md5.update(name.encode())
+            md5.update(str(file_hash(os.path.join(path, name))).encode())
+        return md5.hexdigest()
+    elif os.path.exists(path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                md5.update(block)
+        return md5.hexdigest()
+    return None
+
+
+class Stage:
+    '''
+    One stage of the pipeline.
+
+    Args:
+        name (str): the stage name
+        func (func): function to run, with no arguments
+        requires (list): names of the stages whose outputs this stage reads
+        pars (dict): the parameters the stage depends on; must be JSON-serializable
+        inputs (list): files (or folders) the stage reads, other than the outputs of other stages
+        outputs (list): files (or folders) the stage writes
+        alias_of (list): for a stage that does the work of other stages in one go, the names of those stages; it is current when they all are, and running it records their hashes rather than its own
+    '''
+
+    def __init__(self, name, func, requires=None, pars=None, inputs=None, outputs=None, alias_of=None):
+        self.name     = name
+        self.func     = func
+        self.requires = list(requires) if requires else []
+        self.pars     = pars if pars else {}
+        self.inputs   = list(inputs) if inputs else []
+        self.outputs  = list(outputs) if outputs else []
+        self.alias_of = list(alias_of) if alias_of else []
+        return
+
+
+class Pipeline:
+    '''
+    Run a set of stages in dependency order in a single process, skipping any
+    that are already up to date.
+
+    Args:
+        statefile (str): JSON file recording the input and output hashes of each stage that has run
+    '''
+
+    def __init__(self, statefile):
+        self.statefile = statefile
+        self.stages = sc.odict()
+        self.state = {}
+        if os.path.exists(statefile):
+            with open(statefile) as f:
+                self.state = json.load(f)
+        return
+
+
+    def add(self, name, func, **kwargs):
+        ''' Add a stage; see Stage for the arguments '''
+        self.stages[name] = Stage(name, func, **kwargs)
+        return
+
+
+    def order(self, names):
+        ''' The requested stages plus everything they depend on, with dependencies first '''
+        ordered = []
+        def visit(name, path=()):
+            if name not in self.stages:
+                raise KeyError(f'Stage "{name}" not found; choices are {self.stages.keys()}')
+            if name in path:
+                raise ValueError(f'Circular dependency: {" -> ".join(path + (name,))}')
+            for dep in self.stages[name].requires:
+                visit(dep, path + (name,))
+            if name not in ordered:
+                ordered.append(name)
+        for name in names:
+            visit(name)
+        return ordered
+
+
+    def input_hash(self, name):
+        ''' Hash of everything the stage depends on '''
+        stage = self.stages[name]
+        keyinfo = dict(
+            pars     = stage.pars,
+            inputs   = {path:file_hash(path) for path in stage.inputs},
+            requires = {dep:self.state.get(dep, {}).get('outputs') for dep in stage.requires},
+        )
+        return hashlib.md5(json.dumps(keyinfo, sort_keys=True, default=str).encode()).hexdigest()
+
+
+    def is_current(self, name):
+        ''' Whether the stage ran with the same inputs and its outputs haven't changed since '''
+        stage = self.stages[name]
+        if stage.alias_of:
+            return all(self.is_current(other) for other in stage.alias_of)
+        state = self.state.get(name)
+        if state is None or state['hash'] != self.input_hash(name):
+            return False
+        return all(file_hash(path) is not None and file_hash(path) == state['outputs'].get(path) for path in stage.outputs)
+
+
+    def save(self):
+        ''' Write the state file, via a temporary file so it's never left half-written '''
+        folder = os.path.dirname(self.statefile)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmpfile = f'{self.statefile}.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmpfile, self.statefile)
+        return
+
+
+    def run(self, names, force=False):
+        '''
+        Run the requested stages and any out-of-date stages they depend on.
+
+        Args:
+            names (list): the stages to run
+            force (bool): rerun the requested stages even if they're up to date (their dependencies are still skipped if current)
+        '''
+        for name in self.order(names):
+            stage = self.stages[name]
+            if self.is_current(name) and not (force and name in names):
+                print(f'Skipping {name}: inputs unchanged since it last ran')
+                continue
+            if name not in names and name not in self.state and stage.outputs and all(os.path.exists(path) for path in stage.outputs):
+                print(f'Using the existing outputs of {name}, which was run outside the pipeline') # E.g. results from before the pipeline existed
+                self.record(name, elapsed=None)
+                continue
+            sc.heading(f'Running {name}')
+            T = sc.tic()
+            stage.func()
+            elapsed = sc.toc(T, output=True)
+            self.record(name, elapsed=elapsed)
+            print(f'Finished {name} in {elapsed:0.1f} s')
+        return
+
+
+    def record(self, name, elapsed):
+        ''' Store the input and output hashes of a stage that has just run '''
+        if self.stages[name].alias_of: # Record the stages it stands in for, so that they don't rerun
+            for other in self.stages[name].alias_of:
+                self.record(other, elapsed)
+            return
+        self.state[name] = dict(
+            hash    = self.input_hash(name),
+            outputs = {path:file_hash(path) for path in self.stages[name].outputs},
+            elapsed = elapsed,
+        )
+        self.save()
+        return
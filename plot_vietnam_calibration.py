@@ -1,39 +1,41 @@
-import covasim as cv
-import pandas as pd
-import sciris as sc
 import pylab as pl
 import numpy as np
 from matplotlib import ticker
 import datetime as dt
 import matplotlib.patches as patches
+from vietnam_calendar import calendar as cal
+from resultstore import Results
+import metrics
+from summaries import summarize
+import figtools as ft
 
 # Filepaths
 figsfolder = 'figs234'
-simsfilepath = 'results/vietnam_sim.obj'
+resultspath = 'results/vietnam_sim'
 calibration_end = '2020-10-15'
 
-T = sc.tic()
+T = ft.tic()
 
-# Import files
-simsfile = sc.loadobj(simsfilepath)
+# Open the result store; each key is memory-mapped when it's first used
+res = Results(resultspath)
 
 # Define plotting functions
 #%% Helper functions
 
-def format_ax(ax, sim, key=None):
+def format_ax(ax, key=None):
     @ticker.FuncFormatter
     def date_formatter(x, pos):
-        return (sim['start_day'] + dt.timedelta(days=x)).strftime('%b')
+        return (cal.start_day + dt.timedelta(days=x)).strftime('%b')
     ax.xaxis.set_major_formatter(date_formatter)
-    pl.xlim([0, sim.day(calibration_end)])
-    sc.boxoff()
+    pl.xlim([0, cal.day(calibration_end)])
+    ft.boxoff()
     return
 
-def plotter(key, sims, ax, ys=None, calib=False, label='', ylabel='', low_q=0.025, high_q=0.975, flabel=True, startday=None, subsample=2, chooseseed=None):
+def plotter(key, res, ax, ys=None, calib=False, label='', ylabel='', low_q=0.025, high_q=0.975, flabel=True, startday=None, subsample=2, chooseseed=None):
 
     which = key.split('_')[1]
     try:
-        color = cv.get_colors()[which]
+        color = ft.colors[which]
     except:
         color = [0.5,0.5,0.5]
     if which == 'diagnoses':
@@ -41,31 +43,32 @@ def plotter(key, sims, ax, ys=None, calib=False, label='', ylabel='', low_q=0.02
     elif which == '':
         color = [0.82400815, 0.        , 0.        , 1.        ]
 
-    if ys is None:
-        ys = []
-        for s in sims:
-            ys.append(s.results[key].values)
-
-    yarr = np.array(ys)
+    # Use the store's cached summary if it has these quantiles, otherwise compute the bands from the runs
+    band = None
+    if ys is None and chooseseed is None:
+        band = summarize(res.folder).band(key, [0.5, low_q, high_q])
+    if band is None:
+        if ys is None:
+            ys = res[key]
+        band = metrics.bands(ys, quantiles=[0.5, low_q, high_q])
     if chooseseed is not None:
-        best = sims[chooseseed].results[key].values
+        best = np.asarray(ys[chooseseed])
     else:
-        best = pl.median(yarr, axis=0)
-    low  = pl.quantile(yarr, q=low_q, axis=0)
-    high = pl.quantile(yarr, q=high_q, axis=0)
-
-    sim = sims[0] # For having a sim to refer to
+        best = band['best']
+    low  = band['low']
+    high = band['high']
 
     tvec = np.arange(len(best))
-    if key in sim.data:
-        data_t = np.array((sim.data.index-sim['start_day'])/np.timedelta64(1,'D'))
+    data = cal.column(key)
+    if data is not None:
+        data_t = cal.data_days()
         inds = np.arange(0, len(data_t), subsample)
-        pl.plot(data_t[inds], sim.data[key][inds], 'd', c=color, markersize=15, alpha=0.75, label='Data')
+        pl.plot(data_t[inds], data[inds], 'd', c=color, markersize=15, alpha=0.75, label='Data')
 
     start = None
     if startday is not None:
-        start = sim.day(startday)
-    end = sim.day(calibration_end)
+        start = cal.day(startday)
+    end = cal.day(calibration_end)
     if flabel:
         if which == 'infections':
             fill_label = '95% projected interval'
@@ -78,17 +81,16 @@ def plotter(key, sims, ax, ys=None, calib=False, label='', ylabel='', low_q=0.02
 
     # Print some stats
     if key == 'cum_infections':
-        print(f'Estimated {which} on July 25: {best[sim.day("2020-07-25")]} (95%: {low[sim.day("2020-07-25")]}-{high[sim.day("2020-07-25")]})')
-        print(f'Estimated {which} overall: {best[sim.day(calibration_end)]} (95%: {low[sim.day(calibration_end)]}-{high[sim.day(calibration_end)]})')
+        print(f'Estimated {which} on July 25: {best[cal.day("2020-07-25")]} (95%: {low[cal.day("2020-07-25")]}-{high[cal.day("2020-07-25")]})')
+        print(f'Estimated {which} overall: {best[cal.day(calibration_end)]} (95%: {low[cal.day(calibration_end)]}-{high[cal.day(calibration_end)]})')
     elif key=='n_infectious':
-        peakday = sc.findnearest(best, max(best))
-        peakval = max(best)
-        print(f'Estimated peak {which} on {sim.date(peakday)}: {peakval} (95%: {low[peakday]}-{high[peakday]})')
-        print(f'Estimated {which} on last day: {best[sim.day(calibration_end)]} (95%: {low[sim.day(calibration_end)]}-{high[sim.day(calibration_end)]})')
+        peakday, peakval = metrics.peaks(best)
+        print(f'Estimated peak {which} on {cal.date(peakday)}: {peakval} (95%: {low[peakday]}-{high[peakday]})')
+        print(f'Estimated {which} on last day: {best[cal.day(calibration_end)]} (95%: {low[cal.day(calibration_end)]}-{high[cal.day(calibration_end)]})')
     elif key=='cum_diagnoses':
-        print(f'Estimated {which} overall: {best[sim.day(calibration_end)]} (95%: {low[sim.day(calibration_end)]}-{high[sim.day(calibration_end)]})')
+        print(f'Estimated {which} overall: {best[cal.day(calibration_end)]} (95%: {low[cal.day(calibration_end)]}-{high[cal.day(calibration_end)]})')
 
-    sc.setylim()
+    ft.setylim()
 
     xmin,xmax = ax.get_xlim()
     if calib:
@@ -97,25 +99,25 @@ def plotter(key, sims, ax, ys=None, calib=False, label='', ylabel='', low_q=0.02
         ax.set_xticks(pl.arange(xmin+2, xmax, 28))
 
     pl.ylabel(ylabel)
-    datemarks = pl.array([sim.day('2020-07-01'), sim.day('2020-08-01'), sim.day('2020-09-01'), sim.day('2020-10-01')]) * 1.
+    datemarks = pl.array([cal.day('2020-07-01'), cal.day('2020-08-01'), cal.day('2020-09-01'), cal.day('2020-10-01')]) * 1.
     ax.set_xticks(datemarks)
 
     return
 
 
-def plot_intervs(sim, labels=True):
+def plot_intervs(labels=True):
 
     color = [0, 0, 0]
-    jul25 = sim.day('2020-07-25')
-    for day in [jul25, sim.day('2020-09-05'), sim.day('2020-09-14')]:
+    jul25 = cal.day('2020-07-25')
+    for day in [jul25, cal.day('2020-09-05'), cal.day('2020-09-14')]:
         pl.axvline(day, c=color, linestyle='--', alpha=0.4, lw=3)
 
     if labels:
         yl = pl.ylim()
         labely = yl[1]*0.85
         pl.text(jul25-20, labely, 'Da Nang\noutbreak', color=color, alpha=0.9, style='italic')
-        pl.text(sim.day('2020-09-05')-17, labely, 'Work\nreopens', color=color, alpha=0.9, style='italic')
-        pl.text(sim.day('2020-09-14') + 2, labely, 'School\nreopens', color=color, alpha=0.9, style='italic')
+        pl.text(cal.day('2020-09-05')-17, labely, 'Work\nreopens', color=color, alpha=0.9, style='italic')
+        pl.text(cal.day('2020-09-14') + 2, labely, 'School\nreopens', color=color, alpha=0.9, style='italic')
     return
 
 
@@ -126,10 +128,6 @@ pl.rcParams['font.size'] = font_size
 pl.rcParams['font.family'] = font_family
 pl.figure(figsize=(24,16))
 
-# Extract a sim to refer to
-sims = simsfile.sims
-sim = sims[0]
-
 # Plot locations
 ygapb = 0.05
 ygapm = 0.05
@@ -146,31 +144,31 @@ ax = {}
 
 # a: daily diagnoses
 ax[0] = pl.axes([xgapl, ygapb+ygapm+dy, dx1, dy])
-format_ax(ax[0], sim)
-plotter('new_diagnoses', sims, ax[0], calib=True, label='Model', ylabel='Daily diagnoses')
-plot_intervs(sim)
+format_ax(ax[0])
+plotter('new_diagnoses', res, ax[0], calib=True, label='Model', ylabel='Daily diagnoses')
+plot_intervs()
 
 # b. cumulative diagnoses
 ax[1] = pl.axes([xgapl+xgapm+dx1, ygapb+ygapm+dy, dx2, dy])
-format_ax(ax[1], sim)
-plotter('cum_diagnoses', sims, ax[1], calib=True, label='Diagnoses\n(modeled)', ylabel='Cumulative diagnoses', flabel=False)
+format_ax(ax[1])
+plotter('cum_diagnoses', res, ax[1], calib=True, label='Diagnoses\n(modeled)', ylabel='Cumulative diagnoses', flabel=False)
 pl.legend(loc='upper left', frameon=False)
 #pl.ylim([0, 10e3])
 
 # c. cumulative and active infections
 ax[2] = pl.axes([xgapl, ygapb, dx1, dy])
-format_ax(ax[2], sim)
-plotter('cum_infections', sims, ax[2], calib=True, label='Cumulative infections\n(modeled)', ylabel='', flabel=False)
-plotter('n_infectious', sims, ax[2], calib=True, label='Active infections\n(modeled)', ylabel='Estimated infections', flabel=False)
+format_ax(ax[2])
+plotter('cum_infections', res, ax[2], calib=True, label='Cumulative infections\n(modeled)', ylabel='', flabel=False)
+plotter('n_infectious', res, ax[2], calib=True, label='Active infections\n(modeled)', ylabel='Estimated infections', flabel=False)
 pl.legend(loc='upper left', frameon=False)
 
 # d. cumulative deaths
 ax[3] = pl.axes([xgapl+xgapm+dx1, ygapb, dx2, dy])
-format_ax(ax[3], sim)
-plotter('cum_deaths', sims, ax[3], calib=True, label='Deaths\n(modeled)', ylabel='Cumulative deaths', flabel=False)
+format_ax(ax[3])
+plotter('cum_deaths', res, ax[3], calib=True, label='Deaths\n(modeled)', ylabel='Cumulative deaths', flabel=False)
 pl.legend(loc='upper left', frameon=False)
 #pl.ylim([0, 10e3])
 
-cv.savefig(f'{figsfolder}/fig2_calibration.pdf')
+ft.savefig(f'{figsfolder}/fig2_calibration.pdf')
 
-sc.toc(T)
\ No newline at end of file
+ft.toc(T)
\ No newline at end of file
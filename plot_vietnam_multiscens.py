@@ -1,6 +1,3 @@
-import covasim as cv
-import pandas as pd
-import sciris as sc
 import pylab as pl
 import numpy as np
 from matplotlib import ticker
@@ -9,30 +6,29 @@ import matplotlib.patches as patches
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
 import matplotlib.ticker as mtick
-import seaborn as sns
+from vietnam_calendar import calendar as cal, todate
+from summaries import summarize
+import metrics
+import figtools as ft
 
 # Filepaths
 figsfolder = 'figs234'
 resfolder = 'results'
-simsfilepath = f'{resfolder}/vietnam_sim.obj'
 borders_open = '2020-12-01'
 
-T = sc.tic()
+T = ft.tic()
 thresholds = np.arange(10,60,10)
-# Import files
-filepaths = [f'{resfolder}/vietnam_sim_{t}.obj' for t in thresholds]
-sims = []
-for fp in filepaths:
-    simsfile = sc.loadobj(fp)
-    sims.append(simsfile.sims)
-sim = sims[0][0] # Extract a sim to refer to
-
-borders_open_ind = sim.day(borders_open)
-cuminf = []
-newdiag = []
-for tn,t in enumerate(thresholds):
-    cuminf.append([s.results['cum_infections'].values[-1] - s.results['cum_infections'].values[borders_open_ind] for s in sims[tn]])
-    newdiag.append([s.results['new_diagnoses'].values[borders_open_ind-14:] for s in sims[tn]])
+borders_open_ind = cal.day(borders_open)
+
+def cuminf_after_borders(res):
+    ''' Infections in each run from the day the borders open to the end '''
+    return metrics.cum_diff(res['cum_infections'], cal.day(borders_open))
+
+# Load each store's cached summary; the stores themselves are only read if they've changed since it was made
+summs = [summarize(f'{resfolder}/vietnam_sim_{t}', scalars=dict(cuminf=cuminf_after_borders)) for t in thresholds]
+cuminf = metrics.stack([summ.scalars['cuminf'] for summ in summs]) # (n_thresholds, n_sims), padded with nan where a threshold has fewer runs (e.g. with converge_scenarios)
+newdiag = np.array([summ['new_diagnoses']['best'][borders_open_ind-14:] for summ in summs]) # Median daily diagnoses from two weeks before the borders open
+smoothed = metrics.trailing_mean(newdiag, 14)[:,14:] # 14-day trailing average, for every threshold at once
 
 
 # Fonts and sizes
@@ -60,33 +56,33 @@ ax = {}
 pl.figtext(xgapl*0.5,           ygapb + dy, 'A', fontweight='bold', fontsize=45)
 pl.figtext(xgapl*0.5+xgapm+dx,  ygapb + dy, 'B', fontweight='bold', fontsize=45)
 
-# Set up a dataframe for seaborn plotting
-labels = [f'{t}%' for t in thresholds]
-df = pd.DataFrame(np.array(cuminf).T, columns=labels)
-df2 = df.melt()
-
 for pn in range(nplots):
     ax[pn] = pl.axes([xgapl + (dx + xgapm) * (pn % ncols), ygapb + (ygapm + dy) * (pn // ncols), dx, dy])
 
     if pn==0:
         for tn, t in enumerate(thresholds):
-            yarr = np.array(newdiag[tn])
-            best = pl.median(yarr, axis=0)
-            smoothed = [best[i-14:i].sum()/14 for i in range(14,len(best))]
-            ax[pn].plot(np.arange(len(best)-14), smoothed, lw=4, alpha=1.0, label=f'{t}% testing')
+            ax[pn].plot(np.arange(smoothed.shape[1]), smoothed[tn], lw=4, alpha=1.0, label=f'{t}% testing')
             pl.legend(loc='upper left', frameon=False, fontsize=36)
             ax[pn].set_ylabel('Daily diagnoses (14 day trailing average)')
 
         @ticker.FuncFormatter
         def date_formatter(x, pos):
-            return (cv.date('2020-11-15') + dt.timedelta(days=x)).strftime('%b-%y')
+            return (todate('2020-11-15') + dt.timedelta(days=x)).strftime('%b-%y')
 
         ax[pn].xaxis.set_major_formatter(date_formatter)
 
-        datemarks = pl.array([sim.day('2020-12-01'), sim.day('2021-01-01'), sim.day('2021-02-01'), sim.day('2021-03-01')]) * 1. - sim.day('2020-11-30')
+        datemarks = pl.array([cal.day('2020-12-01'), cal.day('2021-01-01'), cal.day('2021-02-01'), cal.day('2021-03-01')]) * 1. - cal.day('2020-11-30')
         ax[pn].set_xticks(datemarks)
 
     if pn==1:
+        import pandas as pd # Only needed for this panel, so not imported up front
+        import seaborn as sns
+
+        # Set up a dataframe for seaborn plotting
+        labels = [f'{t}%' for t in thresholds]
+        values = [row[~np.isnan(row)] for row in cuminf] # Each threshold's runs, without the padding
+        df2 = pd.DataFrame(dict(variable=np.repeat(labels, [len(v) for v in values]), value=np.concatenate(values)))
+
         ax[pn] = sns.swarmplot(x="variable", y="value", data=df2, color="grey", alpha=0.5)
         ax[pn] = sns.violinplot(x="variable", y="value", data=df2, color ="lightblue", alpha=0.5, inner=None)
         ax[pn] = sns.pointplot(x="variable", y="value", data=df2, ci=None, color ="steelblue", markers='D', scale = 1.2)
@@ -94,9 +90,9 @@ for pn in range(nplots):
         ax[pn].set_ylabel('Cumulative infections, 1 Dec 2020 - 1 Mar 2021')
         ax[pn].set_xlabel('Symptomatic testing rate')
 
-cv.savefig(f'{figsfolder}/fig4_multiscens.pdf')
+ft.savefig(f'{figsfolder}/fig4_multiscens.pdf')
 
-print([np.median(cuminf[tn]) for tn in range(len(thresholds))])
-print([np.quantile(cuminf[tn],q=0.025) for tn in range(len(thresholds))])
-print([np.quantile(cuminf[tn],q=0.975) for tn in range(len(thresholds))])
-sc.toc(T)
\ No newline at end of file
+cuminf_q = np.nanquantile(cuminf, [0.5, 0.025, 0.975], axis=1) # Median and 95% interval for every threshold at once
+for q in cuminf_q:
+    print(list(q))
+ft.toc(T)
\ No newline at end of file
@@ -1,6 +1,3 @@
-import covasim as cv
-import pandas as pd
-import sciris as sc
 import pylab as pl
 import numpy as np
 from matplotlib import ticker
@@ -8,31 +5,35 @@ import datetime as dt
 import matplotlib.patches as patches
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
+from vietnam_calendar import calendar as cal
+from resultstore import Results
+import metrics
+from summaries import summarize
+import figtools as ft
 
 # Filepaths
 figsfolder = 'figs234'
 resfolder = 'results'
-simsfilepath = f'{resfolder}/vietnam_sim.obj'
 borders_open = '2020-12-01'
 
-T = sc.tic()
+T = ft.tic()
 
 # Define plotting functions
 #%% Helper functions
 
-def format_ax(ax, sim, key=None):
+def format_ax(ax, key=None):
     @ticker.FuncFormatter
     def date_formatter(x, pos):
-        return (sim['start_day'] + dt.timedelta(days=x)).strftime('%b-%y')
+        return (cal.start_day + dt.timedelta(days=x)).strftime('%b-%y')
     ax.xaxis.set_major_formatter(date_formatter)
-    pl.xlim([0, sim['n_days']])
+    pl.xlim([0, cal.days['final_day']])
     return
 
-def plotter(key, sims, ax, ys=None, calib=False, label='', ylabel='', low_q=0.025, high_q=0.975, flabel=True, startday=None, subsample=2, chooseseed=None):
+def plotter(key, res, ax, ys=None, calib=False, label='', ylabel='', low_q=0.025, high_q=0.975, flabel=True, startday=None, subsample=2, chooseseed=None):
 
     which = key.split('_')[1]
     try:
-        color = cv.get_colors()[which]
+        color = ft.colors[which]
     except:
         color = [0.5,0.5,0.5]
     if which == 'diagnoses':
@@ -40,31 +41,32 @@ def plotter(key, sims, ax, ys=None, calib=False, label='', ylabel='', low_q=0.02
     elif which == '':
         color = [0.82400815, 0.        , 0.        , 1.        ]
 
-    if ys is None:
-        ys = []
-        for s in sims:
-            ys.append(s.results[key].values)
-
-    yarr = np.array(ys)
+    # Use the store's cached summary if it has these quantiles, otherwise compute the bands from the runs
+    band = None
+    if ys is None and chooseseed is None:
+        band = summarize(res.folder).band(key, [0.5, low_q, high_q])
+    if band is None:
+        if ys is None:
+            ys = res[key]
+        band = metrics.bands(ys, quantiles=[0.5, low_q, high_q])
     if chooseseed is not None:
-        best = sims[chooseseed].results[key].values
+        best = np.asarray(ys[chooseseed])
     else:
-        best = pl.median(yarr, axis=0)
-    low  = pl.quantile(yarr, q=low_q, axis=0)
-    high = pl.quantile(yarr, q=high_q, axis=0)
-
-    sim = sims[0] # For having a sim to refer to
+        best = band['best']
+    low  = band['low']
+    high = band['high']
 
     tvec = np.arange(len(best))
-    if key in sim.data:
-        data_t = np.array((sim.data.index-sim['start_day'])/np.timedelta64(1,'D'))
+    data = cal.column(key)
+    if data is not None:
+        data_t = cal.data_days()
         inds = np.arange(0, len(data_t), subsample)
-        pl.plot(data_t[inds], sim.data[key][inds], 'd', c=color, markersize=10, alpha=0.5, label='Data')
+        pl.plot(data_t[inds], data[inds], 'd', c=color, markersize=10, alpha=0.5, label='Data')
 
     start = None
     if startday is not None:
-        start = sim.day(startday)
-    end = sim.day('2021-03-31')
+        start = cal.day(startday)
+    end = cal.day('2021-03-31')
     if flabel:
         if which == 'infections':
             fill_label = '95% projected interval'
@@ -74,12 +76,12 @@ def plotter(key, sims, ax, ys=None, calib=False, label='', ylabel='', low_q=0.02
         fill_label = None
     pl.fill_between(tvec[startday:end], low[startday:end], high[startday:end], facecolor=color, alpha=0.2, label=fill_label)
     pl.plot(tvec[startday:end], best[startday:end], c=color, label=label, lw=4, alpha=1.0)
-    #for s in sims:
-    #    pl.plot(tvec[startday:end], s.results[key].values[startday:end], c=[0.4, 0.4, 0.4], label=label, lw=1, alpha=0.7)
+    #for y in yarr:
+    #    pl.plot(tvec[startday:end], y[startday:end], c=[0.4, 0.4, 0.4], label=label, lw=1, alpha=0.7)
 
     #sc.setylim()
 
-    datemarks = pl.array([sim.day('2020-07-01'),sim.day('2020-09-01'),sim.day('2020-11-01'),sim.day('2021-01-01')])*1.
+    datemarks = pl.array([cal.day('2020-07-01'),cal.day('2020-09-01'),cal.day('2020-11-01'),cal.day('2021-01-01')])*1.
     ax.set_xticks(datemarks)
 
     pl.ylabel(ylabel)
@@ -110,17 +112,12 @@ nplots = nrows * ncols
 ax = {}
 
 
-# Import files
-filepaths = [f'{resfolder}/vietnam_sim_{policy}.obj' for policy in ['remain','drop','dynamic']]
-sims = []
-for fp in filepaths:
-    simsfile = sc.loadobj(fp)
-    sims.append(simsfile.sims)
-sim = sims[0][0] # Extract a sim to refer to
+# Open the result stores; only the keys that are plotted are read from disk
+stores = [Results(f'{resfolder}/vietnam_sim_{policy}') for policy in ['remain','drop','dynamic']]
 
 colors = [[0.03137255, 0.37401   , 0.63813918, 1.        ], '#c75649']
 linecolor = [0, 0, 0]
-importday = sim.day('2020-12-01')
+importday = cal.day('2020-12-01')
 
 # Add text
 headings =["    Constant high compliance   ",
@@ -138,17 +135,17 @@ for nc in range(ncols):
 
 for pn in range(nplots):
     ax[pn] = pl.axes([xgapl + (dx + xgapm) * (pn % ncols), ygapb + (ygapm + dy) * (pn // ncols), dx, dy])
-    format_ax(ax[pn], sim)
+    format_ax(ax[pn])
     ax[pn].axvline(importday, c=linecolor, linestyle='--', alpha=0.4, lw=3)
 
     if pn in range(ncols):
-        plotter('new_diagnoses', sims[(pn%ncols)], ax[pn])
+        plotter('new_diagnoses', stores[(pn%ncols)], ax[pn])
         ax[pn].set_ylim(0, 150)
         ax[pn].set_yticks(np.arange(0, 150, 25))
         ax[pn].grid(linestyle=':', linewidth='0.5', color='grey', axis='y')
 #        plt.grid(color='black', which='major', axis='y', linestyle='solid')
     else:
-        plotter('n_exposed', sims[(pn%ncols)], ax[pn])
+        plotter('n_exposed', stores[(pn%ncols)], ax[pn])
         ax[pn].set_xticklabels([])
         ax[pn].set_ylim(0, 3000)
         ax[pn].set_yticks(np.arange(0, 3000, 500))
@@ -159,7 +156,7 @@ for pn in range(nplots):
     else:
         ax[pn].set_ylabel('Daily diagnoses') if pn == 0 else ax[pn].set_ylabel('Active infections')
 
-cv.savefig(f'{figsfolder}/fig3_scenarios.pdf')
+ft.savefig(f'{figsfolder}/fig3_scenarios.pdf')
 
 
-sc.toc(T)
\ No newline at end of file
+ft.toc(T)
\ No newline at end of file
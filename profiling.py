@@ -0,0 +1,283 @@
+'''
+Opt-in profiler for the intervention stack of a sim. When enabled in a
+process, it records the wall time and number of calls of each intervention,
+each intervention's trigger, each analyzer, and the phases of every step --
+updating states before and after the interventions, updating contacts, and
+the rest of the step (transmission and counting the results) -- for each
+simulated day. It works by wrapping the methods of the Covasim classes in the
+process the first time it's enabled; when it isn't, nothing is wrapped, and
+once it has been, each wrapper only checks a global before calling through.
+
+Sweeps are profiled with sweep.profile(folder): every job of every later sweep
+then returns its profile along with its results, and the profiles of all the
+runs are summed into a JSON report per sweep (see Report).
+
+**Example**::
+
+    profiling.enable()
+    sim = vm.make_sim(seed=1, beta=0.0135)
+    sim.run()
+    report = profiling.Report()
+    report.add(profiling.take())
+    report.save('results/profile/one_run.json')
+'''
+
+import os
+import json
+import time
+import functools
+import numpy as np
+import covasim as cv
+
+_collector = None # The profile being recorded in this process, if any
+_patched = set() # Classes whose methods have been wrapped
+phases = ['update_states_pre', 'update_contacts', 'update_states_post'] # People methods timed as phases of the step
+
+
+class Collector:
+    ''' Time and calls by name and day for the runs in one job '''
+
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+        self.kinds = {}
+        self.day = 0
+        self.names = {} # Name of each intervention and analyzer of the sim being stepped, by id
+        self.current = None # Name of the intervention being applied, for its trigger
+        self.depth = {} # How deeply each name is nested, so that methods calling each other are only counted once
+        self.n_runs = 0
+        return
+
+
+    def record(self, name, kind, elapsed):
+        if name not in self.times:
+            self.times[name] = np.zeros(1)
+            self.calls[name] = np.zeros(1, dtype=int)
+            self.kinds[name] = kind
+        if self.day >= len(self.times[name]):
+            n = max(self.day+1, 2*len(self.times[name]))
+            self.times[name] = np.concatenate([self.times[name], np.zeros(n-len(self.times[name]))])
+            self.calls[name] = np.concatenate([self.calls[name], np.zeros(n-len(self.calls[name]), dtype=int)])
+        self.times[name][self.day] += elapsed
+        self.calls[name][self.day] += 1
+        return
+
+
+    def to_json(self):
+        n = {name:np.flatnonzero(calls)[-1]+1 if calls.any() else 0 for name,calls in self.calls.items()} # Drop the unused days at the end
+        return dict(n_runs=self.n_runs, rows={name:dict(kind=self.kinds[name], time=self.times[name][:n[name]].tolist(), calls=self.calls[name][:n[name]].tolist()) for name in self.times})
+
+
+def _timed(name, kind, func, *args, **kwargs):
+    ''' Call func and record its time under name, unless it's nested within another call recorded under the same name '''
+    c = _collector
+    depth = c.depth.get(name, 0)
+    c.depth[name] = depth + 1
+    t0 = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        c.depth[name] = depth
+        if not depth:
+            c.record(name, kind, time.perf_counter() - t0)
+
+
+def _wrap_step(step):
+    @functools.wraps(step)
+    def wrapper(sim, *args, **kwargs):
+        c = _collector
+        if c is None:
+            return step(sim, *args, **kwargs)
+        if sim.t == 0:
+            c.n_runs += 1
+        c.day = sim.t
+        c.names = {}
+        for kind,key in [('intervention', 'interventions'), ('analyzer', 'analyzers')]:
+            for i,obj in enumerate(sim[key]):
+                if isinstance(obj, (cv.Intervention, cv.Analyzer)):
+                    c.names[id(obj)] = f'{kind} {i}: {getattr(obj, "label", None) or type(obj).__name__}'
+                    _patch_apply(type(obj), kind)
+                    trigger = getattr(obj, 'trigger', None)
+                    if trigger is not None:
+                        _patch_trigger(type(trigger))
+        return _timed('step', 'total', step, sim, *args, **kwargs)
+    return wrapper
+
+
+def _wrap_phase(name, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if _collector is None:
+            return method(*args, **kwargs)
+        return _timed(name, 'phase', method, *args, **kwargs)
+    return wrapper
+
+
+def _wrap_apply(kind, apply):
+    @functools.wraps(apply)
+    def wrapper(obj, *args, **kwargs):
+        c = _collector
+        if c is None or id(obj) not in c.names:
+            return apply(obj, *args, **kwargs)
+        name = c.names[id(obj)]
+        outer = c.current
+        c.current = name
+        try:
+            return _timed(name, kind, apply, obj, *args, **kwargs)
+        finally:
+            c.current = outer
+    return wrapper
+
+
+def _wrap_trigger(method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        c = _collector
+        if c is None or c.current is None:
+            return method(*args, **kwargs)
+        return _timed(f'{c.current} trigger', 'trigger', method, *args, **kwargs)
+    return wrapper
+
+
+def _patch_apply(cls, kind):
+    if cls not in _patched:
+        cls.apply = _wrap_apply(kind, cls.apply)
+        _patched.add(cls)
+    return
+
+
+def _patch_trigger(cls):
+    ''' Wrap every public method of a trigger class, since it's the trigger's own business which of them the intervention calls '''
+    if cls not in _patched:
+        for attr,value in list(vars(cls).items()):
+            if callable(value) and (not attr.startswith('_') or attr == '__call__'):
+                setattr(cls, attr, _wrap_trigger(value))
+        _patched.add(cls)
+    return
+
+
+def enable():
+    ''' Start recording a profile in this process, wrapping the Covasim classes the first time '''
+    global _collector
+    if cv.Sim not in _patched:
+        cv.Sim.step = _wrap_step(cv.Sim.step)
+        for name in phases:
+            setattr(cv.People, name, _wrap_phase(name, getattr(cv.People, name)))
+        _patched.add(cv.Sim)
+    _collector = Collector()
+    return
+
+
+def take():
+    ''' Stop recording and return the profile recorded since enable(), as a JSON-able dict '''
+    global _collector
+    c = _collector
+    _collector = None
+    return c.to_json() if c is not None else None
+
+
+def profiled(func, job):
+    ''' Run a sweep job with the profiler on, adding its profile to the result under "profile"; see sweep.profile() '''
+    enable()
+    try:
+        result = func(job)
+    finally:
+        profile = take()
+    return dict(result, profile=profile)
+
+
+class Report:
+    '''
+    The profiles of many runs, summed by name and day; a run is counted each
+    time a sim steps from day 0, so a forked run and its branches count once.
+    Besides the recorded rows, the report gives "interventions" (all of them
+    together) and "transmission and results" (the rest of each step: computing
+    viral loads and infections and updating the result counts). A trigger's
+    time is also included in the time of its intervention.
+    '''
+
+    def __init__(self):
+        self.n_runs = 0
+        self.n_jobs = 0
+        self.times = {}
+        self.calls = {}
+        self.kinds = {}
+        return
+
+
+    def add(self, profile):
+        ''' Add the profile returned by take() '''
+        if not profile:
+            return
+        self.n_jobs += 1
+        self.n_runs += profile['n_runs']
+        for name,row in profile['rows'].items():
+            t = np.array(row['time'])
+            n = np.array(row['calls'])
+            if name not in self.times:
+                self.times[name] = np.zeros(0)
+                self.calls[name] = np.zeros(0, dtype=int)
+                self.kinds[name] = row['kind']
+            size = max(len(t), len(self.times[name]))
+            self.times[name] = np.pad(self.times[name], (0, size-len(self.times[name]))) + np.pad(t, (0, size-len(t)))
+            self.calls[name] = np.pad(self.calls[name], (0, size-len(self.calls[name]))) + np.pad(n, (0, size-len(n)))
+        return
+
+
+    def rows(self):
+        ''' Per-day times and calls by name, including the derived rows '''
+        times = dict(self.times)
+        calls = dict(self.calls)
+        kinds = dict(self.kinds)
+        if 'step' in times:
+            n = len(times['step'])
+            def padded(t):
+                return np.pad(t, (0, n-len(t)))[:n]
+            interventions = [name for name,kind in kinds.items() if kind == 'intervention']
+            times['interventions'] = sum((padded(times[name]) for name in interventions), np.zeros(n))
+            calls['interventions'] = calls['step'].copy()
+            kinds['interventions'] = 'phase'
+            accounted = times['interventions'] + sum((padded(times[name]) for name,kind in kinds.items() if kind in ['phase', 'analyzer'] and name != 'interventions'), np.zeros(n))
+            times['transmission and results'] = times['step'] - accounted
+            calls['transmission and results'] = calls['step'].copy()
+            kinds['transmission and results'] = 'phase'
+        return times, calls, kinds
+
+
+    def to_json(self):
+        times, calls, kinds = self.rows()
+        step = times['step'].sum() if 'step' in times else np.nan
+        rows = {}
+        for name in sorted(times, key=lambda name: -times[name].sum()):
+            total = float(times[name].sum())
+            rows[name] = dict(
+                kind       = kinds[name],
+                total      = total,
+                calls      = int(calls[name].sum()),
+                per_run    = total/max(self.n_runs, 1),
+                share      = total/step,
+                per_call   = total/max(calls[name].sum(), 1),
+                day_time   = (times[name]/max(self.n_runs, 1)).tolist(), # Mean time per run on each day
+                day_calls  = calls[name].tolist(),
+            )
+        return dict(n_runs=self.n_runs, n_jobs=self.n_jobs, rows=rows)
+
+
+    def save(self, filename):
+        ''' Write the report as JSON '''
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(self.to_json(), f, indent=1)
+        return filename
+
+
+    def print(self, n=20):
+        ''' Print the rows taking the most time '''
+        rows = self.to_json()['rows']
+        print(f'Profile of {self.n_runs} runs')
+        print(f'{"":45s} {"kind":>12s} {"total (s)":>10s} {"per run (s)":>12s} {"% of step":>10s} {"calls":>10s} {"per call (ms)":>14s}')
+        for name,r in list(rows.items())[:n]:
+            print(f'{name[:45]:45s} {r["kind"]:>12s} {r["total"]:10.2f} {r["per_run"]:12.4f} {r["share"]*100:10.1f} {r["calls"]:10d} {r["per_call"]*1e3:14.3f}')
+        return
@@ -0,0 +1,117 @@
+'''
+Streaming median and quantile bands for batches of sims. Runs are folded in one
+at a time as they finish and can then be dropped, so a batch of any size is
+reduced in bounded memory: quantiles are exact while the batch is no bigger
+than the reservoir, and beyond that are computed from a uniform random sample
+of whole runs (reservoir sampling), which has the same statistical error as a
+batch of that size.
+'''
+
+import numpy as np
+
+
+class QuantileReducer:
+    '''
+    Per-day quantiles of each result key across a stream of runs.
+
+    Args:
+        keys (list): the result keys to reduce
+        quantiles (list): the quantiles to compute; the defaults give the median and 95% interval
+        max_runs (int): size of the reservoir, i.e. the largest batch reduced exactly
+        seed (int): random seed for choosing which runs are kept once the reservoir is full
+
+    **Example**::
+
+        reducer = QuantileReducer(['new_diagnoses'])
+        for results in stream:
+            reducer.add(results)
+        band = reducer.reduce('new_diagnoses') # band['best'], band['low'], band['high']
+    '''
+
+    def __init__(self, keys, quantiles=(0.5, 0.025, 0.975), max_runs=2000, seed=0):
+        self.keys = list(keys)
+        self.quantiles = list(quantiles)
+        self.max_runs = max_runs
+        self.rng = np.random.RandomState(seed)
+        self.n = 0 # Number of runs folded in
+        self.reservoir = None # Allocated once the number of days is known
+        return
+
+
+    def __len__(self):
+        return self.n
+
+
+    @property
+    def exact(self):
+        ''' Whether every run is still held, so the quantiles are exact '''
+        return self.n <= self.max_runs
+
+
+    def add(self, results):
+        '''
+        Fold in one run.
+
+        Args:
+            results (dict): arrays of values by result key, e.g. a record's "results"
+        '''
+        if self.reservoir is None:
+            self.reservoir = {key:np.empty((self.max_runs, len(results[key]))) for key in self.keys}
+        if self.n < self.max_runs:
+            row = self.n
+        else:
+            row = self.rng.randint(self.n+1) # Keep each of the n+1 runs seen so far with equal probability
+        if row < self.max_runs:
+            for key in self.keys:
+                self.reservoir[key][row,:] = results[key]
+        self.n += 1
+        return
+
+
+    def add_record(self, record):
+        ''' Fold in a record returned by a sweep job, for use as run_sweep(on_result=...) '''
+        return self.add(record['results'])
+
+
+    def add_rows(self, arrays, chunk=200):
+        '''
+        Fold in every row of a set of (n_runs, n_days) arrays, e.g. memory-mapped
+        from a result store, a block of rows at a time.
+        '''
+        n_rows = len(arrays[self.keys[0]])
+        for start in range(0, n_rows, chunk):
+            block = {key:np.asarray(arrays[key][start:start+chunk]) for key in self.keys}
+            for i in range(len(block[self.keys[0]])):
+                self.add({key:block[key][i] for key in self.keys})
+        return
+
+
+    def values(self, key):
+        ''' The runs held for this key: all of them, or the reservoir sample '''
+        return self.reservoir[key][:min(self.n, self.max_runs)]
+
+
+    def quantile(self, key, q):
+        ''' Per-day quantile q of this key '''
+        return np.quantile(self.values(key), q, axis=0)
+
+
+    def reduce(self, key):
+        '''
+        The per-day quantiles of this key.
+
+        Returns:
+            dict with best (the first quantile, by default the median), low and high (the next two), and all quantiles by value under "quantiles"
+        '''
+        qvals = np.quantile(self.values(key), self.quantiles, axis=0)
+        band = dict(quantiles={q:v for q,v in zip(self.quantiles, qvals)})
+        for name,v in zip(['best', 'low', 'high'], qvals):
+            band[name] = v
+        return band
+
+
+def reduce_store(res, keys, **kwargs):
+    ''' Build a QuantileReducer for these keys from a resultstore.Results, reading the arrays in blocks '''
+    reducer = QuantileReducer(keys, **kwargs)
+    reducer.add_rows({key:res[key] for key in keys})
+    return reducer
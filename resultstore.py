@@ -0,0 +1,149 @@
+'''
+Columnar store for batches of sim results. Each result key is saved as its own
+(n_sims, n_days) .npy array, written one row at a time as sims finish, with the
+per-sim metadata (beta, seed, policy, ...) in a small JSON file alongside. The
+plotting scripts memory-map just the keys they need instead of unpickling every
+sim.
+'''
+
+import os
+import json
+import numpy as np
+
+# Result keys saved by default: everything the runners and plotting scripts use
+default_keys = ['new_infections', 'cum_infections', 'new_diagnoses', 'cum_diagnoses',
+                'new_deaths', 'cum_deaths', 'n_exposed', 'n_infectious']
+
+metafile = 'meta.json'
+
+
+class ResultsWriter:
+    '''
+    Write sim results into a columnar store as they arrive.
+
+    Args:
+        folder (str): the folder for the store, e.g. results/vietnam_sim_remain
+        n_sims (int): the number of rows to allocate
+        keys (list): the result keys to store
+        meta (dict): metadata for the whole batch, e.g. the policy
+    '''
+
+    def __init__(self, folder, n_sims, keys=None, meta=None):
+        self.folder = folder
+        self.n_sims = n_sims
+        self.keys   = list(keys) if keys is not None else default_keys
+        self.meta   = dict(meta) if meta else {}
+        self.rows   = [] # Metadata for each row, in the order written
+        self.arrays = None # Allocated once the number of days is known
+        os.makedirs(folder, exist_ok=True)
+        self.write_meta(complete=False) # Mark the store as incomplete before any arrays are overwritten
+        return
+
+
+    def write_meta(self, complete, n_days=0):
+        ''' Write the metadata file; Results refuses to read a store that is not marked complete '''
+        meta = dict(complete=complete, keys=self.keys, n_sims=len(self.rows), n_days=n_days, batch=self.meta, rows=self.rows)
+        with open(os.path.join(self.folder, metafile), 'w') as f:
+            json.dump(meta, f, default=float)
+        return
+
+
+    def allocate(self, n_days):
+        ''' Create the memory-mapped arrays on disk '''
+        self.arrays = {}
+        for key in self.keys:
+            self.arrays[key] = np.lib.format.open_memmap(os.path.join(self.folder, f'{key}.npy'), mode='w+', dtype=np.float64, shape=(self.n_sims, n_days))
+        return
+
+
+    def add(self, results, **rowmeta):
+        '''
+        Write one sim's results to the next row.
+
+        Args:
+            results (dict): arrays of values by result key, e.g. from get_results()
+            rowmeta (dict): metadata for this row, e.g. beta and seed
+        '''
+        if len(self.rows) >= self.n_sims:
+            raise IndexError(f'All {self.n_sims} rows of {self.folder} have already been written')
+        if self.arrays is None:
+            self.allocate(len(results[self.keys[0]]))
+        row = len(self.rows)
+        for key in self.keys:
+            self.arrays[key][row,:] = results[key]
+        self.rows.append(rowmeta)
+        return row
+
+
+    def add_record(self, record):
+        ''' Add a record returned by a sweep job: its "results" are written and its other fields become the row metadata '''
+        rowmeta = {k:v for k,v in record.items() if k != 'results'}
+        return self.add(record['results'], **rowmeta)
+
+
+    def close(self):
+        ''' Flush the arrays and write the metadata, marking the store complete; only rows that were written are kept '''
+        n_days = 0
+        if self.arrays is not None:
+            n_days = self.arrays[self.keys[0]].shape[1]
+            for arr in self.arrays.values():
+                arr.flush()
+            self.arrays = None
+        self.write_meta(complete=True, n_days=n_days)
+        return
+
+
+class Results:
+    '''
+    Read-only access to a store written by ResultsWriter. Arrays are memory-mapped
+    on first access, so only the keys that are used are ever read from disk.
+
+    Args:
+        folder (str): the folder of the store
+
+    Raises:
+        RuntimeError: if the writer was interrupted before closing the store
+
+    **Example**::
+
+        res = Results('results/vietnam_sim_remain')
+        diagnoses = res['new_diagnoses'] # Array of shape (n_sims, n_days)
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, metafile)) as f:
+            meta = json.load(f)
+        if not meta.get('complete'):
+            raise RuntimeError(f'The store in {folder} is incomplete: it was not closed after its last write, so rerun the batch that writes it')
+        self.keys   = meta['keys']
+        self.n_sims = meta['n_sims']
+        self.n_days = meta['n_days']
+        self.batch  = meta['batch']
+        self.rows   = meta['rows']
+        self._arrays = {}
+        return
+
+
+    def __len__(self):
+        return self.n_sims
+
+
+    def __getitem__(self, key):
+        if key not in self._arrays:
+            if key not in self.keys:
+                raise KeyError(f'Result "{key}" is not in {self.folder}; available keys are {self.keys}')
+            self._arrays[key] = np.load(os.path.join(self.folder, f'{key}.npy'), mmap_mode='r')[:self.n_sims]
+        return self._arrays[key]
+
+
+    def column(self, field):
+        ''' An array of one metadata field across all rows, e.g. res.column('beta') '''
+        return np.array([row.get(field, np.nan) for row in self.rows])
+
+
+def get_results(sim, keys=None):
+    ''' Pull the result arrays to store out of a finished sim '''
+    if keys is None:
+        keys = default_keys
+    return {key:np.array(sim.results[key].values) for key in keys}
@@ -2,38 +2,68 @@
 This script contains analyses for the paper:
 "Lessons learned from Vietnam's COVID-19 response:
 the role of adaptive behaviour change in epidemic control"
+
+Run any of the stages from the command line, e.g.
+
+    python run_vietnam_central.py fitting mainscens testingscens
+
+Stages are run in a single process in dependency order: asking for mainscens
+also runs fitting if its output is missing or out of date. Stages whose inputs
+(settings, data and model code, and the outputs of the stages they depend on)
+haven't changed since they last ran are skipped; use --force to rerun them.
+With no arguments, runs quickfit.
 '''
 
+import os
+import json
+import hashlib
+import argparse
 import covasim as cv
 import covasim.utils as cvu
 import sciris as sc
 import pylab as pl
 import numpy as np
+import vietnam_model as vm
+from vietnam_model import make_sim, copy_sim
+from vietnam_calendar import calendar
+from sweep import Checkpoint, run_sweep, distribute, profile
+from pipeline import Pipeline
+import calibration as cal
+import adaptive
+import scenarios as scen
+from resultstore import Results
+import memory
+import runcache
+import metrics
 
 
 ########################################################################
 # Settings
 ########################################################################
-T = sc.tic()
-cv.check_save_version()
 
-# Define what to run. All analyses are contained in this single script; the idea if that these should be run sequentially
+# Available stages. All analyses are contained in this single script; the idea if that these should be run sequentially
 runoptions = ['quickfit', # Does a quick preliminary calibration. Quick to run, ~30s
               'plotpeople', # Plots the people -- not currently implemented
               'fitting',  # Searches over parameters and seeds (10,000 runs) and calculates the mismatch for each. Slow to run: ~1hr on Athena
-              'finialisecalibration', # Filters the 10,000 runs from the previous step, selects the best-fitting ones, and runs these. Creates a file "vietnam_sim.obj" used by plot_vietnam_calibration for Figure 2
-              'mainscens', # Takes the best-fitting runs and projects these forward under different border-reopening scenarios. Creates files "vietnam_sim_drop.obj", "vietnam_sim_remain.obj" and "vietnam_sim_dynamic.obj" used by plot_vietnam_scenarios for Figure 3
-              'testingscens'] # Takes the best-fitting runs and projects these forward under different testing scenarios. Creates files "vietnam_sim_{XXX}.obj" used by plot_vietnam_multiscens for Figure 4
-whattorun = runoptions[0] #Select which of the above to run
+              'finialisecalibration', # Filters the 10,000 runs from the previous step, selects the best-fitting ones, and runs these. Creates the result store "results/vietnam_sim" used by plot_vietnam_calibration for Figure 2
+              'mainscens', # Takes the best-fitting runs and projects these forward under different border-reopening scenarios. Creates the result stores "results/vietnam_sim_drop", "vietnam_sim_remain" and "vietnam_sim_dynamic" used by plot_vietnam_scenarios for Figure 3
+              'testingscens', # Takes the best-fitting runs and projects these forward under different testing scenarios. Creates the result stores "results/vietnam_sim_{XXX}" used by plot_vietnam_multiscens for Figure 4
+              'allscens'] # Runs mainscens and testingscens together as a single batch on the worker pool, which avoids the pool draining between scenarios
+sweep_stages = runoptions[2:] # The stages that run their sims on the worker pool
 
 # Settings for plotting and saving
 do_plot = True
 do_save = True
-save_sim = True
-keep_people = True
 n_runs = 500
+ncpus = None # Number of worker processes for the sweeps (None = all cores)
+n_agents = 100e3 # Number of agents; set to vm.total_pop (11.9 million) to simulate everyone, with no rescaling
+distribute_port = None # If set, hand out the sweep jobs to workers on any host connecting on this port (see distributed.py) rather than running them on this machine
+memory_budget = None # Memory the runs may use, in bytes (None = 80% of physical memory); fewer workers are used if all of them wouldn't fit
+shared_population = True # Keep one copy of the population's read-only arrays in shared memory for all the workers, rather than one per worker and run
+profile_folder = None # If set (e.g. 'results/profile'), time each intervention, trigger and step phase of every run by day, and write a JSON report per sweep to this folder
 today = '2020-10-15'
-resfolder = 'results'
+resfolder = 'results' if n_agents == 100e3 else f'results/agents{n_agents:.0f}' # Keep results at other scales apart
+stage_files = ['calibration.py', 'adaptive.py', 'scenarios.py', 'sharedpeople.py', 'runcache.py', 'resultstore.py'] # Code the stages run besides the model itself (runcache.source_files)
 
 to_plot = sc.objdict({
     'Cumulative diagnoses': ['cum_diagnoses'],
@@ -47,108 +77,32 @@ to_plot = sc.objdict({
 # Calibration parameters
 betas = [i / 10000 for i in range(130, 140, 1)]
 change = 0.42
-
-
-########################################################################
-# Make the sim
-########################################################################
-def make_sim(seed, beta, change=0.42, policy='remain', threshold=5, symp_prob=0.01, end_day=None):
-
-    start_day = '2020-06-15'
-    if end_day is None: end_day = '2021-04-30'
-    total_pop = 11.9e6 # Population of central Vietnam
-    n_agents = 100e3
-    pop_scale = total_pop/n_agents
-
-    # Calibration parameters
-    pars = {'pop_size': n_agents,
-            'pop_infected': 0,
-            'pop_scale': pop_scale,
-            'rand_seed': seed,
-            'beta': beta,
-            'start_day': start_day,
-            'end_day': end_day,
-            'verbose': 0,
-            'rescale': True,
-            'iso_factor': dict(h=0.5, s=0.01, w=0.01, c=0.1),  # Multiply beta by this factor for people in isolation
-            'quar_factor': dict(h=1.0, s=0.2, w=0.2, c=0.2),   # Multiply beta by this factor for people in quarantine
-            'location': 'vietnam',
-            'pop_type': 'hybrid',
-            'age_imports': [50,80],
-            'rel_crit_prob': 1.75, # Calibration parameter due to hospital outbreak
-            'rel_death_prob': 2., # Calibration parameter due to hospital outbreak
-            }
-
-    # Make a sim without parameters, just to load in the data to use in the testing intervention and to get the sim days
-    sim = cv.Sim(start_day=start_day, datafile="vietnam_data.csv")
-
-    # Set up import assumptions
-    pars['dur_imports'] = sc.dcp(sim.pars['dur'])
-    pars['dur_imports']['exp2inf']  = {'dist':'lognormal_int', 'par1':0.0, 'par2':0.0}
-    pars['dur_imports']['inf2sym']  = {'dist':'lognormal_int', 'par1':0.0, 'par2':0.0}
-    pars['dur_imports']['sym2sev']  = {'dist':'lognormal_int', 'par1':0.0, 'par2':2.0}
-    pars['dur_imports']['sev2crit'] = {'dist':'lognormal_int', 'par1':1.0, 'par2':3.0}
-    pars['dur_imports']['crit2die'] = {'dist':'lognormal_int', 'par1':3.0, 'par2':3.0}
-
-    # Define import array
-    import_end   = sim.day('2020-07-15')
-    border_start = sim.day('2020-11-30') # Open borders for one month
-    border_end   = sim.day('2020-12-31') # Then close them again
-    final_day_ind  = sim.day('2021-04-30')
-    imports = np.concatenate((np.array([1, 0, 0, 0, 2, 2, 8, 4, 1, 1, 0, 0, 0, 0, 3, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 2, 3, 1, 1, 3, 0, 3, 0, 1, 6, 1, 5, 0, 0]), # Generated from cv.n_neg_binomial(1, 0.25) but then hard-copied to remove variation when calibrating
-                              pl.zeros(border_start-import_end), # No imports from the end of the 1st importation window to the border reopening
-                              cv.n_neg_binomial(1, 0.25, border_end-border_start), # Negative-binomial distributed importations each day
-                              pl.zeros(final_day_ind-border_end)
-                              ))
-    pars['n_imports'] = imports
-
-    # Add testing and tracing interventions
-    trace_probs = {'h': 1, 's': 0.95, 'w': 0.8, 'c': 0.05}
-    trace_time  = {'h': 0, 's': 2, 'w': 2, 'c': 5}
-    pars['interventions'] = [
-        # Testing and tracing
-        cv.test_num(daily_tests=sim.data['new_tests'].rolling(3).mean(), start_day=2, end_day=sim.day('2020-08-22'), symp_test=80, quar_test=80, do_plot=False),
-        cv.test_prob(start_day=sim.day('2020-08-23'), end_day=sim.day('2020-11-30'), symp_prob=0.05, asymp_quar_prob=0.5, do_plot=False),
-        cv.test_prob(start_day=sim.day('2020-12-01'), symp_prob=symp_prob, asymp_quar_prob=0.5,
-                     trigger=cv.trigger('date_diagnosed', 5), triggered_vals={'symp_prob':0.2}, do_plot=False),
-        cv.contact_tracing(start_day=0, trace_probs=trace_probs, trace_time=trace_time, do_plot=False),
-
-        # Change death and critical probabilities
-        cv.dynamic_pars({'rel_death_prob':{'days':sim.day('2020-08-31'), 'vals':1.0},'rel_crit_prob':{'days':sim.day('2020-08-31'), 'vals':1.0}},do_plot=False), # Assume these were elevated due to the hospital outbreak but then would return to normal
-
-        # Increase precautions (especially mask usage) following the outbreak, which are then abandoned after 40 weeks of low case counts
-        cv.change_beta(days=0, changes=change, trigger=cv.trigger('date_diagnosed', 5)),
-
-        # Close schools and workplaces
-        cv.clip_edges(days=['2020-07-28', '2020-09-14'], changes=[0.1, 1.], layers=['s'], do_plot=True),
-        cv.clip_edges(days=['2020-07-28', '2020-09-05'], changes=[0.1, 1.], layers=['w'], do_plot=False),
-
-        # Dynamically close them again if cases go over the threshold
-        cv.clip_edges(days=[170], changes=[0.1], layers=['s'], trigger=cv.trigger('date_diagnosed', threshold)),
-        cv.clip_edges(days=[170], changes=[0.1], layers=['w'], trigger=cv.trigger('date_diagnosed', threshold)),
-    ]
-
-    if policy != 'remain':
-        pars['interventions'] += [cv.change_beta(days=160, changes=1.0, trigger=cv.trigger('date_diagnosed', 2, direction='below', smoothing=28))]
-    if policy == 'dynamic':
-        pars['interventions'] += [cv.change_beta(days=170, changes=change, trigger=cv.trigger('date_diagnosed', threshold)),
-                                  ]
-
-    sim = cv.Sim(pars=pars, datafile="vietnam_data.csv")
-    sim.initialize()
-
-    return sim
+cutoff = 82 # Seeds with a mismatch below this are kept
+early_stop = True # Stop fitting runs as soon as their mismatch can no longer get below the cutoff
+fit_mode = 'grid' # 'grid' runs every beta/seed pair; 'adaptive' shares runs out by acceptance rate until target_accepted runs are accepted
+target_accepted = 500 # For adaptive fitting
+save_states = True # Save the state of each accepted fitting run at the end of the window, so the fit can be warm-started once the data are extended
+min_accepted = 200 # When warm-starting, top up with fresh seeds if fewer runs than this are still accepted
+resume_dates = () # Ends of earlier calibration windows: after extending the data, add the old today here and move today on to warm-start the fit; every run is reseeded on these days
+
+# Scenario parameters
+policies = ['remain','drop','dynamic']
+converge_scenarios = False # Only run as many seeds of each scenario as it takes for the headline numbers to be stable to within converge_rtol
+converge_rtol = 0.05
+paired_scenarios = True # Give the runs of every scenario with the same (beta, seed) the same imports, and report the differences between scenarios run by run
+fork_scenarios = True # Run each (beta, seed) once up to the day the scenarios diverge and branch it from there, rather than running every scenario from the start
+symp_probs = [0.01048074, 0.02206723, 0.0350389 , 0.04979978, 0.06696701] # constructed to give testing rates of 10-50% after 10 days
 
 ########################################################################
 # Define the analyses
 ########################################################################
 
 # Quick calibration
-if whattorun=='quickfit':
-    s0 = make_sim(seed=1, beta=0.0135, change=0.42, end_day=today)
+def quickfit():
+    s0 = make_sim(seed=1, beta=0.0135, change=0.42, end_day=today, n_agents=n_agents)
     sims = []
     for seed in range(10):
-        sim = s0.copy()
+        sim = copy_sim(s0)
         sim['rand_seed'] = seed
         sim.set_seed()
         sims.append(sim)
@@ -159,164 +113,244 @@ if whattorun=='quickfit':
         msim.plot(to_plot=to_plot, do_save=True, do_show=False, fig_path=f'vietnam.png',
                   legend_args={'loc': 'upper left'}, axis_args={'hspace': 0.4}, interval=21)
 
-# Quick calibration
-if whattorun=='plotpeople':
-    sim = make_sim(seed=1, beta=0.0135, change=0.42, end_day=today)
+
+# Plot the people
+def plotpeople():
+    sim = make_sim(seed=1, beta=0.0135, change=0.42, end_day=today, n_agents=n_agents)
     sim.people.plot(do_show=False, do_save=True, fig_path='figs234/figS1_people.pdf')
 
+
 # Full parameter/seed search
-elif whattorun=='fitting':
-    fitsummary = []
-    for beta in betas:
-        sc.blank()
-        print('---------------\n')
-        print(f'Beta: {beta}, change: {change}... ')
-        print('---------------\n')
-        s0 = make_sim(seed=1, beta=beta, change=change, end_day=today)
-        sims = []
-        for seed in range(n_runs):
-            sim = s0.copy()
-            sim['rand_seed'] = seed
-            sim.set_seed()
-            sims.append(sim)
-        msim = cv.MultiSim(sims)
-        msim.run()
-        fitsummary.append([sim.compute_fit().mismatch for sim in msim.sims])
+def fitting():
+    if resume_dates:
+        return warmfitting()
+    if fit_mode == 'adaptive':
+        return adaptivefitting()
+    # All (beta, seed) pairs go into one queue; each finished run is checkpointed, so rerunning after an interruption resumes the sweep
+    checkpoint = Checkpoint(checkpoint_file(f'fitting{change}'), keys=['beta', 'seed'])
+    states = statefolder(today) if save_states else None
+    jobs = cal.fit_jobs(betas, n_runs, change=change, end_day=today, cutoff=cutoff if early_stop else None, n_agents=n_agents, states=states, state_cutoff=cutoff)
+    records = run_sweep(cal.fit_run, jobs, checkpoint=checkpoint, ncpus=ncpus, label='Fitting')
+    fitsummary = cal.make_fitsummary(records, betas, n_runs) # Runs stopped early are recorded with a mismatch of inf
+    stopped = [r['stopped'] for r in records.values() if 'stopped' in r]
+    if stopped:
+        n_days = sc.day(today, start_day='2020-06-15') + 1
+        print(f'{len(stopped)} of {len(records)} runs stopped early, on average after {np.mean(stopped):0.0f} of {n_days} days')
+
+    save_fit(fitsummary)
+    if states:
+        cal.write_states_meta(states, fitsummary, betas, cutoff, end_day=today, change=change, n_agents=n_agents)
+
+
+# Save the fitsummary, along with the importance weight of each beta if the runs weren't shared out equally between them
+def save_fit(fitsummary, weights=None):
+    sc.saveobj(f'{resfolder}/fitsummary{change}.obj', fitsummary)
+    weightfile = f'{resfolder}/fitweights{change}.obj'
+    if weights is not None:
+        sc.saveobj(weightfile, weights)
+    elif os.path.exists(weightfile): # Left by an earlier adaptive fit
+        os.remove(weightfile)
+
+
+# The fitsummary and the weights of its betas (None if they count equally)
+def load_fit():
+    fitsummary = sc.loadobj(f'{resfolder}/fitsummary{change}.obj')
+    weightfile = f'{resfolder}/fitweights{change}.obj'
+    weights = sc.loadobj(weightfile) if os.path.exists(weightfile) else None
+    return fitsummary, weights
+
+
+# Checkpoint file for a fitting sweep, named by a hash of everything its records depend on besides the job fields, so that
+# changing the window, the data, the model code or the population starts a new checkpoint rather than reusing stale mismatches
+def checkpoint_file(name):
+    keyinfo = dict(end_day=today, n_agents=n_agents, resume_dates=resume_dates, shared_triggers=vm.shared_triggers, indexed_tracing=vm.indexed_tracing, cutoff=cutoff if early_stop else None, files=[runcache.file_hash(f) for f in runcache.source_files + stage_files], covasim=cv.__version__)
+    return f'{resfolder}/{name}_{hashlib.md5(json.dumps(keyinfo, sort_keys=True, default=str).encode()).hexdigest()[:12]}.jsonl'
+
+
+# Where the states of the accepted fitting runs are saved at the end of the window ending on this day
+def statefolder(end_day):
+    return f'{resfolder}/states{change}/{end_day}'
+
+
+# Refit after vietnam_data.csv has been extended and today moved on, resuming the accepted runs from the end of the previous window (the last of resume_dates)
+def warmfitting():
+    previous = resume_dates[-1]
+    checkpoint = Checkpoint(checkpoint_file(f'fitting{change}_from{previous}'), keys=['beta', 'seed'])
+    states = statefolder(today) if save_states else None
+    fitsummary = cal.warm_fit(betas, statefolder(previous), change=change, end_day=today, cutoff=cutoff, min_accepted=min_accepted, resume_dates=resume_dates, checkpoint=checkpoint,
+                              states=states, ncpus=ncpus, early_stop=early_stop, n_agents=n_agents)
+    save_fit(fitsummary)
+    if states:
+        cal.write_states_meta(states, fitsummary, betas, cutoff, end_day=today, change=change, n_agents=n_agents, resume_dates=resume_dates)
 
-    sc.saveobj(f'{resfolder}/fitsummary{change}.obj',fitsummary)
+
+# Adaptive parameter/seed search: same output, with nan for the seeds that weren't run, plus the weight of each beta for the later stages to resample the runs by
+def adaptivefitting():
+    checkpoint = Checkpoint(checkpoint_file('fitting_adaptive'), keys=['beta', 'change', 'seed'])
+    sampler = adaptive.adaptive_fit(betas, n_runs, change=change, end_day=today, cutoff=cutoff, target=target_accepted, checkpoint=checkpoint, ncpus=ncpus, early_stop=early_stop, n_agents=n_agents)
+    grid = Checkpoint(checkpoint_file(f'fitting{change}'), keys=['beta', 'seed']) # For comparison, if the grid has been run with the same settings
+    sampler.report(grid_records=list(grid.records.values()))
+    save_fit(sampler.fitsummary(change), sampler.fitweights(change))
 
 
 # Run calibration with best-fitting seeds and parameters
-elif whattorun=='finialisecalibration':
-    sims = []
-    fitsummary = sc.loadobj(f'{resfolder}/fitsummary{change}.obj')
+def finialisecalibration():
+    fitsummary, weights = load_fit()
     for bn, beta in enumerate(betas):
-        goodseeds = [i for i in range(n_runs) if fitsummary[bn][i] < 82]
+        goodseeds = [i for i in range(len(fitsummary[bn])) if fitsummary[bn][i] < cutoff] # Warm fitting may have added seeds
         sc.blank()
         print('---------------\n')
         print(f'Beta: {beta}, change: {change}, goodseeds: {len(goodseeds)}')
         print('---------------\n')
-        if len(goodseeds) > 0:
-            s0 = make_sim(seed=1, beta=beta, change=change, end_day=today)
-            for seed in goodseeds:
-                sim = s0.copy()
-                sim['rand_seed'] = seed
-                sim.set_seed()
-                sims.append(sim)
 
-    msim = cv.MultiSim(sims)
-    msim.run(keep_people=keep_people)
-
-    if keep_people:
-        prop_asymp = []
-        prop_asymp_asymp = []
-        for sim in msim.sims:
-            tt = sim.make_transtree()
-            asymp_count = 0
-            symp_counts = {}
-            asymp_asymp_count = 0
-            minind = -5
-            maxind = 15
-            for _, target_ind in tt.transmissions:
-                dd = tt.detailed[target_ind]
-                date = dd['date']
-                delta = sim.rescale_vec[date] # Increment counts by this much
-                if dd['s']: # If there's a source of the infection (i.e. don't count seed infections)
-
-                    # Loop over all undiagnosed infections after July 25
-                    if tt.detailed[dd['source']]['date'] <= date and tt.detailed[dd['source']]['date'] >= 40 and np.isnan(dd['t']['date_diagnosed']):
-
-                        # Find what date the target was symptomatic
-                        tdate = dd['t']['date_symptomatic']
-
-                        # First, count all the asymptomatic undiagnosed infections
-                        if np.isnan(tdate):
-                            asymp_count += delta
-                        else:
-                            ind = int(date - tdate)
-                            if ind not in symp_counts:
-                                symp_counts[ind] = 0
-                            symp_counts[ind] += delta
-
-                        # Second, count all the asymptomatic undiagnosed infections where the source was also asymptomatic
-                        if np.isnan(dd['s']['date_symptomatic']):
-                            asymp_asymp_count += delta
-
-            prop_asymp.append(asymp_count / (asymp_count + sum(symp_counts.values())))
-            prop_asymp_asymp.append(asymp_asymp_count / asymp_count)
-
-        print(np.median(prop_asymp))
-        print(np.quantile(prop_asymp, q=0.025))
-        print(np.quantile(prop_asymp, q=0.975))
-        print(np.median(prop_asymp_asymp))
-        print(np.quantile(prop_asymp_asymp, q=0.025))
-        print(np.quantile(prop_asymp_asymp, q=0.975))
-
-    if save_sim:
-        msim.save(f'{resfolder}/vietnam_sim.obj')
-    if do_plot:
-        msim.reduce()
-        msim.plot(to_plot=to_plot, do_save=do_save, do_show=False, fig_path=f'vietnam.png',
-                  legend_args={'loc': 'upper left'}, axis_args={'hspace': 0.4}, interval=21)
+    # Each finished run's results are streamed into the store, so the sims are never all held in memory
+    jobs = scen.scenario_jobs(fitsummary, betas, cutoff, change=change, end_day=today, asymp_stats=True, n_agents=n_agents, resume_dates=resume_dates, weights=weights)
+    reducer = scen.run_batch(jobs, f'{resfolder}/vietnam_sim', meta=dict(change=change, end_day=today), ncpus=ncpus, label='Calibration')
+    res = Results(f'{resfolder}/vietnam_sim')
+
+    # The transmission statistics are computed within each run, so the people don't need to be kept
+    prop_asymp = res.column('prop_asymp')
+    prop_asymp_asymp = res.column('prop_asymp_asymp')
+    print(np.median(prop_asymp))
+    print(np.quantile(prop_asymp, q=0.025))
+    print(np.quantile(prop_asymp, q=0.975))
+    print(np.median(prop_asymp_asymp))
+    print(np.quantile(prop_asymp_asymp, q=0.025))
+    print(np.quantile(prop_asymp_asymp, q=0.975))
+
+    if do_plot and do_save:
+        scen.plot_results(reducer, to_plot, fig_path=f'vietnam.png')
+
+
+# Scenario batches: the best-fitting runs projected forward under each border-reopening policy...
+def mainscens_batches(fitsummary, weights=None):
+    batches = sc.odict()
+    for policy in policies:
+        jobs = scen.scenario_jobs(fitsummary, betas, cutoff, paired=paired_scenarios, policy=policy, n_agents=n_agents, resume_dates=resume_dates, weights=weights)
+        batches[policy] = dict(jobs=jobs, folder=f'{resfolder}/vietnam_sim_{policy}', meta=dict(policy=policy))
+    return batches
+
+
+# ...and under each testing rate
+def testingscens_batches(fitsummary, weights=None):
+    batches = sc.odict()
+    for sn,sp in enumerate(symp_probs):
+        jobs = scen.scenario_jobs(fitsummary, betas, cutoff, paired=paired_scenarios, policy='dynamic', symp_prob=sp, n_agents=n_agents, resume_dates=resume_dates, weights=weights)
+        batches[f'{(sn+1)*10}%'] = dict(jobs=jobs, folder=f'{resfolder}/vietnam_sim_{(sn+1)*10}', meta=dict(policy='dynamic', symp_prob=sp), fig_path=f'vietnam_{sp}.png')
+    return batches
 
 
+# Headline numbers of each scenario, used to decide when it has enough seeds; they take one run or a stack of runs
+def infections_after_borders_open(results):
+    return metrics.cum_diff(results['cum_infections'], calendar.day('2020-12-01'))
 
-elif whattorun=='mainscens':
-    # Load good seeds
-    fitsummary = sc.loadobj(f'{resfolder}/fitsummary{change}.obj')
-    for policy in ['remain','drop','dynamic']:
-        sims = []
-        sc.blank()
-        print('---------------\n')
-        print(f'Starting {policy} policy runs... ')
-        print('---------------\n')
-        for bn,beta in enumerate(betas):
-            s0 = make_sim(seed=1, beta=beta, policy=policy)
-            goodseeds = [i for i in range(n_runs) if fitsummary[bn][i] < 82]
-            if len(goodseeds)>0:
-                for seed in goodseeds:
-                    sim = s0.copy()
-                    sim['rand_seed'] = seed
-                    sim.set_seed()
-                    sims.append(sim)
-        msim = cv.MultiSim(sims)
-        msim.run()
-
-        if save_sim:
-            msim.save(f'{resfolder}/vietnam_sim_{policy}.obj')
-        if do_plot:
-            msim.reduce()
-            msim.plot(to_plot=to_plot, do_save=do_save, do_show=False, fig_path=f'vietnam_{policy}.png',
-                      legend_args={'loc': 'upper left'}, axis_args={'hspace': 0.4}, interval=21)
-
-
-
-elif whattorun=='testingscens':
-    # Load good seeds
-    fitsummary = sc.loadobj(f'{resfolder}/fitsummary{change}.obj')
-    symp_probs = np.array([0.01048074, 0.02206723, 0.0350389 , 0.04979978, 0.06696701]) # constructed to give testing rates of 10-50% after 10 days
-    for sn,sp in enumerate(symp_probs):
-        sims = []
-        sc.blank()
-        print('---------------\n')
-        print(f'Starting {sp} testing runs... ')
-        print('---------------\n')
-        for bn,beta in enumerate(betas):
-            s0 = make_sim(seed=1, beta=beta, policy='dynamic', symp_prob=sp)
-            goodseeds = [i for i in range(n_runs) if fitsummary[bn][i] < 82]
-            if len(goodseeds)>0:
-                for seed in goodseeds:
-                    sim = s0.copy()
-                    sim['rand_seed'] = seed
-                    sim.set_seed()
-                    sims.append(sim)
-        msim = cv.MultiSim(sims)
-        msim.run()
-
-        if save_sim:
-            msim.save(f'{resfolder}/vietnam_sim_{(sn+1)*10}.obj')
-        if do_plot:
-            msim.reduce()
-            msim.plot(to_plot=to_plot, do_save=do_save, do_show=False, fig_path=f'vietnam_{sp}.png',
-                      legend_args={'loc': 'upper left'}, axis_args={'hspace': 0.4}, interval=21)
+def peak_diagnoses_after_borders_open(results):
+    return metrics.peaks(results['new_diagnoses'], start=calendar.day('2020-12-01'))[1]
+
+headlines = {'Infections from 1 Dec 2020': infections_after_borders_open, 'Peak daily diagnoses from 1 Dec 2020': peak_diagnoses_after_borders_open}
+
+
+def run_scenarios(batches, label):
+    ''' Run all the scenario batches as one pooled batch, then plot each '''
+    for name,batch in batches.items():
+        print(f'{name}: {len(batch["jobs"])} runs')
+    if converge_scenarios:
+        reducers = scen.run_converged(batches, headlines, rtol=converge_rtol, ncpus=ncpus, label=label, fork=fork_scenarios)
+    else:
+        reducers = scen.run_matrix(batches, ncpus=ncpus, label=label, fork=fork_scenarios)
+    if do_plot and do_save:
+        for name,batch in batches.items():
+            scen.plot_results(reducers[name], to_plot, fig_path=batch.get('fig_path', f'vietnam_{name}.png'))
+    if paired_scenarios:
+        compare_scenarios(batches)
+    return
+
+
+def compare_scenarios(batches):
+    ''' Paired differences of the headline numbers: each policy against remain, and each testing rate against 10% '''
+    for reference,names in [('remain', policies), ('10%', [f'{(sn+1)*10}%' for sn in range(len(symp_probs))])]:
+        if reference in batches:
+            stores = {name:batches[name]['folder'] for name in names if name in batches}
+            sc.heading(f'Differences from {reference}')
+            scen.paired_differences(stores, reference, headlines)
+    return
+
+
+# Project the best-fitting runs forward under different border-reopening scenarios
+def mainscens():
+    fitsummary, weights = load_fit() # Load good seeds
+    run_scenarios(mainscens_batches(fitsummary, weights), label='Policy scenarios')
+
+
+# Project the best-fitting runs forward under different testing scenarios
+def testingscens():
+    fitsummary, weights = load_fit() # Load good seeds
+    run_scenarios(testingscens_batches(fitsummary, weights), label='Testing scenarios')
+
+
+# Both sets of scenarios in a single batch
+def allscens():
+    fitsummary, weights = load_fit() # Load good seeds
+    run_scenarios(sc.mergedicts(mainscens_batches(fitsummary, weights), testingscens_batches(fitsummary, weights)), label='All scenarios')
+
+
+########################################################################
+# Define the pipeline
+########################################################################
 
+def make_pipeline():
+    ''' The stages, what they depend on, and what they produce '''
+    model_files = runcache.source_files + stage_files # The data and model code behind every run, plus the code of the stages themselves
+    fitsummary_file = f'{resfolder}/fitsummary{change}.obj'
+    fitpars = dict(betas=betas, n_runs=n_runs, change=change, today=today, resume_dates=resume_dates, version=cv.__version__)
+    scenpars = sc.mergedicts(fitpars, dict(cutoff=cutoff, converge_rtol=converge_rtol if converge_scenarios else None, paired=paired_scenarios))
+    pipeline = Pipeline(f'{resfolder}/pipeline.json')
+    pipeline.add('quickfit', quickfit, pars=dict(today=today), inputs=model_files, outputs=['vietnam.png'])
+    pipeline.add('plotpeople', plotpeople, pars=dict(today=today), inputs=model_files, outputs=['figs234/figS1_people.pdf'])
+    fitting_pars = dict(cutoff=cutoff if early_stop else None, fit_mode=fit_mode, target_accepted=target_accepted if fit_mode == 'adaptive' else None,
+                        min_accepted=min_accepted if resume_dates else None)
+    pipeline.add('fitting', fitting, pars=sc.mergedicts(fitpars, fitting_pars), inputs=model_files, outputs=[fitsummary_file])
+    pipeline.add('finialisecalibration', finialisecalibration, requires=['fitting'], pars=sc.mergedicts(fitpars, dict(cutoff=cutoff)),
+                 inputs=model_files, outputs=[f'{resfolder}/vietnam_sim'])
+    pipeline.add('mainscens', mainscens, requires=['fitting'], pars=sc.mergedicts(scenpars, dict(policies=policies)),
+                 inputs=model_files, outputs=[f'{resfolder}/vietnam_sim_{policy}' for policy in policies])
+    pipeline.add('testingscens', testingscens, requires=['fitting'], pars=sc.mergedicts(scenpars, dict(symp_probs=symp_probs)),
+                 inputs=model_files, outputs=[f'{resfolder}/vietnam_sim_{(sn+1)*10}' for sn in range(len(symp_probs))])
+    pipeline.add('allscens', allscens, requires=['fitting'], alias_of=['mainscens', 'testingscens']) # Writes the same stores, so its hashes are recorded under those stages
+    return pipeline
+
+
+def warm_caches():
+    ''' Load the population into this process before any pools are started, so that forked workers inherit it rather than each loading it '''
+    sim = make_sim(seed=1, beta=betas[0], end_day=today, n_agents=n_agents) # Builds the population, or loads it from results/cache, and keeps it in memory
+    if shared_population:
+        vm.share_population(sim)
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the calibration and scenario analyses', formatter_class=argparse.RawDescriptionHelpFormatter, epilog='stages:\n  ' + '\n  '.join(runoptions))
+    parser.add_argument('stages', nargs='*', metavar='stage', help='stages to run (default: quickfit)')
+    parser.add_argument('--force', action='store_true', help='rerun the requested stages even if their inputs are unchanged')
+    parser.add_argument('--ncpus', type=int, default=ncpus, help='number of worker processes (default: all cores)')
+    parser.add_argument('--listen', type=int, default=distribute_port, metavar='PORT', help='hand out the sweep jobs to workers started with "python distributed.py worker HOST:PORT"')
+    args = parser.parse_args()
+    stages = args.stages if args.stages else [runoptions[0]]
+    unknown = [stage for stage in stages if stage not in runoptions]
+    if unknown:
+        parser.error(f'unknown stage(s) {unknown}; choices are {runoptions}')
+    if set(stages) & set(sweep_stages): # Only the sweeps run many sims at once, so only they need the memory check (which measures a run the first time)
+        ncpus = memory.max_workers(n_agents, args.ncpus, budget=memory_budget, shared=shared_population)
+        if vm.shared_triggers:
+            vm.check_shared_triggers(n_agents=n_agents) # Don't sweep with triggers that fire on different days
+    if args.listen:
+        distribute(args.listen)
+    if profile_folder:
+        profile(profile_folder)
+
+    T = sc.tic()
+    cv.check_save_version()
+    pipeline = make_pipeline()
+    warm_caches()
+    pipeline.run(stages, force=args.force)
+    sc.toc(T)
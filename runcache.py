@@ -0,0 +1,153 @@
+'''
+Content-addressed cache of finished runs. Each run is stored as a compressed
+.npz file of its result arrays (plus any scalar statistics), named by a hash of
+everything that determines it: the make_sim() arguments, the run's seed, the
+data file, the model code and the Covasim version. The fitting sweep writes
+every run it completes, so later stages that run the same (beta, seed) pairs
+to the same day -- such as finialisecalibration -- can read them back instead
+of simulating them again. The cache is kept under a size limit by deleting the
+least recently used runs.
+'''
+
+import os
+import json
+import inspect
+import hashlib
+import numpy as np
+import covasim as cv
+import vietnam_model
+from vietnam_model import make_sim
+from vietnam_calendar import datafile
+
+here = os.path.dirname(os.path.abspath(__file__))
+cachefolder = 'results/runcache'
+max_size = 2e9 # Maximum size of the cache in bytes
+check_every = 100 # Check the size of the cache after this many writes by each process
+source_files = [datafile] + [os.path.join(here, f) for f in ['vietnam_model.py', 'vietnam_calendar.py', 'vietnam_interventions.py']] # Files the results depend on
+
+_file_hashes = {}
+
+
+def file_hash(filename):
+    ''' MD5 of a file, computed once per process '''
+    if filename not in _file_hashes:
+        with open(filename, 'rb') as f:
+            _file_hashes[filename] = hashlib.md5(f.read()).hexdigest()
+    return _file_hashes[filename]
+
+
+class RunCache:
+    '''
+    Store and retrieve finished runs by content hash.
+
+    Args:
+        folder (str): the folder for the cache
+        max_size (float): the maximum size of the cache in bytes; the least recently used runs are deleted beyond this
+    '''
+
+    def __init__(self, folder=cachefolder, max_size=max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.n_puts = 0
+        return
+
+
+    def key(self, sim_kwargs, seed):
+        '''
+        The hash identifying a run.
+
+        Args:
+            sim_kwargs (dict): the make_sim() arguments; defaults are filled in, so leaving out an argument gives the same key as passing its default
+            seed (int): the seed the run was reseeded with
+        '''
+        args = {name:par.default for name,par in inspect.signature(make_sim).parameters.items() if par.default is not inspect.Parameter.empty}
+        args.update(sim_kwargs)
+        args.pop('analyzers', None) # Analyzers don't change the results
+        args.pop('use_cache', None)
+        keyinfo = dict(args=args, seed=seed, files=[file_hash(f) for f in source_files], covasim=cv.__version__, shared_triggers=vietnam_model.shared_triggers, indexed_tracing=vietnam_model.indexed_tracing)
+        return hashlib.md5(json.dumps(keyinfo, sort_keys=True, default=str).encode()).hexdigest()
+
+
+    def filename(self, key):
+        return os.path.join(self.folder, f'{key}.npz')
+
+
+    def get(self, key, keys=None):
+        '''
+        Load a run, or return None if it isn't cached (or lacks any of the requested result keys).
+
+        Returns:
+            dict with the result arrays under "results" plus any scalar statistics stored with them
+        '''
+        filename = self.filename(key)
+        try:
+            with np.load(filename) as npz:
+                data = {k:npz[k] for k in npz.files}
+        except (FileNotFoundError, OSError, ValueError): # Missing, evicted, or partly written by another process
+            return None
+        results = {k[len('results/'):]:v for k,v in data.items() if k.startswith('results/')}
+        if keys is not None and not all(k in results for k in keys):
+            return None
+        try:
+            os.utime(filename) # Mark as recently used
+        except OSError:
+            pass
+        output = {k:float(v) for k,v in data.items() if not k.startswith('results/')}
+        output['results'] = results
+        return output
+
+
+    def put(self, key, results, **stats):
+        '''
+        Store a run.
+
+        Args:
+            key (str): from key()
+            results (dict): the result arrays
+            stats (dict): scalar statistics to store with them
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        filename = self.filename(key)
+        tmpfile = f'{filename}.{os.getpid()}.tmp.npz'
+        arrays = {f'results/{k}':v for k,v in results.items()}
+        arrays.update(stats)
+        np.savez_compressed(tmpfile, **arrays)
+        os.replace(tmpfile, filename) # So a reader never sees a partly-written file
+        self.n_puts += 1
+        if not (self.n_puts % check_every):
+            self.evict()
+        return
+
+
+    def size(self):
+        ''' Total size of the cached runs in bytes '''
+        return sum(entry.stat().st_size for entry in os.scandir(self.folder) if entry.name.endswith('.npz'))
+
+
+    def evict(self, target=0.9):
+        ''' If the cache is over its size limit, delete the least recently used runs until it's under target times the limit '''
+        if not os.path.isdir(self.folder):
+            return 0
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.npz') and not entry.name.endswith('.tmp.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _,size,_ in entries)
+        if total <= self.max_size:
+            return 0
+        n_removed = 0
+        for mtime,size,path in sorted(entries):
+            if total <= target*self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError: # Already removed by another process
+                pass
+            total -= size
+            n_removed += 1
+        return n_removed
+
+
+# Cache used by the worker functions
+default_cache = RunCache()
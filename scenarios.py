@@ -0,0 +1,489 @@
+'''
+Worker function for runs of the best-fitting (beta, seed) pairs -- the final
+calibration and the policy and testing scenarios -- for use with
+sweep.run_sweep(). Each run sends back its result arrays rather than the whole
+sim, so they can be streamed into a resultstore.ResultsWriter as they finish.
+run_matrix() runs any number of scenarios as one batch, and run_converged()
+runs them only until their headline numbers are stable.
+'''
+
+import time
+import hashlib
+import numpy as np
+import sciris as sc
+import vietnam_model as vm
+from vietnam_model import shared_sim
+from sweep import run_sweep
+from reducers import QuantileReducer
+import calibration as cal
+import resultstore as rs
+import runcache
+
+# Job fields that are passed on to make_sim()
+sim_keys = ['beta', 'change', 'policy', 'symp_prob', 'end_day', 'n_agents', 'resume_dates']
+fork_keys = ['policy', 'symp_prob'] # The ones that only matter after vm.fork_day
+variant_keys = fork_keys + ['scenario', 'import_seed'] # The job fields that may differ between the branches of a forked run; the border imports only start after vm.fork_day
+
+
+def scenario_run(job):
+    '''
+    Run a single seed of a scenario.
+
+    Args:
+        job (dict): the seed plus any of the make_sim() arguments in sim_keys; set asymp_stats=True to also compute the transmission statistics, and import_seed to draw the border imports from their own stream (see vm.make_imports())
+
+    Returns:
+        dict with the result arrays under "results", plus prop_asymp and prop_asymp_asymp if requested; also "cached" if the run was read from the run cache rather than simulated
+    '''
+    sim_kwargs = {k:job[k] for k in sim_keys if k in job}
+    cache = runcache.default_cache if job.get('cache', True) else None
+    if cache is not None:
+        key = cache.key(dict(sim_kwargs, import_seed=job.get('import_seed')), job['seed'])
+        hit = cache.get(key, keys=job.get('keys', rs.default_keys))
+        if hit is not None and (not job.get('asymp_stats') or 'prop_asymp' in hit):
+            output = dict(results={k:hit['results'][k] for k in job.get('keys', rs.default_keys)}, cached=True)
+            if job.get('asymp_stats'):
+                output['prop_asymp'] = hit['prop_asymp']
+                output['prop_asymp_asymp'] = hit['prop_asymp_asymp']
+            return output
+
+    s0 = shared_sim(seed=1, **sim_kwargs)
+    sim = vm.copy_sim(s0)
+    sim['rand_seed'] = job['seed']
+    sim.set_seed()
+    if job.get('import_seed') is not None:
+        sim['n_imports'] = vm.make_imports(job['import_seed'])
+    if job.get('asymp_stats'):
+        sim['analyzers'] = [cal.asymp_stats()]
+        sim.init_analyzers()
+    vm.run_sim(sim)
+
+    output = dict(results=rs.get_results(sim, keys=job.get('keys')))
+    if job.get('asymp_stats'):
+        stats = sim.get_analyzer('asymp_stats').stats
+        output['prop_asymp'] = float(stats.prop_asymp)
+        output['prop_asymp_asymp'] = float(stats.prop_asymp_asymp)
+    if cache is not None:
+        cache.put(key, output['results'], **{k:v for k,v in output.items() if k != 'results'})
+    return output
+
+
+def fork_run(job):
+    '''
+    Run a single seed to vm.fork_day once, then branch it into each scenario.
+    Gives the same results as running each scenario with scenario_run() (see
+    check_fork()), and shares its run cache entries: scenarios already in the
+    cache are read back, and the prefix is only run if any are missing.
+
+    Args:
+        job (dict): the seed, the make_sim() arguments shared by all the scenarios, and a list of "variants", each with a scenario name plus its policy, symp_prob and/or import_seed; set cache=False to bypass the run cache
+
+    Returns:
+        dict with one output per variant under "forks", each with the scenario name, its result arrays, and its share of the run time; also "cached" for those read from the run cache
+    '''
+    t0 = time.time()
+    shared = {k:job[k] for k in sim_keys if k in job and k not in fork_keys}
+    cache = runcache.default_cache if job.get('cache', True) else None
+    forks = [None]*len(job['variants'])
+    cache_keys = [None]*len(job['variants'])
+    if cache is not None:
+        for i,variant in enumerate(job['variants']):
+            sim_kwargs = dict(shared, **{k:variant[k] for k in fork_keys if k in variant}, import_seed=variant.get('import_seed'))
+            cache_keys[i] = cache.key(sim_kwargs, job['seed']) # The same key scenario_run() gives this scenario
+            hit = cache.get(cache_keys[i], keys=job.get('keys', rs.default_keys))
+            if hit is not None:
+                forks[i] = dict(scenario=variant['scenario'], results={k:hit['results'][k] for k in job.get('keys', rs.default_keys)}, cached=True)
+    todo = [i for i,fork in enumerate(forks) if fork is None]
+    t_lookup = (time.time() - t0)/len(job['variants'])
+    for fork in forks:
+        if fork is not None:
+            fork['time'] = t_lookup
+    if not todo:
+        return dict(forks=forks)
+
+    t0 = time.time()
+    prefix = vm.copy_sim(shared_sim(seed=1, **shared))
+    prefix['rand_seed'] = job['seed']
+    prefix.set_seed()
+    vm.run_sim(prefix, until=vm.fork_day) # No border imports before the fork, so the prefix doesn't depend on the import seed
+    t_prefix = (time.time() - t0)/len(todo)
+
+    for i in todo:
+        t0 = time.time()
+        variant = job['variants'][i]
+        v = shared_sim(seed=1, **shared, **{k:variant[k] for k in fork_keys if k in variant})
+        sim = vm.fork_sim(prefix, v)
+        if variant.get('import_seed') is not None:
+            sim['n_imports'] = vm.make_imports(variant['import_seed'])
+        vm.run_from_fork(sim)
+        forks[i] = dict(scenario=variant['scenario'], results=rs.get_results(sim, keys=job.get('keys')), time=t_lookup + t_prefix + time.time() - t0)
+        if cache is not None:
+            cache.put(cache_keys[i], forks[i]['results'])
+    return dict(forks=forks)
+
+
+def check_fork(job):
+    '''
+    Run one seed of every scenario of a fork_run() job both forked and from day
+    0, bypassing the run cache, and check that the results are identical. This
+    would catch any state the fork drops, e.g. if the replaced symptomatic
+    testing intervention or its trigger had changed before vm.fork_day.
+
+    Raises:
+        RuntimeError: naming the scenarios whose forked and unforked runs differ
+    '''
+    forked = fork_run(dict(job, cache=False))['forks']
+    shared = {k:v for k,v in job.items() if k != 'variants'}
+    differ = []
+    for variant,fork in zip(job['variants'], forked):
+        unforked = scenario_run(dict(shared, **variant, cache=False))['results']
+        if not all(np.array_equal(fork['results'][key], unforked[key]) for key in unforked):
+            differ.append(variant['scenario'])
+    if differ:
+        raise RuntimeError(f'Forked runs of (beta={job["beta"]}, seed={job["seed"]}) differ from running from day 0 for {differ}; set fork_scenarios = False')
+    return
+
+
+def fork_jobs(jobs):
+    ''' Group scenario jobs that only differ after vm.fork_day into one fork_run() job each '''
+    groups = sc.odict()
+    for job in jobs:
+        shared = {k:v for k,v in job.items() if k not in variant_keys}
+        key = str(sorted(shared.items()))
+        if key not in groups:
+            groups[key] = dict(shared, variants=[])
+        groups[key]['variants'].append({k:job[k] for k in variant_keys if k in job})
+    return groups.values()
+
+
+def scenario_jobs(fitsummary, betas, cutoff, paired=None, weights=None, resample_seed=0, **kwargs):
+    '''
+    One job per good seed of each beta, i.e. each (beta, seed) pair with a
+    mismatch below the cutoff. If paired, the border imports of each run are
+    seeded by its seed, so every scenario run with that (beta, seed) sees the
+    same imports; together with the shared seed up to vm.fork_day and the
+    fixed reseed there, the scenarios then differ only through their policies.
+    If paired is False, each run's imports are seeded by unpaired_import_seed(),
+    so they differ between scenarios but don't depend on what else the worker
+    has run. Leave it as None for runs that end before the borders open, which
+    have no border imports, so they match the fitting runs in the run cache.
+
+    If weights (one per beta, e.g. from an adaptive fit) are given, the good
+    seeds are resampled with replacement in proportion to their beta's weight,
+    to as many jobs as there are good seeds; the same resample_seed gives every
+    scenario the same draws, so they stay paired.
+    '''
+    if 'resume_dates' in kwargs:
+        kwargs['resume_dates'] = tuple(kwargs['resume_dates']) # As in calibration.fit_run(), so every job and key sees the same type
+    jobs = []
+    for bn,beta in enumerate(betas):
+        goodseeds = [i for i in range(len(fitsummary[bn])) if fitsummary[bn][i] < cutoff]
+        jobs += [dict(beta=beta, seed=seed, **kwargs) for seed in goodseeds]
+    if weights is not None and jobs:
+        p = np.array([weights[betas.index(job['beta'])] for job in jobs], dtype=float)
+        draws = np.random.RandomState(resample_seed).choice(len(jobs), size=len(jobs), p=p/p.sum())
+        jobs = [dict(jobs[i]) for i in np.sort(draws)] # Repeated runs give the same results, so count twice in the quantiles
+    if paired is not None:
+        for job in jobs:
+            job['import_seed'] = job['seed'] if paired else unpaired_import_seed(job)
+    return jobs
+
+
+def unpaired_import_seed(job):
+    ''' A seed for the border imports of a run that's different for every beta, seed and scenario setting in the job '''
+    key = str(sorted((k, job[k]) for k in sim_keys + ['seed'] if k in job))
+    return int(hashlib.md5(key.encode()).hexdigest()[:8], 16)
+
+
+class ScenarioMatrix:
+    '''
+    The result stores, quantile reducers and timing for a set of scenarios,
+    filled in by one or more calls to run(). Each finished run is routed to its
+    scenario's store and reducer, and then dropped.
+
+    Args:
+        batches (dict): for each scenario name, a dict with its jobs, the folder for its result store, and optionally its metadata
+        keys (list): the result keys to reduce (default: all the stored keys)
+        summaries (dict): functions that compute a headline number from one run's results, by name; their values are kept for every run, for checking convergence
+    '''
+
+    def __init__(self, batches, keys=None, summaries=None):
+        self.batches = batches
+        self.summaries = summaries if summaries else {}
+        self.writers = {}
+        self.reducers = {}
+        self.timing = {}
+        self.values = {}
+        for name,batch in batches.items():
+            self.writers[name] = rs.ResultsWriter(batch['folder'], n_sims=len(batch['jobs']), meta=batch.get('meta'))
+            self.reducers[name] = QuantileReducer(keys if keys is not None else self.writers[name].keys)
+            self.timing[name] = dict(n=0, cached=0, busy=0.0, slowest=0.0, finished=0.0)
+            self.values[name] = {key:[] for key in self.summaries}
+        self.fork_checked = False # Whether check_fork() has passed
+        self.T = sc.tic()
+        return
+
+
+    def add(self, record):
+        ''' Route a finished run to its scenario '''
+        name = record.pop('scenario')
+        self.writers[name].add_record(record)
+        self.reducers[name].add_record(record)
+        for key,func in self.summaries.items():
+            self.values[name][key].append(func(record['results']))
+        t = self.timing[name]
+        t['n'] += 1
+        t['cached'] += int(record.get('cached', False))
+        t['busy'] += record['time']
+        t['slowest'] = max(t['slowest'], record['time'])
+        t['finished'] = sc.toc(self.T, output=True)
+        return
+
+
+    def add_forks(self, record):
+        ''' Route each branch of a forked run to its scenario '''
+        shared = {k:v for k,v in record.items() if k not in ['forks', 'variants', 'time']}
+        for variant,output in zip(record['variants'], record['forks']):
+            self.add(sc.mergedicts(shared, variant, output))
+        return
+
+
+    def run(self, jobs, ncpus=None, label=None, fork=False):
+        ''' Run jobs (each with its scenario name under "scenario") as one batch on the pool; see run_matrix() '''
+        if fork:
+            fork_batch = list(fork_jobs(jobs))
+            if not self.fork_checked and fork_batch:
+                check_fork(fork_batch[0]) # On one seed, before trusting the fork with the rest
+                self.fork_checked = True
+            run_sweep(fork_run, fork_batch, ncpus=ncpus, label=label, on_result=self.add_forks)
+        else:
+            run_sweep(scenario_run, jobs, ncpus=ncpus, label=label, on_result=self.add)
+        return
+
+
+    def close(self):
+        ''' Finish writing the result stores '''
+        for writer in self.writers.values():
+            writer.close()
+        return
+
+
+    def report(self):
+        ''' Print the timing by scenario '''
+        print(f'{"Scenario":>12s} {"runs":>6s} {"cached":>7s} {"CPU (s)":>9s} {"mean (s)":>9s} {"slowest (s)":>12s} {"done at (s)":>12s}')
+        for name,t in self.timing.items():
+            mean = t['busy']/t['n'] if t['n'] else 0.0
+            print(f'{str(name):>12s} {t["n"]:6d} {t["cached"]:7d} {t["busy"]:9.1f} {mean:9.2f} {t["slowest"]:12.2f} {t["finished"]:12.1f}')
+        return
+
+
+    def bootstrap(self, name, quantiles=(0.5, 0.025, 0.975), n_boot=200, seed=0):
+        '''
+        The headline numbers of a scenario -- the given quantiles of each summary
+        across its runs so far -- and their bootstrap standard errors.
+
+        Returns:
+            dict of (estimates, standard errors) by summary name
+        '''
+        rng = np.random.RandomState(seed)
+        output = {}
+        for key,vals in self.values[name].items():
+            vals = np.array(vals)
+            inds = rng.randint(len(vals), size=(n_boot, len(vals)))
+            resampled = np.quantile(vals[inds], quantiles, axis=1)
+            output[key] = (np.quantile(vals, quantiles), resampled.std(axis=1))
+        return output
+
+
+    def converged(self, name, rtol, **kwargs):
+        ''' Whether every headline number of a scenario has a bootstrap standard error within rtol of its value '''
+        for est,se in self.bootstrap(name, **kwargs).values():
+            if np.any(se > rtol*np.abs(est)):
+                return False
+        return True
+
+
+def run_matrix(batches, keys=None, ncpus=None, label=None, fork=False):
+    '''
+    Run several scenarios as one flat batch on the worker pool, routing each
+    finished run to its scenario's result store and quantile reducer, so the
+    pool only drains once at the very end rather than after every scenario.
+
+    Args:
+        batches (dict): for each scenario name, a dict with its jobs, the folder for its result store, and optionally its metadata
+        keys (list): the result keys to reduce (default: all the stored keys)
+        ncpus (int): number of worker processes
+        label (str): name to print in progress messages
+        fork (bool): run each (beta, seed) once up to vm.fork_day and branch it into the scenarios, rather than running every scenario from day 0
+
+    Returns:
+        reducers (dict): the QuantileReducer of each scenario
+    '''
+    matrix = ScenarioMatrix(batches, keys=keys)
+    jobs = []
+    for name,batch in batches.items():
+        jobs += [dict(job, scenario=name) for job in batch['jobs']]
+    matrix.run(jobs, ncpus=ncpus, label=label, fork=fork)
+    matrix.close()
+    matrix.report()
+    return matrix.reducers
+
+
+def run_converged(batches, summaries, rtol=0.05, min_runs=100, batch_size=50, keys=None, ncpus=None, label=None, fork=False, seed=0):
+    '''
+    Like run_matrix(), but run each scenario's seeds in batches and stop adding
+    seeds to a scenario once its headline numbers have converged: the median
+    and 95% interval of every summary must have a bootstrap standard error
+    within rtol of its value. Seeds are taken in a random order, the same for
+    every scenario, so the runs of each scenario are a fair sample and paired
+    scenarios (and forks) still share their seeds.
+
+    Args:
+        batches (dict): see run_matrix()
+        summaries (dict): functions that compute a headline number from one run's results, by name
+        rtol (float): relative tolerance for the bootstrap standard errors
+        min_runs (int): runs per scenario before convergence is first checked
+        batch_size (int): runs added to each unconverged scenario per round
+        seed (int): random seed for the order of the seeds
+        other args: see run_matrix()
+
+    Returns:
+        reducers (dict): the QuantileReducer of each scenario
+    '''
+    matrix = ScenarioMatrix(batches, keys=keys, summaries=summaries)
+    pending = {}
+    for name,batch in batches.items():
+        jobs = sorted(batch['jobs'], key=lambda job: (job['beta'], job['seed']))
+        order = np.random.RandomState(seed).permutation(len(jobs))
+        pending[name] = [jobs[i] for i in order]
+
+    active = [name for name in batches.keys() if pending[name]]
+    n_round = 0
+    while active:
+        jobs = []
+        for name in active:
+            n = min_runs if n_round == 0 else batch_size
+            jobs += [dict(job, scenario=name) for job in pending[name][:n]]
+            pending[name] = pending[name][n:]
+        matrix.run(jobs, ncpus=ncpus, label=f'{label} round {n_round}' if label else f'Round {n_round}', fork=fork)
+        n_round += 1
+        for name in list(active):
+            if matrix.converged(name, rtol):
+                print(f'{name}: converged after {matrix.timing[name]["n"]} runs')
+                active.remove(name)
+            elif not pending[name]:
+                print(f'{name}: not converged to {rtol*100:g}%, but all {matrix.timing[name]["n"]} runs are done')
+                active.remove(name)
+    matrix.close()
+    matrix.report()
+
+    # Report the runs saved and the headline numbers
+    for name,batch in batches.items():
+        n_run = matrix.timing[name]['n']
+        n_all = len(batch['jobs'])
+        saved = 1 - n_run/n_all if n_all else 0
+        print(f'{name}: {n_run} of {n_all} runs ({n_all - n_run} saved, {saved*100:0.0f}%)')
+        if not n_run:
+            continue
+        for key,(est,se) in matrix.bootstrap(name).items():
+            print(f'    {key}: ' + ', '.join(f'{e:0.1f} ± {s:0.1f}' for e,s in zip(est, se)) + ' (median, 2.5%, 97.5% ± bootstrap SE)')
+    return matrix.reducers
+
+
+class RowView:
+    ''' The given rows of each key of a result store, read only for the keys that are used '''
+
+    def __init__(self, res, rows):
+        self.res = res
+        self.rows = rows
+        self._arrays = {}
+        return
+
+
+    def __getitem__(self, key):
+        if key not in self._arrays:
+            self._arrays[key] = np.asarray(self.res[key][self.rows])
+        return self._arrays[key]
+
+
+def paired_differences(stores, reference, summaries):
+    '''
+    Compare each scenario with a reference scenario run by run: the runs are
+    matched on (beta, seed), and the mean difference in each headline number is
+    reported with its 95% confidence interval from the paired differences, and
+    from treating the two scenarios as independent samples. The ratio of the
+    variances is how many times more seeds an unpaired comparison would need
+    for an interval as narrow.
+
+    Args:
+        stores (dict): the result store (or its folder) of each scenario, by name
+        reference (str): the name of the scenario to compare with
+        summaries (dict): functions that compute a headline number from a run's results, by name; they're given the (n_runs, n_days) arrays of all the matched runs at once, so must work along the last axis (see metrics)
+
+    Returns:
+        dict of dicts of statistics, by scenario name and then summary name
+    '''
+    stores = {name:(store if isinstance(store, rs.Results) else rs.Results(store)) for name,store in stores.items()}
+    ref = stores[reference]
+    ref_rows = {(row['beta'], row['seed']):i for i,row in enumerate(ref.rows)}
+    output = {}
+    for name,res in stores.items():
+        if name == reference:
+            continue
+        pairs = [(ref_rows[(row['beta'], row['seed'])], i) for i,row in enumerate(res.rows) if (row['beta'], row['seed']) in ref_rows]
+        if len(pairs) < 2:
+            print(f'{name}: fewer than 2 runs matched with {reference}, skipping')
+            continue
+        if not all(row.get('import_seed') == row['seed'] for row in res.rows):
+            print(f'{name}: warning, these runs were not paired (import_seed is not the seed), so their imports differ from {reference}')
+        i_ref, i_scen = np.array(pairs).T
+        output[name] = {}
+        print(f'{name} vs {reference} ({len(pairs)} paired runs):')
+        ref_runs = RowView(ref, i_ref)
+        scen_runs = RowView(res, i_scen)
+        for key,func in summaries.items():
+            x = np.asarray(func(ref_runs), dtype=float)
+            y = np.asarray(func(scen_runs), dtype=float)
+            n = len(x)
+            diff = y - x
+            paired_se = diff.std(ddof=1)/np.sqrt(n)
+            unpaired_se = np.sqrt((x.var(ddof=1) + y.var(ddof=1))/n)
+            ratio = (unpaired_se/paired_se)**2 if paired_se > 0 else np.inf
+            output[name][key] = sc.objdict(n=n, mean=diff.mean(), paired_ci=1.96*paired_se, unpaired_ci=1.96*unpaired_se, variance_ratio=ratio)
+            print(f'    {key}: {diff.mean():0.1f} ± {1.96*paired_se:0.1f} paired vs ± {1.96*unpaired_se:0.1f} unpaired (95% CI); '
+                  f'an unpaired comparison would need {ratio:0.1f}x the seeds')
+    return output
+
+
+def run_batch(jobs, folder, meta=None, keys=None, ncpus=None, label=None):
+    '''
+    Run a single scenario, streaming each finished run into a result store and
+    a quantile reducer and then dropping it, so memory use doesn't grow with the
+    size of the batch. See run_matrix() for the arguments.
+
+    Returns:
+        reducer (QuantileReducer): the median and 95% interval of each key
+    '''
+    reducers = run_matrix({label:dict(jobs=jobs, folder=folder, meta=meta)}, keys=keys, ncpus=ncpus, label=label)
+    return reducers[label]
+
+
+def plot_results(reducer, to_plot, fig_path):
+    ''' Plot the median and interval of each result in to_plot from a reducer, in the layout of msim.plot() '''
+    import pylab as pl
+    fig = pl.figure(figsize=(16,14))
+    nrows = int(np.ceil(len(to_plot)/2))
+    for pn,(title,keys) in enumerate(to_plot.items()):
+        ax = pl.subplot(nrows, 2, pn+1)
+        for key in keys:
+            band = reducer.reduce(key)
+            tvec = np.arange(len(band['best']))
+            pl.fill_between(tvec, band['low'], band['high'], alpha=0.2)
+            pl.plot(tvec, band['best'], lw=2, label=key)
+        ax.set_title(title)
+        sc.boxoff()
+        pl.legend(loc='upper left', frameon=False)
+    pl.subplots_adjust(hspace=0.4)
+    pl.savefig(fig_path, dpi=150)
+    pl.close(fig)
+    return
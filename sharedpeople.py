@@ -0,0 +1,157 @@
+'''
+Shared-memory copy of the parts of the population that no run changes: the
+person attributes (age, sex, prognoses, relative susceptibility and
+transmissibility) and the contact layers. The parent process publishes them
+once, before the worker pool starts; every sim built afterwards (in the parent
+or a worker) has its own copies of these arrays swapped for read-only views of
+the shared ones, and copy_sim() copies a sim without duplicating them. Each run
+then only allocates the arrays it writes to -- the states, dates and durations
+-- and only the job dict (seed and scenario settings) crosses the process
+boundary.
+
+The shared arrays are write-protected, so a run that tried to change one in
+place would fail rather than change it for every other run; Covasim replaces
+contact arrays rather than editing them (e.g. in clip_edges), so the run gets
+its own copy of any layer it changes.
+'''
+
+import os
+import copy
+import atexit
+import numpy as np
+from multiprocessing import shared_memory
+
+_blocks = {} # Shared memory blocks, by field name
+_arrays = {} # Read-only views of the blocks, by field name
+_owner = None # The process that created the blocks, and so should free them
+
+
+def shared_fields(people):
+    ''' The (name, array) pairs of a population that are never written during a run '''
+    for key in people.meta.person:
+        yield key, people[key]
+    for lkey,layer in people.contacts.items():
+        for key in layer.meta_keys():
+            yield f'contacts/{lkey}/{key}', layer[key]
+
+
+def _set_field(people, name, arr):
+    if name.startswith('contacts/'):
+        _, lkey, key = name.split('/')
+        people.contacts[lkey][key] = arr
+    else:
+        people[name] = arr
+    return
+
+
+def _view(shm, shape, dtype):
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    arr.flags.writeable = False
+    return arr
+
+
+def publish(sim):
+    '''
+    Copy the read-only arrays of an initialized sim's population into shared
+    memory, and point the sim at them. Call this in the parent before the
+    worker pool starts; forked workers inherit the blocks.
+
+    Returns:
+        handles (dict): what attach() needs to find the blocks from a process that didn't inherit them
+    '''
+    global _owner
+    release()
+    for name,arr in shared_fields(sim.people):
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[:] = arr
+        view.flags.writeable = False
+        _blocks[name] = shm
+        _arrays[name] = view
+    _owner = os.getpid()
+    use_shared(sim)
+    return handles()
+
+
+def handles():
+    ''' The name, shape and dtype of each shared block, by field name '''
+    return {name:(shm.name, arr.shape, arr.dtype.str) for (name,shm),arr in zip(_blocks.items(), _arrays.values())}
+
+
+def attach(handles):
+    ''' Map blocks published by the parent process, e.g. as the pool initializer for workers that are spawned rather than forked '''
+    for name,(shmname,shape,dtype) in handles.items():
+        shm = shared_memory.SharedMemory(name=shmname)
+        _blocks[name] = shm
+        _arrays[name] = _view(shm, shape, dtype)
+    return
+
+
+def use_shared(sim):
+    '''
+    Replace the sim's own copies of the read-only arrays with the shared views,
+    wherever they are identical (they are for every sim built from the same
+    base population). Returns the number of arrays replaced.
+    '''
+    n = 0
+    for name,arr in list(shared_fields(sim.people)):
+        shared = _arrays.get(name)
+        if shared is not None and arr is not shared and arr.shape == shared.shape and arr.dtype == shared.dtype and np.array_equal(arr, shared):
+            _set_field(sim.people, name, shared)
+            n += 1
+    return n
+
+
+def copy_sim(sim):
+    ''' Deep copy of a sim that shares, rather than copies, the shared arrays; same as sim.copy() if nothing is published '''
+    memo = {id(arr):arr for arr in _arrays.values()}
+    return copy.deepcopy(sim, memo)
+
+
+def strip(sim, base):
+    '''
+    Set the read-only arrays of a sim that are the same as those of base, the
+    sim it was copied from, to None, so that saving it doesn't save another
+    copy of the population; fill() puts them back. Returns the names of the
+    arrays stripped.
+    '''
+    base_fields = dict(shared_fields(base.people))
+    stripped = []
+    for name,arr in list(shared_fields(sim.people)):
+        orig = base_fields.get(name)
+        if orig is not None and (arr is orig or (arr.shape == orig.shape and np.array_equal(arr, orig))): # A layer changed by clip_edges is kept
+            _set_field(sim.people, name, None)
+            stripped.append(name)
+    return stripped
+
+
+def fill(sim, base):
+    ''' Put the read-only arrays of base -- shared, if they have been published -- back into a sim stripped by strip() '''
+    base_fields = dict(shared_fields(base.people))
+    for name,arr in list(shared_fields(sim.people)):
+        if arr is None:
+            _set_field(sim.people, name, base_fields[name])
+    return sim
+
+
+def nbytes():
+    ''' Total size of the shared arrays '''
+    return sum(arr.nbytes for arr in _arrays.values())
+
+
+def release():
+    ''' Unmap the shared blocks, and free them if this process created them '''
+    global _owner
+    _arrays.clear() # Drop the views before closing the blocks they point into
+    for shm in _blocks.values():
+        try:
+            shm.close()
+        except BufferError: # A sim still holds a view; the mapping goes when the process exits
+            pass
+        if _owner == os.getpid(): # Not in forked workers, which inherit _owner
+            shm.unlink()
+    _blocks.clear()
+    _owner = None
+    return
+
+atexit.register(release)
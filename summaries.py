@@ -0,0 +1,164 @@
+'''
+Cache of the summaries the figure scripts draw from a result store: the
+per-day quantile bands of every key, plus any per-run scalars (e.g. infections
+after the borders reopen). They're computed once per store and saved as a small
+.npz file in results/summaries, tagged with a hash of the store's files and of
+what was asked for, so any rewrite of the store recomputes them. The sizes and
+modification times of the store's files are saved too, so that while those
+are unchanged later figure runs load the summary in milliseconds without
+reading the store at all.
+'''
+
+import os
+import json
+import inspect
+import hashlib
+import numpy as np
+from resultstore import Results
+from reducers import reduce_store
+
+cachefolder = 'results/summaries'
+default_quantiles = (0.5, 0.025, 0.975)
+
+_summaries = {} # Summaries loaded in this process, by cache key
+
+
+def store_hash(folder, blocksize=2**20):
+    ''' MD5 of every file in a result store '''
+    md5 = hashlib.md5()
+    for name in sorted(os.listdir(folder)):
+        md5.update(name.encode())
+        with open(os.path.join(folder, name), 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                md5.update(block)
+    return md5.hexdigest()
+
+
+def store_stat(folder):
+    ''' Name, size and modification time of every file in a result store, to skip rehashing a store that hasn't been touched '''
+    stats = []
+    for name in sorted(os.listdir(folder)):
+        st = os.stat(os.path.join(folder, name))
+        stats.append(f'{name}:{st.st_size}:{st.st_mtime_ns}')
+    return hashlib.md5('|'.join(stats).encode()).hexdigest()
+
+
+def _source(func):
+    ''' The source code of a scalar function, so changing it recomputes the summary '''
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return getattr(func, '__qualname__', repr(func))
+
+
+class Summary:
+    '''
+    The quantile bands and per-run scalars of a result store.
+
+    Attributes:
+        bands (dict): for each key, a dict with best, low and high (the first three quantiles) and all quantiles by value under "quantiles", as from QuantileReducer.reduce()
+        scalars (dict): an array with one value per run for each scalar
+    '''
+
+    def __init__(self, quantiles, bands, scalars):
+        self.quantiles = quantiles
+        self.bands = bands
+        self.scalars = scalars
+        return
+
+
+    def __getitem__(self, key):
+        return self.bands[key]
+
+
+    def band(self, key, quantiles):
+        ''' The band of a key for these quantiles, as from QuantileReducer.reduce(); None if they weren't all computed '''
+        if not all(q in self.quantiles for q in quantiles):
+            return None
+        band = dict(quantiles={q:self.bands[key]['quantiles'][q] for q in quantiles})
+        for name,q in zip(['best', 'low', 'high'], quantiles):
+            band[name] = band['quantiles'][q]
+        return band
+
+
+    def save(self, filename, tags):
+        arrays = {f'_{tag}':np.array(val) for tag,val in tags.items()}
+        arrays['_quantiles'] = np.array(self.quantiles)
+        for k,band in self.bands.items():
+            for i,q in enumerate(self.quantiles):
+                arrays[f'band/{k}/{i}'] = band['quantiles'][q]
+        for name,vals in self.scalars.items():
+            arrays[f'scalar/{name}'] = vals
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpfile = f'{filename}.{os.getpid()}.tmp.npz'
+        np.savez(tmpfile, **arrays)
+        os.replace(tmpfile, filename)
+        return
+
+
+    @classmethod
+    def load(cls, filename, **tags):
+        ''' Load a saved summary, or return None if it's missing or any of its tags differ '''
+        try:
+            with np.load(filename) as npz:
+                if any(str(npz[f'_{tag}']) != val for tag,val in tags.items()):
+                    return None
+                data = {k:npz[k] for k in npz.files}
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            return None
+        quantiles = tuple(float(q) for q in data['_quantiles'])
+        bands = {}
+        scalars = {}
+        for name,arr in data.items():
+            if name.startswith('band/'):
+                _, k, i = name.split('/')
+                bands.setdefault(k, {'quantiles':{}})['quantiles'][quantiles[int(i)]] = arr
+            elif name.startswith('scalar/'):
+                scalars[name[len('scalar/'):]] = arr
+        for band in bands.values():
+            for bname,q in zip(['best', 'low', 'high'], quantiles):
+                band[bname] = band['quantiles'][q]
+        return cls(quantiles, bands, scalars)
+
+
+def summarize(folder, quantiles=default_quantiles, scalars=None):
+    '''
+    Load the summary of a result store, computing and caching it first if the
+    store (or the quantiles or scalars asked for) has changed.
+
+    Args:
+        folder (str): the folder of the result store, e.g. results/vietnam_sim_remain
+        quantiles (list): the per-day quantiles to compute for every key; the first three are also given as best, low and high
+        scalars (dict): functions that take the Results store and return one value per run, by name
+
+    Returns:
+        Summary
+
+    **Example**::
+
+        summ = summarize('results/vietnam_sim_remain')
+        median = summ['new_diagnoses']['best']
+    '''
+    scalars = scalars if scalars else {}
+    quantiles = tuple(float(q) for q in quantiles)
+    keyinfo = dict(quantiles=quantiles, scalars={name:_source(func) for name,func in scalars.items()})
+    request = hashlib.md5(json.dumps(keyinfo, sort_keys=True).encode()).hexdigest()
+    stat = store_stat(folder)
+    if (folder, request, stat) in _summaries:
+        return _summaries[(folder, request, stat)]
+
+    # If the store's files haven't been touched since the summary was saved, don't read them at all
+    filename = os.path.join(cachefolder, os.path.normpath(folder).replace(os.sep, '_') + '.npz')
+    summ = Summary.load(filename, request=request, stat=stat)
+    if summ is None:
+        store = store_hash(folder)
+        summ = Summary.load(filename, request=request, store=store)
+        if summ is None:
+            res = Results(folder)
+            bands = {}
+            for k in res.keys:
+                bands[k] = reduce_store(res, [k], quantiles=quantiles).reduce(k) # As the figure scripts reduced them
+            summ = Summary(quantiles, bands, {name:np.asarray(func(res), dtype=float) for name,func in scalars.items()})
+        summ.save(filename, dict(request=request, store=store, stat=stat))
+    _summaries[(folder, request, stat)] = summ
+    return summ
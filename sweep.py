@@ -0,0 +1,219 @@
+'''
+Flat work-queue runner for large batches of independent simulations. Jobs are
+handed out one at a time to a process pool, so no core sits idle waiting for
+the slowest run of a batch, and each finished job is appended to a checkpoint
+file straight away so that an interrupted sweep can pick up where it stopped.
+The pool is kept open between sweeps, so workers (and anything they have
+cached) are reused by every sweep in the same process. Alternatively, after
+distribute() the jobs are handed out to workers on other hosts instead (see
+distributed.py), and after profile() every job is profiled (see profiling.py).
+'''
+
+import os
+import json
+import time
+import atexit
+import functools
+import multiprocessing as mp
+import sciris as sc
+
+
+class Checkpoint:
+    '''
+    Append-only store of finished jobs, one JSON record per line. Each record
+    holds the fields that identify the job (e.g. beta and seed) plus whatever
+    the job returned.
+
+    Args:
+        filename (str): file to append to; created if it doesn't exist
+        keys (list): the job fields that identify a run, e.g. ['beta', 'seed']
+    '''
+
+    def __init__(self, filename, keys):
+        self.filename = filename
+        self.keys = list(keys)
+        self.records = {}
+        self.load()
+        return
+
+
+    def key(self, job):
+        ''' The tuple identifying a job or record '''
+        return tuple(job[k] for k in self.keys)
+
+
+    def load(self):
+        ''' Read any records already on disk; a partly-written last line (from a crash) is ignored '''
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[self.key(record)] = record
+        return self.records
+
+
+    def __contains__(self, job):
+        return self.key(job) in self.records
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def add(self, record):
+        ''' Store a finished job and flush it to disk immediately '''
+        self.records[self.key(record)] = record
+        folder = os.path.dirname(self.filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return
+
+
+# Worker pool kept open between sweeps, so later sweeps reuse warm workers
+_pool = None
+_pool_size = None
+_coordinator = None # Used instead of the pool if set by distribute()
+_profile_folder = None # Where to write the profile of each sweep, if set by profile()
+
+
+def get_pool(ncpus=None):
+    ''' Return the persistent worker pool, starting it (or restarting it with a different size) if needed '''
+    global _pool, _pool_size
+    if ncpus is None:
+        ncpus = mp.cpu_count()
+    if _pool is None or _pool_size != ncpus:
+        close_pool()
+        _pool = mp.Pool(processes=ncpus)
+        _pool_size = ncpus
+    return _pool
+
+
+def close_pool():
+    ''' Shut down the persistent worker pool '''
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+        _pool_size = None
+    return
+
+atexit.register(close_pool)
+
+
+def distribute(port, host='0.0.0.0'):
+    ''' Hand out the jobs of every later sweep to remote workers connecting on this port, rather than running them on the local pool '''
+    global _coordinator
+    from distributed import Coordinator # Only needed in this mode
+    if _coordinator is None:
+        _coordinator = Coordinator((host, port))
+        atexit.register(_coordinator.close)
+    return _coordinator
+
+
+def profile(folder):
+    ''' Profile the interventions and step phases of every job of every later sweep, writing a JSON report per sweep to this folder (None to stop) '''
+    global _profile_folder
+    _profile_folder = folder
+    return
+
+
+def _run_job(args):
+    ''' Run a single job in a worker process, returning timing and the worker ID along with the result '''
+    func, j, job = args
+    t0 = time.time()
+    result = func(job)
+    return j, job, result, os.getpid(), time.time() - t0
+
+
+def run_sweep(func, jobs, checkpoint=None, ncpus=None, label=None, report_every=100, on_result=None):
+    '''
+    Run every job in a single flat queue on a process pool.
+
+    Args:
+        func (func): function taking a job dict and returning a dict of results; must be importable by the workers
+        jobs (list): list of job dicts
+        checkpoint (Checkpoint): if supplied, skip jobs already in it and record each finished job
+        ncpus (int): number of worker processes (default: all cores)
+        label (str): name to print in progress messages
+        report_every (int): print progress after this many finished jobs
+        on_result (func): if supplied, each new record is passed to this function as it arrives instead of being kept, e.g. to stream it to disk
+
+    Returns:
+        records (dict): one record per job (job fields merged with results), keyed by the checkpoint key if given, else by position; records passed to on_result are not included
+    '''
+    if ncpus is None:
+        ncpus = mp.cpu_count()
+    label = f'{label}: ' if label else ''
+
+    # Skip anything that's already been done
+    records = {}
+    todo = []
+    for j,job in enumerate(jobs):
+        if checkpoint is not None and job in checkpoint:
+            records[checkpoint.key(job)] = checkpoint.records[checkpoint.key(job)]
+        else:
+            todo.append((j, job))
+    if records:
+        print(f'{label}resuming with {len(records)} of {len(jobs)} jobs already finished')
+    if not todo:
+        return records
+
+    # Run the rest on the persistent pool, or on the remote workers
+    report = None
+    if _profile_folder is not None:
+        import profiling # Only needed when profiling
+        func = functools.partial(profiling.profiled, func)
+        report = profiling.Report()
+    T = sc.tic()
+    n_done = 0
+    workers = {} # Jobs run and time spent per worker process
+    n_workers = min(ncpus, len(todo))
+    if _coordinator is not None:
+        results = _coordinator.run(func, todo)
+    else:
+        results = get_pool(ncpus).imap_unordered(_run_job, [(func, j, job) for j,job in todo], chunksize=1)
+    for j, job, result, pid, elapsed in results:
+        if report is not None:
+            report.add(result.pop('profile', None))
+        record = sc.mergedicts(job, result, {'time':elapsed})
+        if checkpoint is not None:
+            checkpoint.add(record)
+        if on_result is not None:
+            on_result(record)
+        elif checkpoint is not None:
+            records[checkpoint.key(record)] = record
+        else:
+            records[j] = record
+        if pid not in workers:
+            workers[pid] = sc.objdict(n=0, busy=0.0)
+        workers[pid].n += 1
+        workers[pid].busy += elapsed
+        if _coordinator is not None: # Remote workers come and go
+            n_workers = len(workers)
+        n_done += 1
+        if not (n_done % report_every) or n_done == len(todo):
+            wall = sc.toc(T, output=True)
+            print(f'{label}{n_done}/{len(todo)} jobs done in {wall:0.1f} s '
+                  f'({n_done/wall:0.2f} runs/s, {n_done/wall/n_workers:0.3f} runs/s per worker)')
+
+    # Report throughput per worker
+    wall = sc.toc(T, output=True)
+    for pid,w in workers.items():
+        print(f'  worker {pid}: {w.n} runs, {w.n/wall:0.3f} runs/s, {w.busy/wall*100:0.0f}% busy')
+    busy = [w.busy/wall for w in workers.values()]
+    print(f'{label}load balance: mean worker utilization {sum(busy)/n_workers*100:0.0f}%, busiest {max(busy)*100:0.0f}%, least busy {min(busy)*100:0.0f}%')
+    if report is not None:
+        name = (label.rstrip(': ') if label else func.func.__name__).lower().replace(' ', '_')
+        filename = report.save(os.path.join(_profile_folder, f'{name}.json'))
+        report.print(n=10)
+        print(f'{label}profile of {report.n_runs} runs written to {filename}')
+
+    return records
@@ -0,0 +1,149 @@
+'''
+Data and calendar shared by make_sim() and the plotting scripts. The data file
+is parsed once on import, and the date-to-day conversions used throughout the
+analysis are precomputed, so nothing needs to build a sim just to read the data
+or call sim.day(). Only NumPy is imported up front: the data are parsed with
+pandas (for make_sim()) the first time cal.data is used, while the plotting
+scripts read single columns as arrays with cal.column(), which doesn't need
+pandas at all.
+'''
+
+import os
+import csv
+import hashlib
+import datetime as dt
+import numpy as np
+
+start_day = '2020-06-15'
+end_day   = '2021-04-30'
+datafile  = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vietnam_data.csv')
+
+
+def todate(date):
+    ''' Convert a string or datetime to a date '''
+    if isinstance(date, str):
+        return dt.datetime.strptime(date, '%Y-%m-%d').date()
+    elif isinstance(date, dt.datetime):
+        return date.date()
+    return date
+
+
+def load_data(filename):
+    ''' Load the data in the same form as cv.load_data(): cumulative columns added, indexed by date '''
+    import pandas as pd # Only needed by make_sim(), so not imported until then
+    data = pd.read_csv(filename)
+    for col in list(data.columns):
+        if col.startswith('new'):
+            cum_col = col.replace('new_', 'cum_')
+            if cum_col not in data.columns:
+                data[cum_col] = np.cumsum(data[col])
+    data['date'] = pd.to_datetime(data['date']).dt.date
+    data.set_index('date', inplace=True, drop=False)
+    return data
+
+
+def load_columns(filename):
+    ''' Load the data as a date array and a dict of float arrays by column, with the same cumulative columns as load_data() '''
+    with open(filename, newline='') as f:
+        rows = list(csv.DictReader(f))
+    dates = np.array([todate(row['date']) for row in rows])
+    columns = {}
+    for col in rows[0].keys():
+        if col and col != 'date':
+            columns[col] = np.array([float(row[col]) if row[col] not in ['', 'NA'] else np.nan for row in rows])
+    for col in list(columns.keys()):
+        if col.startswith('new'):
+            cum_col = col.replace('new_', 'cum_')
+            if cum_col not in columns:
+                vals = columns[col]
+                cum = np.nancumsum(vals) # As pandas does, skipping but keeping missing values
+                cum[np.isnan(vals)] = np.nan
+                columns[cum_col] = cum
+    return dates, columns
+
+
+class Calendar:
+    '''
+    The data plus every date-to-day lookup used by the analysis.
+
+    Args:
+        start_day (str): the day the sims start
+        filename (str): the data file to load
+    '''
+
+    def __init__(self, start_day=start_day, filename=datafile):
+        self.start_day = todate(start_day)
+        self.filename = filename
+        self._data = None
+        self._columns = None
+
+        # Days used by make_sim()
+        self.days = dict(
+            import_end     = self.day('2020-07-15'), # End of the first importation window
+            test_num_end   = self.day('2020-08-22'), # End of test_num testing
+            test_prob_start= self.day('2020-08-23'), # Switch to symptomatic testing
+            rel_probs_end  = self.day('2020-08-31'), # Critical and death probabilities return to normal
+            test_prob_end  = self.day('2020-11-30'), # End of symptomatic testing at the calibrated rate
+            border_start   = self.day('2020-11-30'), # Open borders for one month
+            border_end     = self.day('2020-12-31'), # Then close them again
+            symp_test_start= self.day('2020-12-01'), # Start of the testing scenarios
+            final_day      = self.day(end_day),
+        )
+        return
+
+
+    @property
+    def data(self):
+        ''' The data as a dataframe, as used by make_sim() '''
+        if self._data is None:
+            self._data = load_data(self.filename)
+        return self._data
+
+
+    @property
+    def daily_tests(self):
+        ''' Smoothed tests for the test_num intervention '''
+        return self.data['new_tests'].rolling(3).mean()
+
+
+    def column(self, key):
+        ''' One column of the data as an array, or None if there's no such column; doesn't need pandas '''
+        if self._columns is None:
+            self._columns = load_columns(self.filename)
+        return self._columns[1].get(key)
+
+
+    def day(self, day, *args):
+        ''' Convert a date string or date to a day relative to the start day, like sim.day() '''
+        if args:
+            return [self.day(d) for d in (day,)+args]
+        if isinstance(day, (int, np.integer)):
+            return int(day)
+        return (todate(day) - self.start_day).days
+
+
+    def date(self, ind, as_date=False):
+        ''' Convert a day back into a date string (or date), like sim.date() '''
+        date = self.start_day + dt.timedelta(days=int(ind))
+        return date if as_date else date.strftime('%Y-%m-%d')
+
+
+    def data_days(self):
+        ''' Day index of every row of the data '''
+        if self._columns is None:
+            self._columns = load_columns(self.filename)
+        return np.array([(d - self.start_day).days for d in self._columns[0]])
+
+
+    def data_hash(self, end_day):
+        ''' Hash of the data up to and including end_day, to check that extending the data file hasn't revised any earlier rows '''
+        keep = self.data_days() <= self.day(end_day)
+        md5 = hashlib.md5()
+        for key,values in sorted(self._columns[1].items()):
+            md5.update(key.encode())
+            md5.update(np.ascontiguousarray(values[keep]).tobytes())
+        return md5.hexdigest()
+
+
+# Shared instance
+calendar = Calendar()
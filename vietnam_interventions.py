@@ -0,0 +1,246 @@
+'''
+Custom interventions and triggers for the central Vietnam model.
+
+A dynamic sim has up to six triggers on daily diagnoses, each of which counts
+them again every day. shared_trigger reads them instead from a single
+DiagnosisCounter kept on the sim, which extends its running total by one day
+at a time from the sim's new_diagnoses results, so a trigger's value on any
+day -- even with smoothing over 28 days -- takes O(1) work. It's a drop-in
+replacement for cv.trigger('date_diagnosed', ...); set
+vietnam_model.shared_triggers = True to use it. It only overrides __call__(),
+so vietnam_model.check_shared_triggers() -- run before the sweeps whenever it's
+on -- checks that the pinned Covasim actually evaluates it that way, and that
+the interventions fire on the same days as with cv.trigger (trigger_days
+records them). benchmarks/bench_triggers.py times both.
+
+Contact tracing finds the contacts of everyone diagnosed each day, which
+cv.contact_tracing does by scanning every edge of every traced layer.
+indexed_contact_tracing instead looks them up in a compressed sparse row
+index of each layer (ContactIndex), built when the intervention is
+initialized and rebuilt whenever the layer's edge arrays are replaced, e.g.
+when clip_edges closes or reopens schools and workplaces. It's off by default
+(vietnam_model.indexed_tracing). It finds the same contacts as
+cv.contact_tracing, but the random draws of which are traced aren't
+guaranteed to line up with the pinned version's, so runs can differ seed by
+seed; benchmarks/bench_contact_tracing.py checks that the contacts are the
+same and that the numbers notified agree statistically, and times both on the
+days around the peak of the outbreak.
+'''
+
+import numpy as np
+import covasim as cv
+import covasim.utils as cvu
+
+max_indexes = 8 # ContactIndex objects kept per process: enough for the four layers as built plus the school and work layers of the run in progress
+_indexes = {} # ContactIndex objects by the identity of the edge arrays they were built from
+
+
+class DiagnosisCounter:
+    '''
+    Cumulative diagnoses by day for one sim, extended lazily from its results,
+    so that the diagnoses over any window of past days are a difference of two
+    entries.
+
+    Args:
+        sim (Sim): the sim whose diagnoses to count
+    '''
+
+    def __init__(self, sim):
+        self.source = sim.results['new_diagnoses'].values
+        self.cum = np.zeros(sim.npts+1) # cum[d] is the diagnoses on days before d
+        self.t = 0 # Days counted so far
+        return
+
+
+    @classmethod
+    def get(cls, sim):
+        ''' The counter kept on this sim, making a new one if the sim has none or its results have been reset '''
+        counter = getattr(sim, '_diagnosis_counter', None)
+        if counter is None or counter.source is not sim.results['new_diagnoses'].values or counter.t > sim.t:
+            counter = cls(sim)
+            sim._diagnosis_counter = counter # Copied along with the sim, so forks keep counting from where it was
+        return counter
+
+
+    def update(self, t):
+        ''' Count the days before day t; each day is only counted once, after it has finished '''
+        if t > self.t:
+            self.cum[self.t+1:t+1] = self.cum[self.t] + np.cumsum(self.source[self.t:t])
+            self.t = t
+        return
+
+
+    def window(self, t, days):
+        ''' Mean daily diagnoses over the given number of days before day t '''
+        self.update(t)
+        start = max(t-days, 0)
+        return (self.cum[t] - self.cum[start])/days
+
+
+class shared_trigger(cv.trigger):
+    '''
+    A trigger on daily diagnoses that reads them from the sim's DiagnosisCounter
+    rather than counting them itself. Takes the same arguments as
+    cv.trigger('date_diagnosed', ...): the trigger is on when the mean daily
+    diagnoses over the last smoothing days is above (or, with
+    direction='below', below) the threshold.
+
+    **Example**::
+
+        cv.change_beta(days=0, changes=0.42, trigger=shared_trigger('date_diagnosed', 5))
+    '''
+
+    def __init__(self, stat, threshold, direction='above', smoothing=1, **kwargs):
+        if stat != 'date_diagnosed':
+            raise ValueError(f'shared_trigger only counts diagnoses, not "{stat}"; use cv.trigger() instead')
+        if direction not in ['above', 'below']:
+            raise ValueError(f'Trigger direction must be "above" or "below", not "{direction}"')
+        super().__init__(stat, threshold, direction=direction, smoothing=smoothing, **kwargs)
+        self._threshold = threshold # Kept under our own names, so they're read the same way whatever cv.trigger does with its arguments
+        self._direction = direction
+        self._smoothing = smoothing
+        return
+
+
+    def __call__(self, sim):
+        ''' Whether the trigger is on at the sim's current day '''
+        value = DiagnosisCounter.get(sim).window(sim.t, self._smoothing)
+        if self._direction == 'above':
+            return value > self._threshold
+        return value < self._threshold
+
+
+class trigger_days(cv.Analyzer):
+    '''
+    Record what the triggered interventions change on each day -- the overall
+    and per-layer beta, the number of edges in each layer, and the symptomatic
+    testing probability of each intervention -- so that two runs can be checked
+    to have had their interventions fire on the same days.
+    '''
+
+    def __init__(self, label='trigger_days', **kwargs):
+        super().__init__(label=label, **kwargs)
+        self.states = []
+        return
+
+
+    def apply(self, sim):
+        self.states.append((sim['beta'], dict(sim['beta_layer']), {lkey:len(layer) for lkey,layer in sim.people.contacts.items()},
+                            [getattr(intervention, 'symp_prob', None) for intervention in sim['interventions']]))
+        return
+
+
+class ContactIndex:
+    '''
+    Compressed sparse row adjacency of one contact layer: the contacts of
+    person i are indices[indptr[i]:indptr[i+1]], with each edge listed from
+    both ends, as Layer.find_contacts() treats it. The index keeps the p1 and
+    p2 arrays it was built from; Covasim replaces these arrays rather than
+    editing them (clip_edges, for instance, makes new ones each time it moves
+    edges in or out of the layer), so the layer is unchanged as long as it
+    still holds the same arrays.
+
+    Args:
+        p1 (array): first person of each edge
+        p2 (array): second person of each edge
+        n_people (int): size of the population
+    '''
+
+    def __init__(self, p1, p2, n_people):
+        self.p1 = p1
+        self.p2 = p2
+        source = np.concatenate([p1, p2])
+        order = np.argsort(source) # The order of each person's contacts doesn't matter, since find_contacts() sorts them
+        self.indices = np.concatenate([p2, p1])[order]
+        self.indptr = np.zeros(n_people+1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=n_people), out=self.indptr[1:])
+        return
+
+
+    @classmethod
+    def get(cls, sim, lkey):
+        ''' The index of this layer of the sim, building it if the layer's edges have changed since it was last indexed '''
+        layer = sim.people.contacts[lkey]
+        p1, p2 = layer['p1'], layer['p2']
+        key = (id(p1), id(p2)) # Unambiguous, since the index keeps both arrays alive while it's stored
+        index = _indexes.pop(key, None)
+        if index is None or index.p1 is not p1 or index.p2 is not p2:
+            index = cls(p1, p2, len(sim.people))
+        _indexes[key] = index # Move it to the end, so the least recently used are dropped first
+        while len(_indexes) > max_indexes:
+            _indexes.pop(next(iter(_indexes)))
+        return index
+
+
+    def find_contacts(self, inds):
+        ''' The contacts of these people as a sorted array without duplicates, the same as Layer.find_contacts(inds) '''
+        inds = np.asarray(inds)
+        starts = self.indptr[inds]
+        counts = self.indptr[inds+1] - starts
+        total = counts.sum()
+        if not total:
+            return np.empty(0, dtype=self.indices.dtype)
+        positions = np.arange(total) + np.repeat(starts - (np.cumsum(counts) - counts), counts) # The slices of every person, concatenated
+        return np.unique(self.indices[positions])
+
+
+def clear_indexes():
+    ''' Drop every ContactIndex kept in this process '''
+    _indexes.clear()
+    return
+
+
+class indexed_contact_tracing(cv.contact_tracing):
+    '''
+    cv.contact_tracing, finding the contacts of the people traced each day
+    from a ContactIndex of each layer rather than by scanning the layer's
+    edges. Takes the same arguments and traces the same contacts, though not
+    necessarily with the same random draws; benchmarks/bench_contact_tracing.py
+    checks the contacts exactly and the numbers notified statistically.
+
+    **Example**::
+
+        indexed_contact_tracing(start_day=0, trace_probs={'h':1, 's':0.95, 'w':0.8, 'c':0.05}, trace_time={'h':0, 's':2, 'w':2, 'c':5})
+    '''
+
+    def initialize(self, sim):
+        ''' Process the arguments as cv.contact_tracing does, and index the traced layers '''
+        super().initialize(sim)
+        for lkey,trace_prob in self.trace_probs.items():
+            if trace_prob:
+                ContactIndex.get(sim, lkey)
+        return
+
+
+    def apply(self, sim):
+        '''
+        Trace and notify the contacts of the people diagnosed today, as the
+        pinned cv.contact_tracing.apply() does: layer by layer, skipping
+        layers with no chance of tracing or no transmission (beta_layer of 0),
+        with each layer's contacts notified before the next is traced.
+        '''
+        t = sim.t
+        if t < self.start_day:
+            return
+        elif self.end_day is not None and t > self.end_day:
+            return
+
+        if not self.presumptive:
+            trace_inds = cvu.true(sim.people.date_diagnosed == t) # Diagnosed this time step, time to trace
+        else:
+            just_tested = cvu.true(sim.people.date_tested == t) # Tested this time step, time to trace
+            trace_inds = cvu.itruei(sim.people.exposed, just_tested) # This is necessary to avoid infinite chains of asymptomatic testing
+        if not len(trace_inds):
+            return
+
+        for lkey,trace_prob in self.trace_probs.items():
+            if trace_prob == 0 or sim['beta_layer'][lkey] == 0:
+                continue
+            trace_time = self.trace_time[lkey]
+            traceable_inds = ContactIndex.get(sim, lkey).find_contacts(trace_inds)
+            contact_inds = cvu.binomial_filter(trace_prob, traceable_inds)
+            if len(contact_inds):
+                sim.people.known_contact[contact_inds] = True
+                sim.people.date_known_contact[contact_inds] = np.fmin(sim.people.date_known_contact[contact_inds], t + trace_time)
+                sim.people.schedule_quarantine(contact_inds, t + trace_time, self.quar_period - trace_time) # Quarantine starts on the day they're notified
+        return
@@ -0,0 +1,384 @@
+'''
+Model definition for the central Vietnam analyses. Kept separate from
+run_vietnam_central.py so that worker processes can build sims without
+re-running the analysis script.
+'''
+
+import os
+import hashlib
+import covasim as cv
+import covasim.utils as cvu
+import sciris as sc
+import pylab as pl
+import numpy as np
+from vietnam_calendar import calendar as cal
+import sharedpeople
+import vietnam_interventions as vi
+from sharedpeople import copy_sim # Use instead of sim.copy() for runs, so shared population arrays aren't duplicated
+
+
+########################################################################
+# Base sim cache
+########################################################################
+# The people only depend on these parameters (the sims are all built with
+# seed=1 and then reseeded), so one initialized base sim can be reused for
+# every beta, policy and testing rate
+cachefolder = 'results/cache'
+pop_keys = ['pop_size', 'pop_type', 'location', 'rand_seed']
+_base_sims = {}
+
+
+def base_sim_key(pars):
+    ''' Hash of the parameters that determine the population '''
+    keyinfo = [(key, pars[key]) for key in pop_keys] + [('covasim', cv.__version__)]
+    return hashlib.md5(repr(keyinfo).encode()).hexdigest()
+
+
+def base_sim_file(pars):
+    ''' Where the base sim for these parameters is cached on disk '''
+    return os.path.join(cachefolder, f'base_{base_sim_key(pars)}.sim')
+
+
+def get_base_sim(pars, use_disk=True):
+    '''
+    Return an initialized sim with the population for these parameters, from
+    memory or the on-disk cache if it has already been built. The returned sim
+    is shared, so copy it before changing it.
+    '''
+    key = base_sim_key(pars)
+    if key not in _base_sims:
+        filename = base_sim_file(pars)
+        if use_disk and os.path.exists(filename):
+            base = cv.load(filename)
+        else:
+            base = cv.Sim(pars=sc.mergedicts(pars, {'interventions':[], 'analyzers':[]}), datafile=cal.data.copy())
+            base.initialize()
+            if use_disk: # Write to a temporary file first, since several workers may be building the same sim
+                os.makedirs(cachefolder, exist_ok=True)
+                tmpfile = f'{filename}.{os.getpid()}.tmp'
+                base.save(tmpfile, keep_people=True)
+                os.replace(tmpfile, filename)
+        _base_sims[key] = base
+    return _base_sims[key]
+
+
+def share_population(sim):
+    '''
+    Put the read-only arrays of an initialized sim's population in shared
+    memory (see sharedpeople), so that forked workers and every sim built from
+    the same population use one copy of them. Call before the worker pool starts.
+    '''
+    sharedpeople.publish(sim)
+    for other in list(_base_sims.values()) + list(_sims.values()):
+        sharedpeople.use_shared(other)
+    return
+
+
+# Sims built in this process by shared_sim(), keyed by the make_sim() arguments
+_sims = {}
+
+
+def shared_sim(**kwargs):
+    ''' Build the sim for these make_sim() arguments once per process and reuse it for every seed; copy it before running '''
+    if 'resume_dates' in kwargs:
+        kwargs['resume_dates'] = tuple(kwargs['resume_dates']) # However they were given, so they can be part of the key
+    key = tuple(sorted(kwargs.items()))
+    if key not in _sims:
+        _sims[key] = make_sim(**kwargs)
+    return _sims[key]
+
+
+########################################################################
+# Make the sim
+########################################################################
+total_pop = 11.9e6 # Population of central Vietnam
+shared_triggers = False # Have the triggers on daily diagnoses share one running count per sim (see vietnam_interventions), rather than each counting them every day; checked by check_shared_triggers() before use
+indexed_tracing = False # Find the contacts to trace from a per-layer index (see vietnam_interventions) rather than by scanning every edge; the same contacts are found, but the draws of which are traced may differ seed by seed; run benchmarks/bench_contact_tracing.py before turning it on
+
+
+def diagnosis_trigger(threshold, **kwargs):
+    ''' A trigger on daily diagnoses, shared or not according to shared_triggers '''
+    if shared_triggers:
+        return vi.shared_trigger('date_diagnosed', threshold, **kwargs)
+    return cv.trigger('date_diagnosed', threshold, **kwargs)
+
+
+def check_shared_triggers(seed=1, beta=0.0135, policy='dynamic', **kwargs):
+    '''
+    Run one seed with cv.trigger and with shared_trigger, and check that the
+    shared count was read and that every triggered intervention fired on the
+    same days both ways. kwargs are passed to make_sim().
+
+    Raises:
+        RuntimeError: if shared_trigger was never evaluated, or the runs differ
+    '''
+    global shared_triggers
+    saved = shared_triggers
+    states = []
+    try:
+        for shared in [False, True]:
+            shared_triggers = shared
+            sim = run_sim(make_sim(seed, beta, policy=policy, analyzers=[vi.trigger_days()], **kwargs))
+            states.append(sim['analyzers'][-1].states)
+    finally:
+        shared_triggers = saved
+    if not hasattr(sim, '_diagnosis_counter'):
+        raise RuntimeError('shared_trigger was never evaluated, so this version of cv.trigger is not asked through __call__(); set shared_triggers = False')
+    differ = [t for t,(a,b) in enumerate(zip(*states)) if a != b]
+    if differ or len(states[0]) != len(states[1]):
+        day = differ[0] if differ else min(len(states[0]), len(states[1]))
+        raise RuntimeError(f'The interventions fired differently with shared_trigger than with cv.trigger, from {sim.date(day)} (seed {seed}, policy {policy}); set shared_triggers = False')
+    return
+
+
+def contact_tracing(**kwargs):
+    ''' Contact tracing, indexed or not according to indexed_tracing '''
+    if indexed_tracing:
+        return vi.indexed_contact_tracing(**kwargs)
+    return cv.contact_tracing(**kwargs)
+
+
+# Durations for imported infections, which arrive already infectious
+dur_imports = cv.make_pars()['dur']
+dur_imports['exp2inf']  = {'dist':'lognormal_int', 'par1':0.0, 'par2':0.0}
+dur_imports['inf2sym']  = {'dist':'lognormal_int', 'par1':0.0, 'par2':0.0}
+dur_imports['sym2sev']  = {'dist':'lognormal_int', 'par1':0.0, 'par2':2.0}
+dur_imports['sev2crit'] = {'dist':'lognormal_int', 'par1':1.0, 'par2':3.0}
+dur_imports['crit2die'] = {'dist':'lognormal_int', 'par1':3.0, 'par2':3.0}
+
+
+def make_imports(import_seed=None):
+    '''
+    Daily imported infections: the hard-coded first wave, then negative-binomial
+    importations while the borders are open. If import_seed is given, the
+    border importations are drawn from their own random stream with that seed,
+    so that runs of different scenarios with the same seed get the same imports.
+    '''
+    days = cal.days
+    import_end   = days['import_end']
+    border_start = days['border_start'] # Open borders for one month
+    border_end   = days['border_end'] # Then close them again
+    final_day_ind  = days['final_day']
+    if import_seed is None:
+        border_imports = cv.n_neg_binomial(1, 0.25, border_end-border_start) # Negative-binomial distributed importations each day
+    else:
+        rate, dispersion = 1, 0.25 # As for cv.n_neg_binomial(1, 0.25)
+        border_imports = np.random.RandomState(import_seed).negative_binomial(n=dispersion, p=dispersion/(rate+dispersion), size=border_end-border_start)
+    imports = np.concatenate((np.array([1, 0, 0, 0, 2, 2, 8, 4, 1, 1, 0, 0, 0, 0, 3, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 2, 3, 1, 1, 3, 0, 3, 0, 1, 6, 1, 5, 0, 0]), # Generated from cv.n_neg_binomial(1, 0.25) but then hard-copied to remove variation when calibrating
+                              pl.zeros(border_start-import_end), # No imports from the end of the 1st importation window to the border reopening
+                              border_imports,
+                              pl.zeros(final_day_ind-border_end)
+                              ))
+    return imports
+
+
+def make_sim(seed, beta, change=0.42, policy='remain', threshold=5, symp_prob=0.01, end_day=None, analyzers=None, use_cache=True, import_seed=None, n_agents=100e3, resume_dates=()):
+    '''
+    Build a sim of central Vietnam. Each agent represents total_pop/n_agents
+    people; with n_agents=total_pop, everyone is simulated and nothing is
+    rescaled (see memory.py for whether that fits). run_sim() reseeds it on
+    each of the resume_dates (see extend_sim()).
+    '''
+
+    start_day = '2020-06-15'
+    if end_day is None: end_day = '2021-04-30'
+    days = cal.days # Precomputed date-to-day lookups
+    pop_scale = total_pop/n_agents
+
+    # Calibration parameters
+    pars = {'pop_size': n_agents,
+            'pop_infected': 0,
+            'pop_scale': pop_scale,
+            'rand_seed': seed,
+            'beta': beta,
+            'start_day': start_day,
+            'end_day': end_day,
+            'verbose': 0,
+            'rescale': pop_scale > 1,
+            'iso_factor': dict(h=0.5, s=0.01, w=0.01, c=0.1),  # Multiply beta by this factor for people in isolation
+            'quar_factor': dict(h=1.0, s=0.2, w=0.2, c=0.2),   # Multiply beta by this factor for people in quarantine
+            'location': 'vietnam',
+            'pop_type': 'hybrid',
+            'age_imports': [50,80],
+            'rel_crit_prob': 1.75, # Calibration parameter due to hospital outbreak
+            'rel_death_prob': 2., # Calibration parameter due to hospital outbreak
+            }
+
+    # Set up import assumptions
+    pars['dur_imports'] = sc.dcp(dur_imports)
+
+    # Define import array
+    pars['n_imports'] = make_imports(import_seed)
+
+    # Add testing and tracing interventions
+    trace_probs = {'h': 1, 's': 0.95, 'w': 0.8, 'c': 0.05}
+    trace_time  = {'h': 0, 's': 2, 'w': 2, 'c': 5}
+    pars['interventions'] = [
+        # Testing and tracing
+        cv.test_num(daily_tests=cal.daily_tests, start_day=2, end_day=days['test_num_end'], symp_test=80, quar_test=80, do_plot=False),
+        cv.test_prob(start_day=days['test_prob_start'], end_day=days['test_prob_end'], symp_prob=0.05, asymp_quar_prob=0.5, do_plot=False),
+        cv.test_prob(start_day=days['symp_test_start'], symp_prob=symp_prob, asymp_quar_prob=0.5,
+                     trigger=diagnosis_trigger(5), triggered_vals={'symp_prob':0.2}, do_plot=False, label='symp_testing'),
+        contact_tracing(start_day=0, trace_probs=trace_probs, trace_time=trace_time, do_plot=False),
+
+        # Change death and critical probabilities
+        cv.dynamic_pars({'rel_death_prob':{'days':days['rel_probs_end'], 'vals':1.0},'rel_crit_prob':{'days':days['rel_probs_end'], 'vals':1.0}},do_plot=False), # Assume these were elevated due to the hospital outbreak but then would return to normal
+
+        # Increase precautions (especially mask usage) following the outbreak, which are then abandoned after 40 weeks of low case counts
+        cv.change_beta(days=0, changes=change, trigger=diagnosis_trigger(5)),
+
+        # Close schools and workplaces
+        cv.clip_edges(days=['2020-07-28', '2020-09-14'], changes=[0.1, 1.], layers=['s'], do_plot=True),
+        cv.clip_edges(days=['2020-07-28', '2020-09-05'], changes=[0.1, 1.], layers=['w'], do_plot=False),
+
+        # Dynamically close them again if cases go over the threshold
+        cv.clip_edges(days=[170], changes=[0.1], layers=['s'], trigger=diagnosis_trigger(threshold)),
+        cv.clip_edges(days=[170], changes=[0.1], layers=['w'], trigger=diagnosis_trigger(threshold)),
+    ]
+
+    if policy != 'remain':
+        pars['interventions'] += [cv.change_beta(days=160, changes=1.0, trigger=diagnosis_trigger(2, direction='below', smoothing=28), label='policy')]
+    if policy == 'dynamic':
+        pars['interventions'] += [cv.change_beta(days=170, changes=change, trigger=diagnosis_trigger(threshold), label='policy'),
+                                  ]
+
+    pars['analyzers'] = analyzers if analyzers is not None else []
+
+    if use_cache: # Clone the cached base sim and swap in everything except the people
+        sim = get_base_sim(pars).copy()
+        sim.update_pars(pars)
+        sim.people.set_pars(sim.pars)
+    else:
+        sim = cv.Sim(pars=pars, datafile=cal.data.copy()) # Use the already-parsed data
+    sim.initialize() # Keeps existing people, so this only resets the results and interventions
+    sharedpeople.use_shared(sim) # Swap in the shared read-only arrays, if the population has been published
+    sim.resume_dates = tuple(resume_dates)
+
+    return sim
+
+
+########################################################################
+# Forking scenarios
+########################################################################
+# The policy and testing scenarios only differ from day 160 on: the policy
+# interventions start on day 160, the borders reopen on day 168 and the
+# testing scenarios start on day 169. So each (beta, seed) can be run once up
+# to fork_day and then branched into every scenario. Every run that gets past
+# fork_day is reseeded there, so a forked run gives the same results as running
+# the scenario from day 0 with the same seed.
+fork_day = 160
+fork_seed_offset = 1000003 # Added to the run's seed when reseeding at fork_day
+
+
+def reseeds(sim):
+    ''' The days on which the sim is reseeded, with what is added to its seed on each, in order '''
+    days = [(cal.day(date), resume_seed_offset + cal.day(date)) for date in getattr(sim, 'resume_dates', ())] + [(fork_day, fork_seed_offset)]
+    return sorted(days)
+
+
+def run_sim(sim, until=None):
+    '''
+    Run a sim to the given day (by default, to the end), reseeding it before it
+    steps fork_day or any of its resume_dates, so that its results match those
+    of a forked or resumed run. Also continues a sim that has already been run
+    partway.
+    '''
+    until = sim.npts if until is None else until
+    reset_seed = not sim.t # A new sim is seeded from its rand_seed, as by sim.run()
+    for day,offset in reseeds(sim):
+        if sim.t <= day < until:
+            if sim.t < day:
+                sim.run(until=day, reset_seed=reset_seed)
+                if sim.t < day: # Stopped by its stopping_func
+                    return sim
+            cvu.set_seed(sim['rand_seed'] + offset)
+            reset_seed = False
+    if sim.t < until:
+        sim.run(until=until, reset_seed=reset_seed)
+    return sim
+
+
+def run_from_fork(sim):
+    ''' Reseed a sim that has been run to fork_day and run it to the end '''
+    return run_sim(sim)
+
+
+def fork_sim(sim, variant):
+    '''
+    Branch a sim that has been run to fork_day into a scenario. The people, the
+    results so far, and the state of the interventions shared by all scenarios
+    are kept from sim; the imports, the symptomatic testing, and the policy
+    interventions -- none of which have acted yet -- are taken from variant, a
+    sim made by make_sim() with the same beta and the scenario's settings.
+
+    Args:
+        sim (Sim): the sim run to fork_day; not modified
+        variant (Sim): the unrun sim for the scenario
+
+    Returns:
+        A copy of sim set up for the scenario, ready for run_from_fork()
+    '''
+    if sim.t != fork_day:
+        raise ValueError(f'Sims can only be forked at t={fork_day}, not t={sim.t}')
+    fork = copy_sim(sim)
+    fork['n_imports'] = variant['n_imports']
+    interventions = []
+    for intervention in fork['interventions']:
+        if intervention.label == 'symp_testing':
+            intervention = sc.dcp(variant.get_intervention('symp_testing'))
+        if intervention.label != 'policy':
+            interventions.append(intervention)
+    interventions += [sc.dcp(intervention) for intervention in variant['interventions'] if intervention.label == 'policy'] # Already initialized with the same beta
+    fork['interventions'] = interventions
+    return fork
+
+
+########################################################################
+# Resuming runs
+########################################################################
+# When the data file is extended and the calibration window moves on, the
+# accepted runs of the previous fit are resumed from the state they were saved
+# in at the end of its window (see calibration.warm_fit()), rather than rerun
+# from day 0. Each date in the resume_dates given to make_sim() is the end of
+# an earlier window: the run is reseeded on that day, so that a resumed run
+# gives the same results as the same (beta, seed) run from day 0, and the later
+# stages reproduce the runs that were scored. They're set in
+# run_vietnam_central.py and passed to every run in its job.
+resume_seed_offset = 2000003 # Plus the day, added to the run's seed when reseeding on each of the resume_dates
+
+
+def extend_sim(sim, variant):
+    '''
+    Carry on a sim saved partway through a run in a longer run. The people, the
+    results so far, and the state of the interventions are kept from sim; the
+    end day, the data, the imports and the test numbers -- which depend on the
+    end day and the data file -- are taken from variant, an unrun sim made by
+    make_sim() with the same beta and the new end day.
+
+    Args:
+        sim (Sim): the sim to extend, e.g. loaded from a saved state; modified in place
+        variant (Sim): the unrun sim to extend it to
+
+    Returns:
+        sim, ready for run_sim()
+    '''
+    if not sim.t < variant.npts:
+        raise ValueError(f'Cannot extend a sim at t={sim.t} to end at t={variant.npts-1}')
+    extended = {key:variant[key] for key in ['end_day', 'n_days', 'n_imports']}
+    sim.update_pars(extended)
+    if getattr(sim, '_orig_pars', None): # Otherwise restored when the sim is finalized
+        sim._orig_pars.update(sc.dcp(extended))
+    sim.data = variant.data
+    sim.datafile = variant.datafile
+    for key in sim.result_keys():
+        result = sc.dcp(variant.results[key])
+        result.values[:len(sim.results[key].values)] = sim.results[key].values
+        sim.results[key] = result
+    for key in ['date', 't']:
+        sim.results[key] = variant.results[key]
+    rescale_vec = np.full(variant.npts, sim.rescale_vec[-1]) # The rescaling of every day after sim.t is already set to that of its last day
+    rescale_vec[:len(sim.rescale_vec)] = sim.rescale_vec
+    sim.rescale_vec = rescale_vec
+    sim.resume_dates = variant.resume_dates # Including the end of the window the sim was saved in
+    sim['interventions'] = [sc.dcp(new) if isinstance(new, cv.test_num) else old for old,new in zip(sim['interventions'], variant['interventions'])]
+    return sim